@@ -1,9 +1,11 @@
 import os
+import time
 import pymongo
-from pymongo.errors import OperationFailure
+from pymongo import ReplaceOne, DeleteMany
 import sys
 import json
 import datetime
+import itertools
 import re
 from tqdm import tqdm
 from pprint import pprint
@@ -14,16 +16,8 @@ client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_
                              password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
 db = client[os.getenv("COVID_DB")]
 
-use_test_db = False
-
-#Rebuild the entire entries collection
-rebuild = False
-
-if rebuild:
-    entries_to_build_query = {}
-else:
-    yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
-    entries_to_build_query = {"_bt": { "$gte" : yesterday }}
+# name of the metadata document holding the watermark and the change stream resume token
+sweep_metadata = "last_entries_searchable_builder_sweep"
 
 #Keys that are allowed in the entries database to keep it clean and minimal
 entries_keys = [
@@ -135,8 +129,7 @@ def strip_down_entry(entry):
     if 'similar_abstracts' in entry_searchable.keys():
         similar_abstracts_json = []
         for a in entry_searchable['similar_abstracts']:
-            doi = a[1]
-            matching_entry = db.entries.find_one({"doi": doi})
+            matching_entry = db.entries.find_one({"_id": a[1]})
             fields_to_include = ['title', 'authors', 'abstract', 'link']
             matching_entry = {k:v for k,v in matching_entry.items() if k in fields_to_include}
             similar_abstracts_json.append(matching_entry)
@@ -151,19 +144,120 @@ def strip_down_entry(entry):
 
 
 
-for doc in tqdm(list(db.entries.find(entries_to_build_query))):
-    if use_test_db:
-        collection_name = "entries_searchable_test"
-    else: 
-        collection_name = "entries_searchable"
-    stripped_down = strip_down_entry(doc)
-    if stripped_down:
-        existing_entry = db[collection_name].find_one({"doi": doc["doi"]})
-        if existing_entry:
-            try:
-                db[collection_name].find_one_and_replace({"doi": doc["doi"]}, stripped_down)
-            except OperationFailure:
-                db[collection_name].delete_one({"doi": doc["doi"]})
-                db[collection_name].insert_one(stripped_down)
-        else:
-            db[collection_name].insert_one(stripped_down)
+def upsert_requests(stripped_down):
+    """
+    Replace the searchable entry with the same _id, and drop older searchable entries
+    of the same doi that were built from another entry
+    """
+    requests = [ReplaceOne({"_id": stripped_down["_id"]}, stripped_down, upsert=True)]
+    if stripped_down.get("doi"):
+        requests.append(DeleteMany({"doi": stripped_down["doi"], "_id": {"$ne": stripped_down["_id"]}}))
+    return requests
+
+
+def build_batch(docs, collection_name):
+    """
+    Strip down a batch of entries and write them with one bulk write
+    :return: number of entries written
+    """
+    requests = []
+    count = 0
+    for doc in docs:
+        stripped_down = strip_down_entry(doc)
+        if stripped_down:
+            requests.extend(upsert_requests(stripped_down))
+            count += 1
+    if requests:
+        db[collection_name].bulk_write(requests, ordered=False)
+    return count
+
+
+def save_sweep(**values):
+    db.metadata.update_one({"data": sweep_metadata}, {"$set": values}, upsert=True)
+
+
+def sweep(collection_name="entries_searchable", batch_size=1000, rebuild=False):
+    """
+    Build the searchable entries of the entries modified (_bt) since the last sweep.
+
+    The entries are read in _bt order and the watermark is saved after each batch,
+    so an interrupted sweep resumes from the last batch written.
+    The first sweep, without a watermark, starts from yesterday like the old daily rebuild.
+    """
+    state = db.metadata.find_one({"data": sweep_metadata}) or {}
+    if rebuild:
+        query = {}
+    else:
+        watermark = state.get("datetime") or datetime.datetime.today() - datetime.timedelta(days=1)
+        query = {"_bt": {"$gte": watermark}}
+
+    # also in IndependentScripts/create_entries_indices.py, without it the sort is done in memory
+    db.entries.create_index([("_bt", pymongo.ASCENDING)])
+    cursor = db.entries.find(query, no_cursor_timeout=True).sort("_bt", 1).batch_size(batch_size)
+    count = 0
+    try:
+        with tqdm(total=db.entries.count_documents(query)) as progress:
+            while True:
+                docs = list(itertools.islice(cursor, batch_size))
+                if not docs:
+                    break
+                count += build_batch(docs, collection_name)
+                progress.update(len(docs))
+                last_bt = docs[-1].get("_bt")
+                if last_bt is not None:
+                    save_sweep(datetime=last_bt)
+    finally:
+        cursor.close()
+    return count
+
+
+def watch(collection_name="entries_searchable", batch_size=1000, max_wait=10):
+    """
+    Follow the change stream of entries (needs a replica set) and build the changed entries
+    in batches of batch_size, or whatever arrived within max_wait seconds.
+
+    The resume token is saved after each batch built, so a restarted watcher continues
+    where it stopped. Without a token, it sweeps from the watermark once the stream is open.
+    """
+    state = db.metadata.find_one({"data": sweep_metadata}) or {}
+    resume_token = state.get("resume_token")
+
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+    with db.entries.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+        if resume_token is None:
+            # the entries changed before the stream was opened are caught by the sweep
+            sweep(collection_name, batch_size)
+        while stream.alive:
+            changed = {}
+            deadline = time.time() + max_wait
+            while len(changed) < batch_size and time.time() < deadline:
+                change = stream.try_next()
+                if change is None:
+                    time.sleep(0.5)
+                    continue
+                if change.get("fullDocument") is not None:
+                    changed[change["documentKey"]["_id"]] = change["fullDocument"]
+            # the watermark only moves when entries were built
+            if changed:
+                build_batch(changed.values(), collection_name)
+                if stream.resume_token is not None:
+                    save_sweep(resume_token=stream.resume_token, datetime=datetime.datetime.now())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", help="sweep: build the entries modified since the last sweep, "
+                        "watch: follow the change stream of entries", nargs="?", default="sweep",
+                        choices=["sweep", "watch"])
+    parser.add_argument("--rebuild", help="sweep: rebuild all the entries", action="store_true")
+    parser.add_argument("--test-db", help="write to entries_searchable_test", action="store_true")
+    parser.add_argument("-b", "--batch-size", help="entries per bulk write, default=1000", type=int, default=1000)
+    args = parser.parse_args()
+
+    collection_name = "entries_searchable_test" if args.test_db else "entries_searchable"
+    if args.mode == "sweep":
+        sweep(collection_name, args.batch_size, rebuild=args.rebuild)
+    else:
+        watch(collection_name, args.batch_size)
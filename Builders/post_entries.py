@@ -1,13 +1,22 @@
 import os
+import time
 import pymongo
 import sys
 import json
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from elastic_app_search import Client
 from tqdm import tqdm
-import datetime
-from pprint import pprint
 import itertools
 
+logger = logging.getLogger(__name__)
+
+# App Search accepts at most 100 documents per index_documents request
+MAX_DOCUMENTS_PER_REQUEST = 100
+
+
 def grouper(n, iterable):
     it = iter(iterable)
     while True:
@@ -20,24 +29,123 @@ client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_
                              password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
 db = client[os.getenv("COVID_DB")]
 
+_local = threading.local()
+
+
+def get_app_client():
+    """One App Search client per thread, they do not share their HTTP session"""
+    if not hasattr(_local, "client"):
+        _local.client = Client(
+            base_endpoint='{}/api/as/v1'.format(os.getenv("APPSEARCH_API_ENDPOINT")),
+            api_key=os.getenv("APPSEARCH_API_KEY"),
+            use_https=True
+        )
+    return _local.client
+
+
+def is_transient(error):
+    """Throttling, server or connection errors, which a retry may get through"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is None or status == 429 or status >= 500
+    return False
+
+
+def index_documents(docs, max_retries=3, backoff=1.0):
+    """
+    Index documents into the entries engine, retrying the whole request with backoff when it fails
+    with a transient error (is_transient). Documents rejected with per-document (validation) errors
+    and requests failing otherwise are given up at once, a retry cannot succeed.
+
+    :return: (ids indexed, dict of id -> errors for the documents given up)
+    """
+    indexed = []
+    failed = {}
+    ids = set(doc['id'] for doc in docs)
+    for attempt in range(max_retries + 1):
+        try:
+            results = get_app_client().index_documents("entries", list(docs))
+            break
+        except Exception as e:
+            if attempt < max_retries and is_transient(e):
+                time.sleep(backoff * 2 ** attempt)
+                continue
+            failed.update((doc['id'], [repr(e)]) for doc in docs)
+            return indexed, failed
+
+    for result in results:
+        doc_id = result.get('id')
+        if doc_id not in ids:
+            logger.warning("App Search returned the unknown document id {!r}: {}".format(doc_id, result))
+        elif result.get('errors'):
+            failed[doc_id] = result['errors']
+        else:
+            indexed.append(doc_id)
+    return indexed, failed
+
+
+def post_entries(threads=8, batch_size=MAX_DOCUMENTS_PER_REQUEST, max_retries=3):
+    """
+    Index the unsynced entries_searchable documents, with up to `threads` requests in flight.
+    Only the documents App Search accepted are marked is_synced.
+    """
+    batch_size = min(batch_size, MAX_DOCUMENTS_PER_REQUEST)
+    query = {"is_synced": False}
+    total = db.entries_searchable.count_documents(query)
+
+    n_indexed = n_failed = 0
+    progress = tqdm(total=total)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {}
+
+        def collect(done):
+            nonlocal n_indexed, n_failed
+            for future in done:
+                ids = futures.pop(future)
+                indexed, failed = future.result()
+                if indexed:
+                    db.entries_searchable.update_many({"_id": {"$in": [ids[i] for i in indexed]}},
+                                                      {"$set": {"is_synced": True}})
+                for doc_id, errors in failed.items():
+                    logger.warning("Could not index {}: {}".format(doc_id, errors))
+                n_indexed += len(indexed)
+                n_failed += len(failed)
+                progress.update(len(ids))
+
+        for docs in grouper(batch_size, db.entries_searchable.find(query)):
+            ids = {}
+            for doc in docs:
+                doc['id'] = str(doc['_id'])
+                ids[doc['id']] = doc['_id']
+                del(doc['is_synced'])
+                del(doc['_id'])
+            futures[executor.submit(index_documents, docs, max_retries)] = ids
+            if len(futures) >= threads * 2:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(futures).done)
+    progress.close()
+
+    print("Indexed {} documents, {} failed".format(n_indexed, n_failed))
+    return n_indexed, n_failed
 
-doc_post_url=os.getenv("APPSEARCH_API_ENDPOINT")+"/api/as/v1/engines/entries/documents"
 
-elastic_app_client = Client(
-    base_endpoint='{}/api/as/v1'.format(os.getenv("APPSEARCH_API_ENDPOINT")),
-    api_key=os.getenv("APPSEARCH_API_KEY"),
-    use_https=True
-)
+if __name__ == "__main__":
+    import argparse
 
-yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--threads", help="requests in flight, default=8", type=int, default=8)
+    parser.add_argument("-b", "--batch-size", help="documents per request, at most 100", type=int,
+                        default=MAX_DOCUMENTS_PER_REQUEST)
+    parser.add_argument("-r", "--max-retries", help="retries of a request with a transient error, default=3",
+                        type=int, default=3)
+    args = parser.parse_args()
 
-for docs in grouper(100, db.entries_searchable.find({"is_synced": False})):
-    ids = []
-    for doc in docs:
-        ids.append(doc['_id'])
-        doc['id'] = str(doc['_id'])
-        del(doc['is_synced'])
-        del(doc['_id'])
-    pprint(elastic_app_client.index_documents("entries", docs))
-    db.entries_searchable.update_many({"_id": {"$in": ids}}, {"$set": {"is_synced":True}})
+    out_hdlr = logging.StreamHandler(sys.stdout)
+    out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(out_hdlr)
+    logger.setLevel(logging.INFO)
 
+    post_entries(threads=args.threads, batch_size=args.batch_size, max_retries=args.max_retries)
@@ -8,9 +8,14 @@ collection = db["entries"]
 
 collection.create_index([("doi", pymongo.DESCENDING)], unique=True)
 collection.create_index([("is_covid19_ml", pymongo.DESCENDING)])
+# Builders/entries_searchable_builder.py sweeps the entries in _bt order from a watermark
+collection.create_index([("_bt", pymongo.ASCENDING)])
 
 collection.create_index([("title", pymongo.TEXT), ("abstract", pymongo.TEXT), ("authors", pymongo.TEXT), ("journal", pymongo.TEXT), ("keywords", pymongo.TEXT), ("keywords_ML", pymongo.TEXT), ("summary_human", pymongo.TEXT)], name="text_search_index", default_language ="english")
 
+# the Vespa exporter resolves the ML category tags of each batch with a $in query on doi
+db["entries_categories_ml"].create_index([("doi", pymongo.ASCENDING)])
+
 # collection = db["google_form_submissions"]
 
 # collection.create_index([("doi", pymongo.DESCENDING)])
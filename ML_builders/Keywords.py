@@ -17,10 +17,13 @@ from mongoengine import connect
 
 from difflib import SequenceMatcher as SM
 import datetime
+import time
 from pprint import pprint
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'parsers'))
 from entries import EntriesDocument
+from instrumentation import Metrics, save_run, start_server_from_env
+from mongoengine.connection import get_db
 from mongoengine.queryset.visitor import Q
 
 nlp = spacy.load("en_core_sci_lg")
@@ -46,7 +49,11 @@ entries = EntriesDocument.objects(Q(keywords_ML=[]) | Q(keywords_ML__exists=Fals
 # In[48]:
 print(len(entries))
 
+start_server_from_env()
+metrics = Metrics("keywords")
+metrics.count("pending", len(entries))
 for entry in entries:
+    start = time.time()
     # example text
     text=""
     entry_dict = entry.to_mongo()
@@ -72,6 +79,7 @@ for entry in entries:
             phrase = phrase.replace("middle east respiratory syndrome", "MERS")
             ml_keywords.append(phrase)
         entry.keywords_ML = ml_keywords
+        metrics.count("with_keywords")
 
     covid19_words = ["COVID-19", "SARS-CoV2", "sars-cov-2", "nCoV-2019", "covid19", "sarscov2", "ncov2019", "covid 19", "sars cov2", "ncov 2019", "severe acute respiratory syndrome coronavirus 2", "Wuhan seafood market pneumonia virus", "Coronavirus disease", "covid", "wuhan virus"]
     if not entry.is_covid19:
@@ -106,4 +114,8 @@ for entry in entries:
             #pprint(entry_dict)
     entry.synced = False
     entry.save()
+    metrics.count("processed")
+    metrics.observe("entry_seconds", time.time() - start)
+
+save_run(metrics, get_db())
 
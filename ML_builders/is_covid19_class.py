@@ -9,7 +9,9 @@ import datetime
 import spacy
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'parsers'))
 from entries import EntriesDocument
+from instrumentation import Metrics, save_run, start_server_from_env
 from mongoengine import connect
+from mongoengine.connection import get_db
 from mongoengine.queryset.visitor import Q
 import itertools
 from joblib import Parallel, delayed
@@ -63,21 +65,30 @@ def process_batch(docs):
     init_mongoengine()
     covid19_classifier = spacy.load("./COVID19_Binary_430_2")
 
+    metrics = Metrics("classify", register=False)
     print("started parsing")
     for doc in docs:
         try:
-            is_covid19 = is_covid19_model(doc.to_mongo()) 
+            with metrics.timer("classify"):
+                is_covid19 = is_covid19_model(doc.to_mongo()) 
             if is_covid19 is not None:
                 doc.is_covid19_ML = is_covid19 # returns float value for score from model 
 
                 print(doc)
                 doc.synced = False
                 doc.save()
+                metrics.count("classified")
         except:
-            pass
+            metrics.count("failed")
     print("processed")
+    return metrics.to_dict()
 
 #for document in grouper(100, entries):
 #    process_batch(document)
+start_server_from_env()
+metrics = Metrics("classify")
+metrics.count("pending", len(entries))
 with Parallel(n_jobs=32) as parallel:
-   parallel(delayed(process_batch)(document) for document in grouper(500, entries))
+   for batch_metrics in parallel(delayed(process_batch)(document) for document in grouper(500, entries)):
+       metrics.merge(batch_metrics)
+save_run(metrics, get_db())
@@ -3,13 +3,12 @@ import os
 import pymongo
 from datetime import datetime
 from utils import clean_title, find_cited_by, find_references
-import gridfs
-import traceback
-from io import BytesIO
-from pdf_extractor.paragraphs import extract_paragraphs_pdf
+from pdf_extractor.sections import segment
 from mongoengine import DynamicDocument, ReferenceField, DateTimeField
 
-latest_version = 3
+latest_version = 4
+
+PDF_BUCKET = 'Scraper_connect_biorxiv_org_fs'
 
 class BiorxivDocument(VespaDocument):
     meta = {"collection": "biorxiv_parsed_vespa",
@@ -117,26 +116,23 @@ class BiorxivParser(Parser):
          'text': <class 'str'>
          }
 
+        The paragraphs are the ones stored on the PDF file by the extraction service
+        (pdf_extractor.service). A PDF not extracted yet is requested from the service, which
+        touches last_updated of the document once done, so that it is parsed again.
          """
         body_text = None
 
-        if self.parse_full_text:
-            paper_fs = gridfs.GridFS(self.db, collection='Scraper_connect_biorxiv_org_fs')
-            pdf_file = paper_fs.get(doc['PDF_gridfs_id'])
-
-            try:
-                paragraphs = extract_paragraphs_pdf(BytesIO(pdf_file.read()))
-            except Exception as e:
-                print('Failed to extract PDF %s(%r) (%r)' % (doc['Doi'], doc['PDF_gridfs_id'], e))
-                traceback.print_exc()
-                paragraphs = []
-
-            body_text = [{
-                'section_heading': None,
-                'text': x
-            } for x in paragraphs]
+        if self.parse_full_text and doc.get('PDF_gridfs_id') is not None:
+            files = self.db[PDF_BUCKET + '.files']
+            file_doc = files.find_one({'_id': doc['PDF_gridfs_id']},
+                                      {'pdf_extraction_success': 1, 'pdf_extraction_plist': 1})
+            if file_doc is None:
+                return body_text
 
-            return body_text
+            if file_doc.get('pdf_extraction_success') and file_doc.get('pdf_extraction_plist'):
+                body_text = segment(file_doc['pdf_extraction_plist'])
+            elif 'pdf_extraction_success' not in file_doc:
+                files.update_one({'_id': file_doc['_id']}, {'$set': {'pdf_extraction_requested': True}})
 
         return body_text
 
@@ -230,7 +226,7 @@ class UnparsedBiorxivDocument(DynamicDocument):
     meta = {"collection": "Scraper_connect_biorxiv_org"
     }
 
-    parser = BiorxivParser()
+    parser = BiorxivParser(parse_full_text=True)
 
     parsed_class = BiorxivDocument
 
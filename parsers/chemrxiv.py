@@ -3,10 +3,10 @@ import os
 import pymongo
 from datetime import datetime
 from utils import clean_title, find_cited_by, find_references, find_remaining_ids
-import gridfs
 import traceback
-from io import BytesIO
-from pdf_extractor.paragraphs import extract_paragraphs_pdf
+from pdf_extractor.cache import ExtractionCache
+from pdf_extractor.service import load_registry
+from pdf_extractor.sections import segment
 from mongoengine import DynamicDocument, ReferenceField, DateTimeField
 
 latest_version = 1
@@ -32,6 +32,10 @@ class ChemrxivParser(Parser):
                                      password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
 
         self.db = client[os.getenv("COVID_DB")]
+        self.extraction_cache = ExtractionCache(self.db)
+        # the settings of the extraction service, so that both find each other's results in the cache,
+        # read with the first PDF
+        self.pdf_source = None
 
     def _parse_doi(self, doc):
         """ Returns the DOI of a document as a <class 'str'>"""
@@ -119,20 +123,17 @@ class ChemrxivParser(Parser):
         body_text = None
 
         if self.parse_full_text:
-            paper_fs = gridfs.GridFS(self.db, collection='Scraper_chemrxiv_org_fs')
-            pdf_file = paper_fs.get(doc['PDF_gridfs_id'])
-
+            if self.pdf_source is None:
+                self.pdf_source = load_registry(self.db)['chemrxiv']
             try:
-                paragraphs = extract_paragraphs_pdf(BytesIO(pdf_file.read()))
+                paragraphs = self.extraction_cache.extract_gridfs(self.pdf_source.bucket, doc['PDF_gridfs_id'],
+                                                                  return_dicts=True, **self.pdf_source.settings())
             except Exception as e:
                 print('Failed to extract PDF %s(%r) (%r)' % (doc['Doi'], doc['PDF_gridfs_id'], e))
                 traceback.print_exc()
                 paragraphs = []
 
-            body_text = [{
-                'section_heading': None,
-                'text': x
-            } for x in paragraphs]
+            body_text = segment(paragraphs)
 
             return body_text
 
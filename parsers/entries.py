@@ -26,6 +26,8 @@ import re
 import os
 import pymongo
 import hashlib
+import time
+from instrumentation import Metrics
 
 client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
                              password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
@@ -280,7 +282,10 @@ parsed_collections = [
     RapidReviewsDocument
 ]
 
-def build_entries():
+def build_entries(metrics=None):
+    """Merge the documents parsed since the last sweep into the entries, counting them per collection in metrics"""
+    if metrics is None:
+        metrics = Metrics("build_entries", register=False)
     i=0
     #def find_matching_doc(doc):
     #    return []
@@ -295,15 +300,20 @@ def build_entries():
         #docs = [doc for doc in collection.objects()]
         print(len(docs))
         #docs = collection.objects()
+        source = collection._get_collection_name()
+        metrics.count("read", len(docs), source=source)
         for doc in docs:
             i+= 1
             if i%100 == 0:
                 print(i)
+            start = time.time()
             id_fields = [doc.to_mongo().get('doi', None), 
             doc.to_mongo().get('pubmed_id', None),
             doc.to_mongo().get('pmcid', None),
             ]
             matching_doc = find_matching_doc(doc)
+            metrics.observe("find_matching_doc_seconds", time.time() - start, source=source)
+            metrics.count("matched" if matching_doc else "unmatched", source=source)
             if len(matching_doc) == 1:
                 insert_doc = EntriesDocument(**merge_documents(doc.to_mongo(), matching_doc[0].to_mongo()))
                 insert_doc.id = matching_doc[0].id
@@ -333,8 +343,10 @@ def build_entries():
                 insert_doc.synced = False
                 try:
                     insert_doc.save()
+                    metrics.count("saved", source=source)
                 except:
-                    pass
+                    metrics.count("failed", source=source)
+            metrics.observe("build_seconds", time.time() - start, source=source)
     db.metadata.update_one({'data': 'last_entries_builder_sweep_vespa'}, {"$set": {"datetime": run_time}})
 
 
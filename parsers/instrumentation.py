@@ -0,0 +1,242 @@
+"""
+Timers, counters and histograms shared by the pipeline stages.
+
+Every stage creates one Metrics for its run, records what it does per source collection,
+and saves a run record at the end, into db.metadata ({"data": "run_record", "stage": ...})
+and/or a JSON lines log:
+
+    metrics = Metrics("export")
+    with metrics.timer("batch", source="entries_vespa2"):
+        ...
+    metrics.count("exported", 500, source="entries_vespa2")
+    metrics.save(db, path=os.getenv("PIPELINE_METRICS_LOG"))
+
+Metrics of worker processes are returned as dicts (to_dict) and merged into the stage's Metrics
+(merge). serve(port) exposes the current metrics in the Prometheus text format;
+start_server_from_env() does so when PIPELINE_METRICS_PORT is set. Only the latest registered
+Metrics of each stage is exposed: a new run of a stage in the same process replaces the previous one.
+"""
+import os
+import json
+import time
+import socket
+import threading
+import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds of the histogram buckets, in seconds for timers
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800, 3600, float("inf"))
+
+_registry = OrderedDict()  # stage -> its latest registered Metrics
+_registry_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for i, n in enumerate(other["counts"]):
+            self.counts[i] += n
+        self.count += other["count"]
+        self.sum += other["sum"]
+        for key, pick in [("min", min), ("max", max)]:
+            if other[key] is not None:
+                setattr(self, key, other[key] if getattr(self, key) is None else pick(getattr(self, key), other[key]))
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "min": self.min, "max": self.max,
+                "mean": self.sum / self.count if self.count else None, "counts": list(self.counts)}
+
+
+class Metrics:
+    """
+    Metrics of one run of a stage. Counters and histograms are keyed by name and source collection.
+    """
+
+    def __init__(self, stage, register=True):
+        self.stage = stage
+        self.started = datetime.datetime.now()
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        if register:
+            with _registry_lock:
+                _registry.pop(stage, None)
+                _registry[stage] = self
+
+    def count(self, name, n=1, source=None):
+        with self._lock:
+            self.counters[(name, source)] = self.counters.get((name, source), 0) + n
+
+    def observe(self, name, value, source=None):
+        with self._lock:
+            if (name, source) not in self.histograms:
+                self.histograms[(name, source)] = Histogram()
+            self.histograms[(name, source)].observe(value)
+
+    @contextmanager
+    def timer(self, name, source=None):
+        """time the block into the histogram <name>_seconds"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name + "_seconds", time.time() - start, source)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "counters": [[name, source, n] for (name, source), n in self.counters.items()],
+                "histograms": [[name, source, h.to_dict()] for (name, source), h in self.histograms.items()],
+            }
+
+    def merge(self, other):
+        """add the metrics of another Metrics, or of its to_dict() returned by a worker"""
+        if isinstance(other, Metrics):
+            other = other.to_dict()
+        if not other:
+            return
+        for name, source, n in other["counters"]:
+            self.count(name, n, source)
+        with self._lock:
+            for name, source, histogram in other["histograms"]:
+                if (name, source) not in self.histograms:
+                    self.histograms[(name, source)] = Histogram()
+                self.histograms[(name, source)].merge(histogram)
+
+    def record(self, **extra):
+        """the run record: duration and metrics grouped by source collection"""
+        by_source = {}
+        with self._lock:
+            for (name, source), n in self.counters.items():
+                by_source.setdefault(source or "all", {}).setdefault("counters", {})[name] = n
+            for (name, source), h in self.histograms.items():
+                summary = h.to_dict()
+                del summary["counts"]
+                by_source.setdefault(source or "all", {}).setdefault("histograms", {})[name] = summary
+        record = {
+            "data": "run_record",
+            "stage": self.stage,
+            "started": self.started,
+            "finished": datetime.datetime.now(),
+            "seconds": time.time() - self._start,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "sources": by_source,
+        }
+        record.update(extra)
+        return record
+
+    def save(self, db=None, path=None, **extra):
+        """
+        write the run record into db.metadata and/or append it to the JSON lines file path
+        """
+        record = self.record(**extra)
+        if db is not None:
+            db.metadata.insert_one(dict(record))
+        if path:
+            with open(path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        return record
+
+    def families(self):
+        """the samples of the metrics as [(family, type, lines)], for exposition()"""
+        def labels(source, **more):
+            pairs = [("stage", self.stage)] + ([("source", source)] if source else []) + sorted(more.items())
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+        families = []
+        with self._lock:
+            for (name, source), n in sorted(self.counters.items(), key=str):
+                families.append(("pipeline_%s_total" % name, "counter",
+                                 ["pipeline_%s_total%s %s" % (name, labels(source), n)]))
+            for (name, source), h in sorted(self.histograms.items(), key=str):
+                lines = []
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append("pipeline_%s_bucket%s %d" % (
+                        name, labels(source, le="+Inf" if bound == float("inf") else bound), cumulative))
+                lines.append("pipeline_%s_sum%s %s" % (name, labels(source), h.sum))
+                lines.append("pipeline_%s_count%s %d" % (name, labels(source), h.count))
+                families.append(("pipeline_%s" % name, "histogram", lines))
+        families.append(("pipeline_run_seconds", "gauge",
+                         ["pipeline_run_seconds%s %s" % (labels(None), time.time() - self._start)]))
+        return families
+
+    def prometheus(self):
+        """the metrics in the Prometheus text exposition format"""
+        return exposition([self])
+
+
+def exposition(all_metrics):
+    """
+    the metrics of several Metrics in the Prometheus text exposition format, the samples of each
+    family grouped under a single # TYPE line
+    """
+    grouped = OrderedDict()
+    for metrics in all_metrics:
+        for family, kind, lines in metrics.families():
+            grouped.setdefault(family, (kind, []))[1].extend(lines)
+    out = []
+    for family, (kind, lines) in grouped.items():
+        out.append("# TYPE %s %s" % (family, kind))
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with _registry_lock:
+            data = exposition(list(_registry.values())).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port):
+    """serve the metrics of this process on http://<host>:port/metrics, from a daemon thread"""
+    server = HTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server_from_env():
+    """serve the metrics on PIPELINE_METRICS_PORT if set, a port already in use only disables the endpoint"""
+    port = os.getenv("PIPELINE_METRICS_PORT")
+    if not port:
+        return None
+    try:
+        return serve(int(port))
+    except OSError as e:
+        print("Metrics endpoint disabled, cannot listen on port %s: %s" % (port, e))
+        return None
+
+
+def save_run(metrics, db=None, **extra):
+    """save the run record into db.metadata and into the log file PIPELINE_METRICS_LOG if set"""
+    return metrics.save(db, path=os.getenv("PIPELINE_METRICS_LOG"), **extra)
@@ -1,16 +1,49 @@
 import os
+import time
+import hashlib
+import itertools
 import pymongo
 import json
 from tqdm import tqdm
 import datetime
 import unidecode
-from multiprocessing import Pool
+from functools import partial
+from multiprocessing import Pool, cpu_count
 from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne, DeleteMany
+from vespa_feed import VespaFeedClient
+from vespa_tensor import ENCODINGS, encode_tensor
+from instrumentation import Metrics, save_run, start_server_from_env
+import profiling
 client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
                                  password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
 db = client[os.getenv("COVID_DB")]
 
-def doc_to_json(doc):
+def categories_to_tags(categories):
+    return [key for key in categories if categories[key][0] == True]
+
+
+def load_tags(dois):
+    """
+    Resolve the ML category tags of a batch of DOIs with a single query.
+
+    Returns a dict of doi -> tags
+    """
+    dois = [doi for doi in dois if doi is not None]
+    if not dois:
+        return {}
+    return {match["doi"]: categories_to_tags(match["categories"])
+            for match in db.entries_categories_ml.find({"doi": {"$in": dois}}, {"doi": 1, "categories": 1})}
+
+
+def doc_to_json(doc, tags=None, tensor_encoding="list"):
+    """
+    Convert an entry into a Vespa put operation.
+
+    tags is a dict of doi -> tags preloaded with load_tags. If it is None, the tags
+    are looked up in entries_categories_ml for this document only.
+    tensor_encoding is the encoding of the embeddings, see vespa_tensor.ENCODINGS.
+    """
     if not "timestamp" in doc:
         try:
             doc["timestamp"] = int(doc["publication_date"].timestamp())
@@ -57,13 +90,15 @@ def doc_to_json(doc):
     if "altmetric" in doc:
         del doc['altmetric']
     # Tags #
-    tags = []
+    doc_tags = []
     if "doi" in doc and doc["doi"] is not None:
-        possible_match = db.entries_categories_ml.find_one({"doi": doc["doi"]})
-        if possible_match:
-            possible_tags = possible_match["categories"]
-            tags = [key for key in possible_tags if possible_tags[key][0] == True]
-    doc["tags"] =  tags
+        if tags is not None:
+            doc_tags = tags.get(doc["doi"], [])
+        else:
+            possible_match = db.entries_categories_ml.find_one({"doi": doc["doi"]})
+            if possible_match:
+                doc_tags = categories_to_tags(possible_match["categories"])
+    doc["tags"] = doc_tags
 
     #TODO: Find way to make ids shorter
     #print(unidecode.unidecode(doc.get('title', "")))
@@ -100,11 +135,11 @@ def doc_to_json(doc):
         del doc["source_documents"]
     abstract_embedding = doc.get("embeddings", {}).get("abstract_embedding", None)
     if abstract_embedding:
-        abstract_embedding = {"values": abstract_embedding}
+        abstract_embedding = encode_tensor(abstract_embedding, tensor_encoding)
     doc["abstract_embedding"] = abstract_embedding
     title_embedding = doc.get("embeddings", {}).get("title_embedding", None)
     if title_embedding:
-        title_embedding = {"values": title_embedding}
+        title_embedding = encode_tensor(title_embedding, tensor_encoding)
     doc["title_embedding"] = title_embedding
     if "embeddings" in doc:
         del doc["embeddings"]
@@ -135,33 +170,236 @@ def doc_to_json(doc):
         return vespa_doc
 
 
-def process_chunk(chunk):
+feed_client = None
+
+
+def init_worker(endpoint=None, connections=8, max_in_flight=64):
+    """Connect each worker to the database after forking, and to Vespa if endpoint is given"""
+    global db, feed_client
     client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
                                  password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
     db = client[os.getenv("COVID_DB")]
+    profiling.install_from_env()
+    if endpoint is not None:
+        feed_client = VespaFeedClient(endpoint, connections=connections, max_in_flight=max_in_flight)
 
-    processed_docs = []
-    for doc in chunk:
-        processed_docs.append(doc_to_json(doc, db))
 
-    db.entries_vespa_upload.insert_many(processed_docs)
+def grouper(n, iterable):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
 
-    return processed_docs
 
+def field_hashes(fields):
+    """Hash every field of a Vespa document, to find the fields changed since the last sync"""
+    return {k: hashlib.sha1(json.dumps(v, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            for k, v in fields.items()}
 
-if __name__ == '__main__':
-    new_docs = db.entries_vespa2.find({'synced':False})
-    processed_docs = []
-    for doc in tqdm(list(new_docs), total = new_docs.count(),mininterval=20,maxinterval=60):
-        processed_doc=doc_to_json(doc)
+
+def feed_operation(vespa_doc, old_hashes, new_hashes):
+    """
+    Turn a put from doc_to_json into the smallest feed operation.
+
+    If the document was synced before (old_hashes is not None), only the fields whose hash
+    changed are sent, as a partial update assigning the new values:
+        {'update': 'id:covid-19:doc::<id>', 'fields': {<field>: {'assign': <value>}}}
+    A full put is kept when the document is new or a field has been removed.
+    Returns None if nothing changed.
+    """
+    if old_hashes is None or set(old_hashes) - set(new_hashes):
+        return vespa_doc
+
+    changed = [k for k, h in new_hashes.items() if old_hashes.get(k) != h]
+    if not changed:
+        return None
+
+    return {
+        'update': vespa_doc['put'],
+        'fields': {k: {'assign': vespa_doc['fields'][k]} for k in changed},
+        'synced': False
+    }
+
+
+def prepare_operations(docs, full=False, tensor_encoding="list"):
+    """
+    Convert a batch of entries into feed operations.
+
+    Returns a list of (entry _id, operation or None, field hashes). Entries which
+    doc_to_json rejects are left out.
+    """
+    tags = load_tags(set(doc.get('doi', None) for doc in docs))
+    ids = [doc['_id'] for doc in docs]
+    vespa_ids = ['id:covid-19:doc::%s' % _id for _id in ids]
+
+    old_hashes = {}
+    if not full:
+        old_hashes = {state['_id']: state['field_hashes'] for state in
+                      db.entries_vespa_sync_state.find({'_id': {'$in': ids}})}
+        # an operation still waiting in the staging collection could be overwritten,
+        # so these documents are sent in full
+        for staged in db.entries_vespa_upload.find(
+                {'$or': [{'put': {'$in': vespa_ids}}, {'update': {'$in': vespa_ids}}], 'synced': {'$ne': True}},
+                {'put': 1, 'update': 1}):
+            old_hashes.pop(ObjectId((staged.get('put') or staged['update']).split('::')[-1]), None)
+
+    operations = []
+    for doc in docs:
+        _id = doc['_id']
+        processed_doc = doc_to_json(doc, tags, tensor_encoding)
         if processed_doc is not None:
-            db.entries_vespa_upload.replace_one({'put': processed_doc['put']}, processed_doc, upsert=True)
-            #print(doc['id'])
-            db.entries_vespa2.update_one({'_id': ObjectId(doc['id'])}, {"$set": {"synced": True}})
-            #db.entries_vespa2.update_one({'id': ObjectId(doc['id'])}, {"$set": {"synced": True}})
-            #processed_docs.append(processed_doc)
-    #print(processed_docs)
-    #db.entries_vespa_upload.insert_many(processed_docs)
-    #db.entries_vespa2.update_many({"_id": {"$in": [e["fields"]['id'] for e in processed_docs]}},
-                                 #{"$set": {"synced": True}})
-        # processed_chunks = list(p.map(process_chunk, chunks))
+            hashes = field_hashes(processed_doc['fields'])
+            operations.append((_id, feed_operation(processed_doc, old_hashes.get(_id), hashes), hashes))
+
+    return operations
+
+
+# fields written by the parsers (_bt, last_updated), is_covid19_class.py, Keywords.py and the embedding
+# builders, which may change an entry while it is exported
+SYNC_GUARD_FIELDS = ('_bt', 'last_updated', 'is_covid19', 'is_covid19_ML', 'keywords', 'keywords_ML', 'embeddings')
+
+
+def sync_guards(docs):
+    """
+    The filters setting the synced flag of the entries as read (before doc_to_json changes them):
+    an entry updated by another stage while it was exported keeps synced: False, and is exported again.
+    """
+    return {doc['_id']: dict({'_id': doc['_id']}, **{k: doc.get(k) for k in SYNC_GUARD_FIELDS})
+            for doc in docs}
+
+
+def mark_synced(operations, guards=None):
+    """
+    Record the field hashes of the synced documents and set their synced flag, only on the entries
+    that still match their guard from sync_guards, if given
+    """
+    if not operations:
+        return
+    guards = guards or {}
+    db.entries_vespa_sync_state.bulk_write([
+        UpdateOne({'_id': _id}, {'$set': {'field_hashes': hashes}}, upsert=True)
+        for _id, operation, hashes in operations
+    ], ordered=False)
+    db.entries_vespa2.bulk_write([
+        UpdateOne(guards.get(_id, {'_id': _id}), {"$set": {"synced": True}})
+        for _id, operation, hashes in operations
+    ], ordered=False)
+
+
+def stage_operations(operations):
+    """Write the operations into entries_vespa_upload for the feeder, one document per Vespa id"""
+    requests = []
+    for _id, operation, hashes in operations:
+        if operation is None:
+            continue
+        if 'put' in operation:
+            requests.append(ReplaceOne({'put': operation['put']}, operation, upsert=True))
+            requests.append(DeleteMany({'update': operation['put']}))
+        else:
+            requests.append(ReplaceOne({'update': operation['update']}, operation, upsert=True))
+
+    if requests:
+        db.entries_vespa_upload.bulk_write(requests, ordered=False)
+
+
+def send_operations(operations):
+    """
+    Feed the operations straight to Vespa with the worker's feed client.
+
+    Returns the operations acknowledged by Vespa (and the ones with nothing to send);
+    the others stay unsynced and are retried on the next export.
+    """
+    acked = set()
+    keyed = [(i, operation) for i, (_id, operation, hashes) in enumerate(operations) if operation is not None]
+    for result in feed_client.feed(keyed):
+        if result.ok:
+            acked.add(result.key)
+    return [op for i, op in enumerate(operations) if op[1] is None or i in acked]
+
+
+def process_chunk(ids, full=False, tensor_encoding="list"):
+    """
+    Export a batch of entries: convert them into feed operations, stage them in entries_vespa_upload
+    (or send them to Vespa when the worker has a feed client) and mark them synced, with unordered bulk writes.
+
+    Returns (number of entries read, number of entries exported, number of partial updates, seconds,
+    profiling stats or None)
+    """
+    start = time.time()
+    docs = list(db.entries_vespa2.find({'_id': {'$in': ids}, 'synced': False}))
+    guards = sync_guards(docs)
+    operations = prepare_operations(docs, full, tensor_encoding)
+
+    if feed_client is not None:
+        operations = send_operations(operations)
+    else:
+        stage_operations(operations)
+    mark_synced(operations, guards)
+
+    n_updates = sum(1 for _, operation, _ in operations if operation is not None and 'update' in operation)
+    return len(docs), len(operations), n_updates, time.time() - start, profiling.collect()
+
+
+def export_entries(processes=None, batch_size=500, full=False, endpoint=None, connections=8, max_in_flight=64,
+                   tensor_encoding="list"):
+    """
+    Stream all the unsynced entries through a process pool, batch_size entries per task.
+    With full=True, every entry is sent as a full put, ignoring the fields synced before.
+    With endpoint, the entries are fed to Vespa's document/v1 API instead of entries_vespa_upload,
+    connections and max_in_flight are per process.
+    tensor_encoding must match the cell type of the embedding fields in the Vespa schema.
+    """
+    query = {'synced': False}
+    total = db.entries_vespa2.count_documents(query)
+    ids = (doc['_id'] for doc in db.entries_vespa2.find(query, {'_id': 1}))
+
+    metrics = Metrics("export")
+    profile = {}
+    start = time.time()
+    n_read = n_exported = n_updates = 0
+    with Pool(processes=processes or cpu_count(), initializer=init_worker,
+              initargs=(endpoint, connections, max_in_flight)) as pool:
+        for read, exported, updates, seconds, chunk_profile in tqdm(
+                pool.imap_unordered(partial(process_chunk, full=full, tensor_encoding=tensor_encoding), grouper(batch_size, ids)),
+                total=-(-total // batch_size), mininterval=20, maxinterval=60):
+            n_read += read
+            n_exported += exported
+            n_updates += updates
+            metrics.observe("batch_seconds", seconds, source="entries_vespa2")
+            profiling.merge(profile, chunk_profile)
+
+    elapsed = time.time() - start
+    print('Exported %d of %d entries (%d partial updates) in %.1f s (%.1f entries/s)' % (
+        n_exported, n_read, n_updates, elapsed, n_exported / elapsed if elapsed else 0))
+    metrics.count("read", n_read, source="entries_vespa2")
+    metrics.count("exported", n_exported, source="entries_vespa2")
+    metrics.count("partial_updates", n_updates, source="entries_vespa2")
+    save_run(metrics, db, target=endpoint or "entries_vespa_upload")
+    if profile:
+        print('Profile written to', profiling.dump(profile))
+    return n_read, n_exported
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--processes", help="number of export processes", type=int, default=None)
+    parser.add_argument("-b", "--batch-size", help="entries per batch, default=500", type=int, default=500)
+    parser.add_argument("--full", help="send full puts instead of partial updates", action="store_true")
+    parser.add_argument("--endpoint", help="feed Vespa directly, e.g. http://localhost:8080", default=None)
+    parser.add_argument("-c", "--connections", help="HTTP connections per process, default=8", type=int, default=8)
+    parser.add_argument("--max-in-flight", help="pending operations per process, default=64", type=int, default=64)
+    parser.add_argument("--tensor-encoding", help="encoding of the embeddings, default=list: JSON floats, "
+                        "float/bfloat16/int8: hex string of the cells", default="list", choices=ENCODINGS)
+    parser.add_argument("--profile", help="profile doc_to_json, write the reports into this directory", default=None)
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable(args.profile)
+    start_server_from_env()
+    export_entries(processes=args.processes, batch_size=args.batch_size, full=args.full, endpoint=args.endpoint,
+                   connections=args.connections, max_in_flight=args.max_in_flight,
+                   tensor_encoding=args.tensor_encoding)
@@ -1,4 +1,3 @@
-import re
 import traceback
 from datetime import datetime
 from io import BytesIO
@@ -7,48 +6,27 @@ import gridfs
 from tqdm import tqdm
 
 from pdf_extractor.paragraphs import extract_paragraphs_pdf
+from pdf_extractor.sections import segment, sections_text
 from utils import clean_title
 
 
-def try_parse_pdf_hierarchy(pdf_file):
+def try_parse_pdf_hierarchy(pdf_file, doc):
+    """
+    Extract the paragraphs of a PDF, and split them into sections with pdf_extractor.sections
+    :return: {'body': all the text, 'body_text': the paragraphs with their section_heading,
+        and the text of every known section (introduction, method, result, ...)}
+    """
     try:
-        paragraphs = extract_paragraphs_pdf(BytesIO(pdf_file.read()))
+        paragraphs = extract_paragraphs_pdf(BytesIO(pdf_file.read()), return_dicts=True)
     except Exception as e:
         print('Failed to extract PDF %s(%r) (%r)' % (doc['Doi'], doc['PDF_gridfs_id'], e))
         traceback.print_exc()
         paragraphs = []
 
-    headings = r'\n' \
-               r'(?:abstract|backgrounds?|introduction|methods?|' \
-               r'results?|discussions?|conclusions?|acknowledgements?|' \
-               r'references?)'
-    continuing_section = fr'(?:.(?!{headings}))'
-    sections = fr"""
-    (?:
-    (?:^|\n)\s*
-    (?:
-        abstract\s+(?P<abstract>{continuing_section}+)*|
-        backgrounds?\s+(?P<background>{continuing_section}+)|
-        introduction\s+(?P<introduction>{continuing_section}+)|
-        methods?\s+(?P<method>{continuing_section}+)|
-        results?\s+(?P<result>{continuing_section}+)|
-        discussions?\s+(?P<discussion>{continuing_section}+)|
-        conclusions?\s+(?P<conclusion>{continuing_section}+)|
-        acknowledgements??\s+(?P<acknowledgement>{continuing_section}+)|
-        references?\s+(?P<reference>{continuing_section}+)
-    )
-    )+
-    """
-    sections = re.compile(sections, re.VERBOSE | re.DOTALL | re.IGNORECASE)
-
-    body_text = '\n'.join(paragraphs)
-    parsed_content = {'body': body_text}
-    for match in re.finditer(sections, body_text):
-        for name, value in match.groupdict().items():
-            if value is not None:
-                parsed_content[name] = value
-
-    # print(body_text)
+    body_text = segment(paragraphs)
+    parsed_content = sections_text(body_text)
+    parsed_content['body'] = '\n'.join(p['text'] for p in body_text)
+    parsed_content['body_text'] = body_text
 
     return parsed_content
 
@@ -58,7 +36,7 @@ def convert_chemrxiv_to_vespa(doc, db):
     #     db, collection='???')
     # pdf_file = paper_fs.get(doc['PDF_gridfs_id'])
 
-    # parsed_content = try_parse_pdf_hierarchy(pdf_file)
+    # parsed_content = try_parse_pdf_hierarchy(pdf_file, doc)
     parsed_content = {}
 
     parsed_doc = {
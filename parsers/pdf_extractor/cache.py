@@ -0,0 +1,136 @@
+"""
+Content-addressed cache of PDF extraction results.
+
+A result is keyed by the MD5 of the PDF content, the version of the extraction code
+(paragraphs.EXTRACTOR_VERSION) and the extraction settings (laparams, only_printable, maxpages,
+stop_at, backend), so the same
+PDF is never run through pdfminer twice with the same settings, whichever bucket, script or parser
+asks for it. The results are stored in the pdf_extraction_cache collection:
+
+    {_id: <key>, md5, extractor_version, laparams, only_printable, maxpages, stop_at, backend, paragraphs,
+     created}
+
+The paragraphs are always cached as dicts; the plain-text paragraphs asked for with
+return_dicts=False are their texts. With stop_at, the PDF is extracted with the streaming
+paragraphs.iter_paragraphs_pdf.
+
+    cache = ExtractionCache(db)
+    paragraphs = cache.extract_gridfs('Scraper_connect_biorxiv_org_fs', file_id, laparams={'char_margin': 3.0},
+                                      return_dicts=True)
+"""
+import datetime
+import hashlib
+import json
+from io import BytesIO
+
+from gridfs.errors import NoFile
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError
+
+from pdf_extractor.gridfs_reader import open_gridfs
+from pdf_extractor.paragraphs import extract_paragraphs_pdf, iter_paragraphs_pdf, EXTRACTOR_VERSION
+
+__all__ = ['ExtractionCache', 'cache_key', 'content_md5']
+
+CACHE_COLLECTION = 'pdf_extraction_cache'
+
+
+def content_md5(data):
+    """MD5 of the PDF content, as GridFS stores it in the md5 field of the files"""
+    return hashlib.md5(data).hexdigest()
+
+
+def cache_key(md5, laparams=None, only_printable=True, maxpages=0, stop_at=None, backend='layout',
+              extractor_version=EXTRACTOR_VERSION):
+    settings = [extractor_version, laparams, only_printable, maxpages, sorted(stop_at) if stop_at else None, backend]
+    settings = json.dumps(settings, sort_keys=True)
+    return '%s:%s' % (md5, hashlib.sha1(settings.encode('utf-8')).hexdigest())
+
+
+def _as_requested(paragraphs, return_dicts):
+    if return_dicts:
+        return paragraphs
+    return [p['text'] for p in paragraphs]
+
+
+class ExtractionCache(object):
+    def __init__(self, db, collection=CACHE_COLLECTION):
+        self.db = db
+        self.collection = db[collection]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, md5, laparams=None, only_printable=True, maxpages=0, stop_at=None, backend='layout'):
+        """the cached paragraphs (dicts) of the PDF with this MD5, None if not cached"""
+        key = cache_key(md5, laparams, only_printable, maxpages, stop_at, backend)
+        doc = self.collection.find_one({'_id': key}, {'paragraphs': 1})
+        return doc['paragraphs'] if doc is not None else None
+
+    def put(self, md5, paragraphs, laparams=None, only_printable=True, maxpages=0, stop_at=None, backend='layout'):
+        try:
+            self.collection.insert_one({
+                '_id': cache_key(md5, laparams, only_printable, maxpages, stop_at, backend),
+                'md5': md5,
+                'extractor_version': EXTRACTOR_VERSION,
+                'laparams': laparams,
+                'only_printable': only_printable,
+                'maxpages': maxpages,
+                'stop_at': sorted(stop_at) if stop_at else None,
+                'backend': backend,
+                'paragraphs': paragraphs,
+                'created': datetime.datetime.now(),
+            })
+        except DuplicateKeyError:
+            # extracted concurrently by another worker, with the same result
+            pass
+        except DocumentTooLarge:
+            print('Extraction of %s too large to be cached' % md5)
+
+    def extract(self, data, laparams=None, return_dicts=False, only_printable=True, maxpages=0, stop_at=None,
+                md5=None, backend='layout'):
+        """
+        extract_paragraphs_pdf of the PDF content data (bytes), from the cache if possible.
+        Failed extractions are not cached, their exception is raised.
+        """
+        return self.extract_file(BytesIO(data), md5 or content_md5(data), laparams=laparams,
+                                 return_dicts=return_dicts, only_printable=only_printable, maxpages=maxpages,
+                                 stop_at=stop_at, backend=backend)
+
+    def extract_file(self, fp, md5, laparams=None, return_dicts=False, only_printable=True, maxpages=0,
+                     stop_at=None, backend='layout'):
+        """extract the PDF file-like object fp, whose content has this MD5, from the cache if possible"""
+        paragraphs = self.get(md5, laparams, only_printable, maxpages, stop_at, backend)
+        if paragraphs is not None:
+            self.hits += 1
+            return _as_requested(paragraphs, return_dicts)
+
+        self.misses += 1
+        if stop_at:
+            paragraphs = list(iter_paragraphs_pdf(fp, return_dicts=True, only_printable=only_printable,
+                                                  laparams=laparams, maxpages=maxpages, stop_at=stop_at,
+                                                  backend=backend))
+        else:
+            paragraphs = extract_paragraphs_pdf(fp, return_dicts=True, only_printable=only_printable,
+                                                laparams=laparams, maxpages=maxpages, backend=backend)
+        self.put(md5, paragraphs, laparams, only_printable, maxpages, stop_at, backend)
+        return _as_requested(paragraphs, return_dicts)
+
+    def extract_gridfs(self, bucket, file_id, laparams=None, return_dicts=False, only_printable=True, maxpages=0,
+                       stop_at=None, backend='layout'):
+        """
+        extract a PDF of a GridFS bucket, read chunk by chunk (gridfs_reader.open_gridfs). When GridFS
+        stored its MD5, a cached result is found without reading the file.
+        """
+        doc = self.db[bucket + '.files'].find_one({'_id': file_id})
+        if doc is None:
+            raise NoFile('no file in %s with _id %r' % (bucket, file_id))
+        if doc.get('md5') is not None:
+            paragraphs = self.get(doc['md5'], laparams, only_printable, maxpages, stop_at, backend)
+            if paragraphs is not None:
+                self.hits += 1
+                return _as_requested(paragraphs, return_dicts)
+
+        # files uploaded with MD5 disabled are hashed while read
+        with open_gridfs(self.db, bucket, file_doc=doc) as (fp, md5):
+            return self.extract_file(fp, md5, laparams=laparams, return_dicts=return_dicts,
+                                     only_printable=only_printable, maxpages=maxpages, stop_at=stop_at,
+                                     backend=backend)
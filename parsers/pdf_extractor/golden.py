@@ -0,0 +1,175 @@
+"""
+Golden outputs and benchmark of the paragraph extraction, to check that a change of paragraphs.py
+does not change what is extracted (or to bump EXTRACTOR_VERSION if it does).
+
+    # hash the paragraphs extracted from sample PDFs with every setting of SETTINGS
+    python -m pdf_extractor.golden record golden.json sample1.pdf sample2.pdf ...
+    # extract them again and compare, exits with 1 if anything changed
+    python -m pdf_extractor.golden check golden.json
+    # time every page with the reference and the optimized group_textlines, and compare their output
+    python -m pdf_extractor.golden bench sample1.pdf sample2.pdf ... [-n 3]
+"""
+import hashlib
+import json
+import sys
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from pdfminer.layout import LTLayoutContainer
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+
+from pdf_extractor import paragraphs
+from pdf_extractor.paragraphs import extract_paragraphs_pdf, TextHandler
+
+# laparams of the sources, and of the fast mode of the extraction service
+SETTINGS = {
+    'default': None,
+    'biorxiv': {'char_margin': 3.0, 'line_margin': 2.5},
+    'pho': {'char_margin': 1.0, 'line_margin': 3.0},
+    'fast': {'char_margin': 3.0, 'line_margin': 2.5, 'boxes_flow': 2.0},
+    'narrow': {'line_margin': 0.5},
+}
+
+
+def output_hash(result):
+    return hashlib.sha1(json.dumps(result, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def extract_all(path):
+    """{setting: [hash of the paragraphs (dicts), number of paragraphs]} of a PDF"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    outputs = {}
+    for name, laparams in sorted(SETTINGS.items(), key=lambda x: x[0]):
+        result = extract_paragraphs_pdf(BytesIO(data), return_dicts=True, laparams=laparams)
+        outputs[name] = [output_hash(result), len(result)]
+    return outputs
+
+
+def record(golden_path, pdfs):
+    golden = {path: extract_all(path) for path in pdfs}
+    with open(golden_path, 'w') as f:
+        json.dump(golden, f, indent=2, sort_keys=True)
+    return golden
+
+
+def check(golden_path):
+    """:return: list of (pdf, setting, expected, found) that changed"""
+    with open(golden_path) as f:
+        golden = json.load(f)
+    changed = []
+    for path, expected in sorted(golden.items()):
+        found = extract_all(path)
+        for name in sorted(expected):
+            status = 'ok' if found.get(name) == expected[name] else 'CHANGED'
+            print('%-8s %-10s %s' % (status, name, path))
+            if status != 'ok':
+                changed.append((path, name, expected[name], found.get(name)))
+    return changed
+
+
+@contextmanager
+def group_textlines(implementation):
+    """use implementation as LTLayoutContainer.group_textlines in the block"""
+    current = LTLayoutContainer.group_textlines
+    LTLayoutContainer.group_textlines = implementation
+    try:
+        yield
+    finally:
+        LTLayoutContainer.group_textlines = current
+
+
+def page_times(data, laparams=None):
+    """
+    :return: (per page (seconds of the page, seconds in group_textlines), paragraphs of the pages)
+    """
+    grouping = [0.0]
+    implementation = LTLayoutContainer.group_textlines
+
+    def timed(self, laparams, lines):
+        start = time.perf_counter()
+        boxes = list(implementation(self, laparams, lines))
+        grouping[0] += time.perf_counter() - start
+        return iter(boxes)
+
+    doc = PDFDocument(PDFParser(BytesIO(data)))
+    rsrcmgr = PDFResourceManager()
+    device = TextHandler(rsrcmgr, laparams=laparams)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    times = []
+    with group_textlines(timed):
+        for page in PDFPage.create_pages(doc):
+            grouping[0] = 0.0
+            start = time.perf_counter()
+            interpreter.process_page(page)
+            times.append((time.perf_counter() - start, grouping[0]))
+    return times, device.pages
+
+
+def bench(pdfs, laparams=None, repeat=1):
+    """
+    time the pages of the PDFs with group_textlines_reference and group_textlines
+    :return: True if both gave the same paragraphs for all the pages
+    """
+    implementations = [('reference', paragraphs.group_textlines_reference),
+                       ('optimized', paragraphs.group_textlines)]
+    same = True
+    totals = {name: [0.0, 0.0] for name, _ in implementations}
+    print('%-40s %5s %-10s %10s %12s %12s' % ('pdf', 'pages', 'version', 'page ms', 'grouping ms', 'max page ms'))
+    for path in pdfs:
+        with open(path, 'rb') as f:
+            data = f.read()
+        outputs = {}
+        for name, implementation in implementations:
+            best = None
+            with group_textlines(implementation):
+                for _ in range(repeat):
+                    times, pages = page_times(data, laparams)
+                    if best is None or sum(t for t, _ in times) < sum(t for t, _ in best):
+                        best = times
+            outputs[name] = pages
+            page_total = sum(t for t, _ in best)
+            grouping_total = sum(g for _, g in best)
+            totals[name][0] += page_total
+            totals[name][1] += grouping_total
+            print('%-40s %5d %-10s %10.1f %12.1f %12.1f' % (
+                path[-40:], len(best), name, 1000 * page_total / len(best), 1000 * grouping_total / len(best),
+                1000 * max(t for t, _ in best)))
+        if outputs['reference'] != outputs['optimized']:
+            same = False
+            print('%s: DIFFERENT OUTPUT' % path)
+    for name, (page_total, grouping_total) in totals.items():
+        print('total %-10s %8.2f s, %8.2f s in group_textlines' % (name, page_total, grouping_total))
+    return same
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    record_parser = commands.add_parser('record', help='record the golden outputs of PDFs')
+    record_parser.add_argument('golden')
+    record_parser.add_argument('pdfs', nargs='+')
+    check_parser = commands.add_parser('check', help='compare the outputs with the golden ones')
+    check_parser.add_argument('golden')
+    bench_parser = commands.add_parser('bench', help='time the reference and the optimized group_textlines')
+    bench_parser.add_argument('pdfs', nargs='+')
+    bench_parser.add_argument('-n', '--repeat', help='runs per PDF, the fastest is kept, default: 1', type=int,
+                              default=1)
+    bench_parser.add_argument('-s', '--setting', help='laparams, default: biorxiv', choices=sorted(SETTINGS),
+                              default='biorxiv')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.golden, args.pdfs)
+    elif args.command == 'check':
+        sys.exit(1 if check(args.golden) else 0)
+    elif args.command == 'bench':
+        sys.exit(0 if bench(args.pdfs, SETTINGS[args.setting], args.repeat) else 1)
+    else:
+        parser.print_help()
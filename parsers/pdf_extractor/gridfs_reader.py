@@ -0,0 +1,179 @@
+"""
+Read PDFs from GridFS without loading and copying them whole.
+
+BytesIO(fs.get(file_id).read()) holds the PDF twice in memory (the bytes read and the copy in
+the BytesIO) for as long as pdfminer parses it. Instead:
+
+    GridFSReader   a seekable file over the chunks of a GridFS file: chunks are fetched read_ahead
+                   at a time and kept in an LRU cache of cache_size chunks, so pdfminer's seeks
+                   (xref at the end, objects all over the file) do not query the chunks again
+    spool          copies a large file chunk by chunk into a temporary file and memory-maps it,
+                   its pages are then read from disk and can be evicted
+
+open_gridfs(db, bucket, file_id) picks one of them according to the size of the file.
+"""
+import hashlib
+import io
+import mmap
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from gridfs.errors import CorruptGridFile, NoFile
+
+__all__ = ['GridFSReader', 'spool', 'open_gridfs']
+
+# files larger than this are spooled to a memory-mapped temporary file
+SPOOL_THRESHOLD = 32 * 2 ** 20
+
+
+def _file_doc(db, bucket, file_id):
+    doc = db[bucket + '.files'].find_one({'_id': file_id})
+    if doc is None:
+        raise NoFile('no file in %s with _id %r' % (bucket, file_id))
+    return doc
+
+
+class GridFSReader(io.RawIOBase):
+    def __init__(self, db, bucket, file_id=None, cache_size=64, read_ahead=4, file_doc=None):
+        """
+        :param file_doc: the document of the file in <bucket>.files, instead of file_id
+        :param cache_size: chunks kept in memory
+        :param read_ahead: chunks fetched per query
+        """
+        super(GridFSReader, self).__init__()
+        doc = file_doc if file_doc is not None else _file_doc(db, bucket, file_id)
+        self.chunks = db[bucket + '.chunks']
+        self.file_id = doc['_id']
+        self.length = doc['length']
+        self.chunk_size = doc['chunkSize']
+        self.n_chunks = (self.length + self.chunk_size - 1) // self.chunk_size
+        self.read_ahead = max(1, read_ahead)
+        self.cache_size = max(cache_size, self.read_ahead)
+        self.queries = 0
+        self._cache = OrderedDict()
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError('invalid whence %r' % whence)
+        if position < 0:
+            raise ValueError('negative seek position %d' % position)
+        self._position = position
+        return position
+
+    def _chunk(self, n):
+        data = self._cache.get(n)
+        if data is not None:
+            self._cache.move_to_end(n)
+            return data
+
+        self.queries += 1
+        query = {'files_id': self.file_id, 'n': {'$gte': n, '$lt': min(n + self.read_ahead, self.n_chunks)}}
+        for chunk in self.chunks.find(query).sort('n', 1):
+            self._cache[chunk['n']] = chunk['data']
+            self._cache.move_to_end(chunk['n'])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        data = self._cache.get(n)
+        if data is None:
+            raise CorruptGridFile('no chunk #%d of file %r' % (n, self.file_id))
+        expected = self.chunk_size if n < self.n_chunks - 1 else self.length - n * self.chunk_size
+        if len(data) != expected:
+            raise CorruptGridFile('chunk #%d of file %r is %d bytes, %d expected' % (
+                n, self.file_id, len(data), expected))
+        return data
+
+    def readinto(self, b):
+        """read from a single chunk into b, as a raw file does"""
+        if self._position >= self.length:
+            return 0
+        n, offset = divmod(self._position, self.chunk_size)
+        data = self._chunk(n)
+        size = min(len(b), len(data) - offset)
+        b[:size] = memoryview(data)[offset:offset + size]
+        self._position += size
+        return size
+
+    def read(self, size=-1):
+        """read size bytes, or up to the end of the file: pdfminer expects full reads"""
+        if size is None or size < 0:
+            size = max(0, self.length - self._position)
+        parts = []
+        while size > 0 and self._position < self.length:
+            n, offset = divmod(self._position, self.chunk_size)
+            data = self._chunk(n)
+            part = data[offset:offset + size]
+            parts.append(part)
+            self._position += len(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def iter_chunks(self):
+        """the chunks of the file in order, keeping the current position"""
+        for n in range(self.n_chunks):
+            yield self._chunk(n)
+
+
+def spool(db, bucket, file_id=None, file_doc=None, dir=None):
+    """
+    copy a GridFS file into a memory-mapped temporary file
+    :return: (mmap, MD5 of the content), close the mmap when done
+    """
+    doc = file_doc if file_doc is not None else _file_doc(db, bucket, file_id)
+    reader = GridFSReader(db, bucket, file_doc=doc, cache_size=1, read_ahead=1)
+    md5 = hashlib.md5()
+    with tempfile.TemporaryFile(dir=dir) as f:
+        for data in reader.iter_chunks():
+            md5.update(data)
+            f.write(data)
+        f.flush()
+        if doc['length'] == 0:
+            return io.BytesIO(b''), md5.hexdigest()
+        # the mapping stays valid once the file is closed and deleted
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), md5.hexdigest()
+
+
+@contextmanager
+def open_gridfs(db, bucket, file_id=None, file_doc=None, spool_threshold=SPOOL_THRESHOLD):
+    """
+    open a GridFS file for pdfminer: a GridFSReader caching the whole file if it is at most
+    spool_threshold bytes, spooled to a memory-mapped temporary file otherwise
+
+        with open_gridfs(db, 'Scraper_connect_biorxiv_org_fs', file_id) as (fp, md5):
+            paragraphs = extract_paragraphs_pdf(fp)
+
+    md5 is the MD5 of the content, computed while reading it if GridFS did not store it
+    """
+    doc = file_doc if file_doc is not None else _file_doc(db, bucket, file_id)
+    if doc['length'] > spool_threshold:
+        fp, md5 = spool(db, bucket, file_doc=doc)
+    else:
+        n_chunks = (doc['length'] + doc['chunkSize'] - 1) // doc['chunkSize']
+        fp = GridFSReader(db, bucket, file_doc=doc, cache_size=max(1, n_chunks), read_ahead=16)
+        md5 = doc.get('md5')
+        if md5 is None:
+            md5 = hashlib.md5()
+            for data in fp.iter_chunks():
+                md5.update(data)
+            md5 = md5.hexdigest()
+    try:
+        yield fp, md5
+    finally:
+        fp.close()
@@ -3,9 +3,10 @@ import string
 from collections import Counter
 from io import StringIO
 
+import numpy as np
 from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams, LTContainer, LTTextBox, LTLayoutContainer, LTTextLineHorizontal, \
-    LTTextBoxHorizontal, LTTextBoxVertical
+from pdfminer.layout import LAParams, LTChar, LTContainer, LTText, LTTextBox, LTLayoutContainer, \
+    LTTextLineHorizontal, LTTextBoxHorizontal, LTTextBoxVertical
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
@@ -14,10 +15,15 @@ from pdfminer.utils import Plane, uniq
 
 import sys
 
+# Version of the extraction code, part of the key of the extraction cache (pdf_extractor/cache.py):
+# change it whenever a change here changes the paragraphs extracted from a PDF
+EXTRACTOR_VERSION = '20200503'
 
-def group_textlines(self, laparams, lines):
+
+def group_textlines_reference(self, laparams, lines):
     """Patched class method that fixes empty line aggregation, and allows
-    run-time line margin detection"""
+    run-time line margin detection.
+    Reference implementation of group_textlines, see pdf_extractor/golden.py"""
     plane = Plane(self.bbox)
     plane.extend(lines)
     boxes = {}
@@ -67,10 +73,163 @@ def group_textlines(self, laparams, lines):
     return
 
 
+class LineArrays(object):
+    """
+    Coordinates of the lines of a page as numpy arrays, and the grid cells pdfminer's Plane puts
+    them in. neighbors() gives the same lines, in the same order, as line.find_neighbors: ordered by
+    the first grid cell (row by row) where the query meets them, then by their order in lines.
+    """
+    block_size = 2 ** 20  # (query, line) pairs compared at once
+
+    def __init__(self, bbox, lines, gridsize=50):
+        self.bbox = bbox
+        self.gridsize = gridsize
+        self.x0 = np.array([line.x0 for line in lines], dtype=np.float64)
+        self.y0 = np.array([line.y0 for line in lines], dtype=np.float64)
+        self.x1 = np.array([line.x1 for line in lines], dtype=np.float64)
+        self.y1 = np.array([line.y1 for line in lines], dtype=np.float64)
+        self.height = np.array([line.height for line in lines], dtype=np.float64)
+        # lines out of the page are never found
+        self.cells = self.getrange(self.x0, self.y0, self.x1, self.y1)
+
+    def getrange(self, x0, y0, x1, y1):
+        """in_page, y start, y stop, x start, x stop of the cells of bboxes, as Plane._getrange"""
+        px0, py0, px1, py1 = self.bbox
+        in_page = ~((x1 <= px0) | (px1 <= x0) | (y1 <= py0) | (py1 <= y0))
+
+        def drange(v0, v1):
+            return (np.floor_divide(np.trunc(np.maximum(v0[0], v0[1])), self.gridsize),
+                    np.floor_divide(np.trunc(np.minimum(v1[0], v1[1]) + self.gridsize), self.gridsize))
+
+        ys = drange((py0, y0), (py1, y1))
+        xs = drange((px0, x0), (px1, x1))
+        return in_page, ys[0], ys[1], xs[0], xs[1]
+
+    def found(self, rows, ratios, candidates=None):
+        """
+        mask of the lines found by line.find_neighbors(plane, ratio) for the lines of rows, and the
+        cells of the queries, among candidates (a mask) if given
+        """
+        d = ratios * self.height[rows]
+        x0, x1, h = self.x0[rows, None], self.x1[rows, None], self.height[rows, None]
+        y0, y1, d = (self.y0[rows] - d)[:, None], (self.y1[rows] + d)[:, None], d[:, None]
+        query = self.getrange(x0, y0, x1, y1)
+        in_page, ys_start, ys_stop, xs_start, xs_stop = self.cells
+        mask = (query[0] & in_page &
+                (ys_start < query[2]) & (query[1] < ys_stop) & (xs_start < query[4]) & (query[3] < xs_stop) &
+                ~((self.x1 <= x0) | (x1 <= self.x0) | (self.y1 <= y0) | (y1 <= self.y0)) &
+                (np.abs(self.height - h) < d) &
+                ((np.abs(self.x0 - x0) < d) | (np.abs(self.x1 - x1) < d)))
+        if candidates is not None:
+            mask &= candidates
+        return mask, query
+
+    def order(self, found, query, row):
+        """the lines of a row of found, in the order of Plane.find"""
+        j = np.flatnonzero(found[row])
+        in_page, ys_start, ys_stop, xs_start, xs_stop = self.cells
+        return j[np.lexsort((j, np.maximum(xs_start[j], query[3][row, 0]),
+                             np.maximum(ys_start[j], query[1][row, 0])))].tolist()
+
+    def true_margins(self, rows, found, line_margin):
+        """the paragraph specific margins of the lines of rows, from the neighbors they found"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            margins = np.minimum(np.abs(self.y0 - self.y1[rows, None]), np.abs(self.y1 - self.y0[rows, None]))
+            margins = margins * 1.05 / self.height[rows, None]
+        others = found.copy()
+        others[np.arange(len(rows)), rows] = False
+        margins = np.where(others, margins, np.inf).min(axis=1)
+        return np.minimum(margins, line_margin)
+
+
+def _blank(line):
+    """not line.get_text().strip(), stopping at the first character that is not a space"""
+    return not any(obj.get_text().strip() for obj in line if isinstance(obj, LTText))
+
+
+def group_textlines(self, laparams, lines):
+    """Patched class method that fixes empty line aggregation, and allows
+    run-time line margin detection.
+    Same output as group_textlines_reference: the neighbors of the lines are found and their
+    paragraph specific margins computed by blocks of lines with LineArrays, and the neighbors
+    within the paragraph specific margin are selected among the ones found with line_margin."""
+    if not all(isinstance(line, LTTextLineHorizontal) for line in lines):
+        for box in group_textlines_reference(self, laparams, lines):
+            yield box
+        return
+
+    arrays = LineArrays(self.bbox, lines)
+    blank = [_blank(line) for line in lines]
+
+    # index of a line -> its neighbors within the paragraph specific margin, for the non blank lines found
+    # among their own neighbors
+    neighbors = {}
+    block = max(1, arrays.block_size // max(1, len(lines)))
+    for start in range(0, len(lines), block):
+        rows = np.arange(start, min(start + block, len(lines)))
+        found, query = arrays.found(rows, np.full(len(rows), laparams.line_margin))
+        margins = arrays.true_margins(rows, found, laparams.line_margin)
+        narrower = margins < laparams.line_margin
+        if narrower.any():
+            found[narrower], narrow_query = arrays.found(rows[narrower], margins[narrower], found[narrower])
+            for k in range(len(query)):
+                query[k][narrower] = narrow_query[k]
+        for row, i in enumerate(rows.tolist()):
+            if blank[i] or not found[row, i]:
+                continue
+            neighbors[i] = arrays.order(found, query, row)
+
+    boxes = {}
+    for i in range(len(lines)):
+        if i not in neighbors:
+            continue
+        members = []
+        for j in neighbors[i]:
+            if blank[j]:
+                continue
+            obj1 = lines[j]
+            members.append(obj1)
+            if obj1 in boxes:
+                members.extend(boxes.pop(obj1))
+        box = LTTextBoxHorizontal()
+        for obj in uniq(members):
+            box.add(obj)
+            boxes[obj] = box
+    done = set()
+    for line in lines:
+        if line not in boxes:
+            continue
+        box = boxes[line]
+        if box in done:
+            continue
+        done.add(box)
+        if not box.is_empty():
+            yield box
+    return
+
+
 # Patch the method
 LTLayoutContainer.group_textlines = group_textlines
 
 
+class _PrintableTable(dict):
+    """str.translate table deleting the characters not in string.printable, filled as they are met"""
+    printable = set(string.printable)
+
+    def __missing__(self, key):
+        value = key if chr(key) in self.printable else None
+        self[key] = value
+        return value
+
+
+_printable_table = _PrintableTable()
+
+
+def printable_text(text):
+    """text without the characters not in string.printable"""
+    return text.translate(_printable_table)
+
+
 class TextHandler(TextConverter):
     def __init__(self, rsrcmgr, laparams=None):
         _laparams = {
@@ -114,11 +273,10 @@ class TextHandler(TextConverter):
             ))
 
         # Drop number only paragraphs
-        printable = set(string.printable)
         for page in self.pages:
             new_page = []
             for item in page:
-                normalized_text = ''.join((filter(lambda k: k in printable, item['text']))).strip()
+                normalized_text = printable_text(item['text']).strip()
                 words = re.findall(r'[a-zA-Z]', item['text'])
                 if len(words) > 0.5 * len(normalized_text):
                     new_page.append(item)
@@ -132,16 +290,140 @@ class TextHandler(TextConverter):
         return self.pages
 
 
-def extract_paragraphs_pdf(pdf_file, return_dicts=False, only_printable=True, laparams=None):
+class CharHandler(TextHandler):
+    """
+    Handler of the text backend: the characters of a page are grouped into lines in the order they
+    are drawn, and the lines into paragraphs, without pdfminer's layout analysis (textboxes of
+    neighbours found in a Plane, and their hierarchical grouping), which dominates the time of
+    the layout backend. Uses char_margin, line_margin, word_margin and line_overlap of laparams;
+    the paragraphs are the same dicts as the ones of TextHandler.
+    """
+
+    def __init__(self, rsrcmgr, laparams=None):
+        super(CharHandler, self).__init__(rsrcmgr, laparams=laparams)
+        self.params = self.laparams
+        # no layout analysis by PDFLayoutAnalyzer.end_page
+        self.laparams = None
+
+    def lines(self, chars):
+        """[x0, y0, x1, y1, text] of the lines of the characters, in drawing order"""
+        params = self.params
+        lines = []
+        prev = None
+        for c in chars:
+            if prev is not None and \
+                    min(prev.height, c.height) * params.line_overlap < prev.voverlap(c) and \
+                    prev.hdistance(c) < max(prev.width, c.width) * params.char_margin:
+                line = lines[-1]
+                if c.x0 - line[2] > params.word_margin * max(c.width, c.height):
+                    line[4].append(' ')
+                line[0], line[1] = min(line[0], c.x0), min(line[1], c.y0)
+                line[2], line[3] = max(line[2], c.x1), max(line[3], c.y1)
+            else:
+                line = [c.x0, c.y0, c.x1, c.y1, []]
+                lines.append(line)
+            line[4].append(c.get_text())
+            prev = c
+        for line in lines:
+            line[4] = ''.join(line[4])
+        return [line for line in lines if line[4].strip()]
+
+    def blocks(self, lines):
+        """
+        group the lines into paragraphs as group_textlines does: the neighbours of a line are the lines
+        above and below it, less than line_margin line heights away, of about the same height and
+        aligned with it on the left or on the right; a line is grouped with its nearest neighbours
+        (within 5%, the paragraph specific margin)
+        """
+        line_margin = self.params.line_margin
+        lines = sorted(lines, key=lambda l: (-l[3], l[0]))
+        # nearest neighbour of every line above and below, (gap, index)
+        above = [None] * len(lines)
+        below = [None] * len(lines)
+        window = []
+        for i, line in enumerate(lines):
+            height = line[3] - line[1]
+            d = line_margin * height
+            still_open = []
+            for j in window:
+                last = lines[j]
+                gap = last[1] - line[3]
+                if gap > line_margin * max(height, last[3] - last[1]):
+                    continue
+                still_open.append(j)
+                if -0.5 * height < gap < d and abs(last[3] - last[1] - height) < d and \
+                        (abs(last[0] - line[0]) < d or abs(last[2] - line[2]) < d):
+                    gap = max(gap, 0.0)
+                    if above[i] is None or gap < above[i][0]:
+                        above[i] = (gap, j)
+                    if below[j] is None or gap < below[j][0]:
+                        below[j] = (gap, i)
+            still_open.append(i)
+            window = still_open
+
+        parent = list(range(len(lines)))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(lines)):
+            neighbours = [x for x in (above[i], below[i]) if x is not None]
+            if not neighbours:
+                continue
+            margin = min(gap for gap, _ in neighbours) * 1.05
+            for gap, j in neighbours:
+                if gap <= margin:
+                    parent[root(j)] = root(i)
+
+        blocks = {}
+        for i, line in enumerate(lines):
+            blocks.setdefault(root(i), []).append(line)
+        return list(blocks.values())
+
+    def receive_layout(self, ltpage):
+        paragraphs = []
+        for block in self.blocks(self.lines(item for item in ltpage if isinstance(item, LTChar))):
+            paragraphs.append({
+                'text': ''.join(line[4] + '\n' for line in block),
+                'bbox': (min(line[0] for line in block), min(line[1] for line in block),
+                         max(line[2] for line in block), max(line[3] for line in block))
+            })
+        self.pages.append(paragraphs)
+
+
+# extraction backends: the handler grouping the text of the pages into paragraphs
+#     layout  pdfminer's layout analysis, paragraphs follow the geometry of the page
+#     text    lines and paragraphs grouped from the characters directly, faster, for bulk indexing
+BACKENDS = {
+    'layout': TextHandler,
+    'text': CharHandler,
+}
+
+
+def _handler(backend, rsrcmgr, laparams):
+    if backend not in BACKENDS:
+        raise ValueError('unknown backend %r, one of %s' % (backend, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[backend](rsrcmgr, laparams=laparams)
+
+
+def extract_paragraphs_pdf(pdf_file, return_dicts=False, only_printable=True, laparams=None, maxpages=0,
+                           backend='layout'):
     """
     pdf_file is a file-like object.
-    This function will return lists of plain-text paragraphs."""
+    This function will return lists of plain-text paragraphs.
+    Only the first maxpages pages are extracted if maxpages is not 0.
+    backend is one of BACKENDS, both give the same paragraph dicts."""
+    rsrcmgr = PDFResourceManager()
+    device = _handler(backend, rsrcmgr, laparams)
     parser = PDFParser(pdf_file)
     doc = PDFDocument(parser)
-    rsrcmgr = PDFResourceManager()
-    device = TextHandler(rsrcmgr, laparams=laparams)
     interpreter = PDFPageInterpreter(rsrcmgr, device)
-    for page in PDFPage.create_pages(doc):
+    for i, page in enumerate(PDFPage.create_pages(doc)):
+        if maxpages and i >= maxpages:
+            break
         interpreter.process_page(page)
 
     def paragraph_pos_rank(p):
@@ -149,23 +431,25 @@ def extract_paragraphs_pdf(pdf_file, return_dicts=False, only_printable=True, la
         return int(y)
 
     def is_ending_char(c):
-        return re.match(r'!\.\?', c) is not None
+        return c in '.!?'
 
     paragraphs = []
 
-    printable = set(string.printable)
     for page_num, page in enumerate(device.get_true_paragraphs()):
-        for j, p in enumerate(sorted(page, key=paragraph_pos_rank)):
+        first = True
+        for p in sorted(page, key=paragraph_pos_rank):
             text = p['text']
 
             if only_printable:
-                text = ''.join(filter(lambda x: x in printable, text))
+                text = printable_text(text)
 
             text = text.strip()
+            if not text:
+                continue
 
             indention_level = int(p['bbox'][0] / 10)
 
-            if j == 0 and len(paragraphs) > 0:
+            if first and len(paragraphs) > 0:
                 last_paragraph = paragraphs[-1]
                 if return_dicts:
                     last_paragraph = last_paragraph['text']
@@ -177,6 +461,7 @@ def extract_paragraphs_pdf(pdf_file, return_dicts=False, only_printable=True, la
                     if return_dicts:
                         indention_level = paragraphs[-1]['indention_level']
                     del paragraphs[-1]
+            first = False
 
             if return_dicts:
                 paragraphs.append({
@@ -191,6 +476,119 @@ def extract_paragraphs_pdf(pdf_file, return_dicts=False, only_printable=True, la
     return paragraphs
 
 
+# Headings of the sections that end the body of a paper, for iter_paragraphs_pdf(stop_at=...)
+END_SECTIONS = ('references', 'bibliography', 'literature cited', 'acknowledgements', 'acknowledgments',
+                'supplementary material', 'supplementary materials', 'supplementary information')
+
+
+def _heading_key(text):
+    """'5. REFERENCES' -> 'references'"""
+    return ' '.join(re.sub(r'[^a-z ]', ' ', text.lower()).split())
+
+
+def iter_paragraphs_pdf(pdf_file, return_dicts=False, only_printable=True, laparams=None, maxpages=0,
+                        stop_at=None, header_pages=3, max_header_length=200, backend='layout'):
+    """
+    Streaming variant of extract_paragraphs_pdf: yields the paragraphs page by page, keeping
+    only the current page in memory.
+
+    Headers and footers are detected on the first header_pages pages (texts repeated there, as
+    get_true_paragraphs does on the whole document), and afterwards as the short texts
+    (max_header_length characters) seen before.
+    Stops after maxpages pages if maxpages is not 0, and at the first paragraph that is one of the
+    headings stop_at (e.g. END_SECTIONS), which is not yielded.
+    backend is one of BACKENDS, as for extract_paragraphs_pdf.
+    """
+    stop_at = set(_heading_key(x) for x in stop_at or ())
+    rsrcmgr = PDFResourceManager()
+    device = _handler(backend, rsrcmgr, laparams)
+    parser = PDFParser(pdf_file)
+    doc = PDFDocument(parser)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+    seen = Counter()
+    redundant = set()
+
+    def clean(page):
+        page = [x for x in page if x['text'] not in redundant]
+        new_page = []
+        for item in page:
+            normalized_text = printable_text(item['text']).strip()
+            words = re.findall(r'[a-zA-Z]', item['text'])
+            if len(words) > 0.5 * len(normalized_text):
+                item['text'] = re.sub(r'\s+', ' ', item['text'])
+                new_page.append(item)
+        return sorted(new_page, key=lambda p: int(-p['bbox'][1]))
+
+    def paragraphs(page_num, page):
+        j = 0
+        for p in clean(page):
+            text = p['text']
+            if only_printable:
+                text = printable_text(text)
+            text = text.strip()
+            if not text:
+                continue
+            yield j, {
+                'text': text,
+                'page_num': page_num,
+                'indention_level': int(p['bbox'][0] / 10),
+                'bbox': p['bbox']
+            }
+            j += 1
+
+    def pages():
+        """(page number, raw paragraphs of the page), the first pages once their headers are known"""
+        buffered = []
+        for page_num, page in enumerate(PDFPage.create_pages(doc)):
+            if maxpages and page_num >= maxpages:
+                break
+            interpreter.process_page(page)
+            page = device.pages.pop()
+            if page_num < header_pages:
+                seen.update(x['text'] for x in page)
+                buffered.append(page)
+                if page_num == header_pages - 1:
+                    redundant.update(x for x, n in seen.items() if n > 1)
+                    for i, p in enumerate(buffered):
+                        yield i, p
+                    buffered = []
+                continue
+            for x in page:
+                if len(x['text']) <= max_header_length:
+                    if x['text'] in seen:
+                        redundant.add(x['text'])
+                    seen[x['text']] += 1
+            yield page_num, page
+        # documents shorter than header_pages
+        redundant.update(x for x, n in seen.items() if n > 1)
+        for i, p in enumerate(buffered):
+            yield i, p
+
+    def result(p):
+        return p if return_dicts else p['text']
+
+    last = None
+    for page_num, page in pages():
+        for j, p in paragraphs(page_num, page):
+            if stop_at and _heading_key(p['text']) in stop_at:
+                if last is not None:
+                    yield result(last)
+                return
+            if j == 0 and last is not None:
+                should_join = (last['text'][-1] not in '.!?' and
+                               not p['text'][0].isupper())
+                if should_join:
+                    p['text'] = last['text'] + ' ' + p['text']
+                    p['indention_level'] = last['indention_level']
+                    last = None
+            if last is not None:
+                yield result(last)
+            last = p
+    if last is not None:
+        yield result(last)
+
+
 if __name__ == '__main__':
     if len(sys.argv) == 3:
         _, input_file, output_file = sys.argv
@@ -0,0 +1,136 @@
+"""
+Split the paragraphs extracted from a PDF into sections.
+
+segment() takes the paragraphs of extract_paragraphs_pdf(return_dicts=True) and returns the
+body_text of a parser, {'section_heading': ..., 'text': ...} as ExtendedParagraph, in one pass:
+a paragraph is a heading if it is short, single line (its bbox is not taller than the usual
+single-line paragraph), does not end like a sentence, and either is a known section name
+("2. Materials and Methods", "RESULTS") or is numbered ("3.1 Cell culture"). A known section name
+starting a paragraph ("Introduction The outbreak of ...", when pdfminer grouped the heading with
+its first paragraph) is split from it.
+"""
+import re
+
+__all__ = ['SECTIONS', 'canonical_section', 'is_heading', 'segment', 'sections_text']
+
+# canonical name -> headings of the section
+SECTIONS = {
+    'abstract': ['abstract', 'summary'],
+    'background': ['background', 'backgrounds'],
+    'introduction': ['introduction'],
+    'method': ['method', 'methods', 'materials and methods', 'material and methods', 'methods and materials',
+               'methodology', 'experimental', 'experimental section', 'experimental procedures',
+               'study design', 'patients and methods'],
+    'result': ['result', 'results', 'findings'],
+    'result_discussion': ['results and discussion', 'result and discussion'],
+    'discussion': ['discussion', 'discussions'],
+    'conclusion': ['conclusion', 'conclusions', 'concluding remarks'],
+    'acknowledgement': ['acknowledgement', 'acknowledgements', 'acknowledgment', 'acknowledgments'],
+    'reference': ['reference', 'references', 'bibliography', 'literature cited'],
+    'supplementary': ['supplementary material', 'supplementary materials', 'supplementary information',
+                      'supporting information'],
+}
+_CANONICAL = {heading: name for name, headings in SECTIONS.items() for heading in headings}
+_MAX_HEADING_WORDS = max(len(heading.split()) for heading in _CANONICAL)
+
+_NUMBERING = re.compile(r'(?:\d{1,2}(?:\.\d{1,2})*\.?|[IVX]{1,4}\.|[A-H]\.)\s+')
+_NON_LETTERS = re.compile(r'[^a-z]+')
+_SENTENCE_END = re.compile(r'[.,;?!]\s*$')
+
+
+def _key(text):
+    return _NON_LETTERS.sub(' ', text.lower()).strip()
+
+
+def _known(text):
+    """canonical name of a heading made of words only, None otherwise"""
+    words = text.split()
+    if not all(_key(word) for word in words):
+        return None
+    return _CANONICAL.get(_key(text))
+
+
+def _strip_numbering(text):
+    match = _NUMBERING.match(text)
+    return text[match.end():] if match else text
+
+
+def canonical_section(heading):
+    """the canonical name of a heading ('2. Materials and Methods' -> 'method'), None if unknown"""
+    if heading is None:
+        return None
+    return _known(_strip_numbering(heading))
+
+
+def _single_line_height(paragraphs):
+    """median height of the short paragraphs, which are most likely one line"""
+    heights = sorted(p['bbox'][3] - p['bbox'][1] for p in paragraphs if len(p['text']) <= 80)
+    return heights[len(heights) // 2] if heights else None
+
+
+def is_heading(paragraph, line_height=None, max_words=12):
+    """:return: the heading text without its numbering, or None if the paragraph is not a heading"""
+    text = paragraph['text'].strip().rstrip(':').rstrip()
+    words = text.split()
+    if not words or len(words) > max_words or _SENTENCE_END.search(text):
+        return None
+    if line_height is not None and 'bbox' in paragraph and \
+            paragraph['bbox'][3] - paragraph['bbox'][1] > 1.8 * line_height:
+        return None
+    heading = _strip_numbering(text)
+    if not heading or not heading[0].isupper():
+        return None
+    if _known(heading) is not None:
+        return heading
+    if heading != text and not heading[-1].isdigit():
+        # numbered, "2.1 Viral RNA extraction"
+        return heading
+    return None
+
+
+def _split_heading(text):
+    """('Introduction', 'The outbreak ...') for 'Introduction The outbreak ...', None if not headed"""
+    body = _strip_numbering(text)
+    words = body.split(None, _MAX_HEADING_WORDS)
+    for n in range(min(_MAX_HEADING_WORDS, len(words) - 1), 0, -1):
+        following = words[n][:1]
+        if words[0][:1].isupper() and (following.isupper() or following.isdigit()) and \
+                _known(' '.join(words[:n])) is not None:
+            return ' '.join(words[:n]), body.split(None, n)[n]
+    return None
+
+
+def segment(paragraphs):
+    """
+    :param paragraphs: dicts of extract_paragraphs_pdf(return_dicts=True), or plain strings
+    :return: list of {'section_heading': heading or None, 'text': text}
+    """
+    paragraphs = [p if isinstance(p, dict) else {'text': p} for p in paragraphs]
+    with_bbox = [p for p in paragraphs if 'bbox' in p]
+    line_height = _single_line_height(with_bbox) if with_bbox else None
+
+    body_text = []
+    heading = None
+    for p in paragraphs:
+        text = p['text'].strip()
+        if not text:
+            continue
+        found = is_heading(p, line_height)
+        if found is not None:
+            heading = found
+            continue
+        split = _split_heading(text)
+        if split is not None:
+            heading, text = split
+        body_text.append({'section_heading': heading, 'text': text})
+    return body_text
+
+
+def sections_text(body_text):
+    """canonical section name -> text of the paragraphs of the sections with that name"""
+    sections = {}
+    for p in body_text:
+        name = canonical_section(p['section_heading'])
+        if name is not None:
+            sections.setdefault(name, []).append(p['text'])
+    return {name: '\n'.join(texts) for name, texts in sections.items()}
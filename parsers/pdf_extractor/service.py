@@ -0,0 +1,379 @@
+"""
+PDF extraction service: extracts the paragraphs of the PDFs stored in the GridFS buckets of
+the scrapers, and stores them on the file documents (pdf_extraction_plist and friends).
+
+Every source is registered in SOURCES with its bucket, its pdfminer laparams and the version
+of its extraction settings. A single worker pool serves all the sources; the pending PDFs
+of the sources are interleaved round-robin, so a large backlog in one bucket does not starve
+the others.
+
+The pool (workers.GuardedPool) stops the extraction of a PDF that takes more than `timeout`
+seconds or more than `max_memory` MB, and recycles its worker. The failure is recorded on the file
+(pdf_extraction_failure: 'timeout', 'memory' or 'crash'), and the PDF is extracted again after
+`retry_delay` seconds in the next cheaper of MODES:
+    full         the laparams of the source
+    fast         no hierarchical grouping of the text boxes (boxes_flow outside [-1, 1]), which is
+                 quadratic in the number of boxes of a page
+    first_pages  fast, streamed (paragraphs.iter_paragraphs_pdf), on the first FIRST_PAGES pages
+                 and up to the references (paragraphs.END_SECTIONS)
+A source can also be extracted streamed and up to given sections in every mode with stop_at, and
+with the text backend of paragraphs.BACKENDS instead of the layout analysis of pdfminer (faster,
+for the sources indexed in bulk that do not need the geometry of the paragraphs).
+
+Parsers that read the extracted paragraphs instead of running pdfminer (BiorxivParser) queue the
+files not extracted yet with pdf_extraction_requested: the requested files of a source are
+extracted first, and once done, the last_updated of the scraped documents referencing them
+(Source.documents) is touched so that they are parsed again, with their full text.
+
+The laparams, backends and versions of SOURCES can be overridden per source in the
+pdf_extraction_sources collection (REGISTRY_COLLECTION), where pdf_extractor.tune_laparams stores
+the best settings it found; ExtractionService loads them with load_registry.
+
+Library API:
+
+    service = ExtractionService(processes=32)
+    service.run()                      # drain every source
+    service.run(['biorxiv'], limit=10)
+    service.extract('pho', file_id)    # one PDF, in this process
+
+CLI:
+
+    python -m pdf_extractor.service [-s biorxiv -s pho] [-p 32] [--limit N]
+"""
+import datetime
+import itertools
+import multiprocessing
+import os
+import traceback
+
+from pymongo import MongoClient
+from tqdm import tqdm
+
+from pdf_extractor.cache import ExtractionCache
+from pdf_extractor.paragraphs import END_SECTIONS
+from pdf_extractor.workers import GuardedPool
+
+__all__ = ['Source', 'SOURCES', 'MODES', 'ExtractionService', 'extract_file', 'load_registry']
+
+MODES = ['full', 'fast', 'first_pages']
+FIRST_PAGES = 20
+REGISTRY_COLLECTION = 'pdf_extraction_sources'
+
+
+class Source(object):
+    """A GridFS bucket of PDFs and the settings its PDFs are extracted with"""
+
+    def __init__(self, name, bucket, version, laparams=None, stop_at=None, documents=None,
+                 file_field='PDF_gridfs_id', backend='layout'):
+        """
+        :param stop_at: headings of the sections the extraction stops at, e.g. END_SECTIONS; the
+            version must be changed with it
+        :param backend: one of paragraphs.BACKENDS, the version must be changed with it
+        :param documents: collection of the scraped documents whose file_field references the files,
+            touched when a requested file is extracted
+        """
+        self.name = name
+        self.bucket = bucket
+        self.version = version
+        self.laparams = laparams or {}
+        self.stop_at = stop_at
+        self.documents = documents
+        self.file_field = file_field
+        self.backend = backend
+
+    def override(self, version, laparams, backend=None):
+        """a copy of the source extracted with other laparams, or another backend"""
+        return Source(self.name, self.bucket, version, laparams, stop_at=self.stop_at,
+                      documents=self.documents, file_field=self.file_field, backend=backend or self.backend)
+
+    @property
+    def files_collection(self):
+        return self.bucket + '.files'
+
+    def settings(self, mode='full'):
+        """extraction arguments of a mode, for ExtractionCache.extract"""
+        if mode == 'full':
+            return {'laparams': self.laparams, 'stop_at': self.stop_at, 'backend': self.backend}
+        settings = {'laparams': dict(self.laparams, boxes_flow=2.0), 'stop_at': self.stop_at,
+                    'backend': self.backend}
+        if mode == 'first_pages':
+            settings.update(maxpages=FIRST_PAGES, stop_at=self.stop_at or END_SECTIONS)
+        return settings
+
+    def __repr__(self):
+        return 'Source(%r, bucket=%r, version=%r, laparams=%r, backend=%r)' % (
+            self.name, self.bucket, self.version, self.laparams, self.backend)
+
+
+SOURCES = {
+    'biorxiv': Source(
+        'biorxiv', 'Scraper_connect_biorxiv_org_fs', 'biorxiv_20200421',
+        {'char_margin': 3.0, 'line_margin': 2.5}, documents='Scraper_connect_biorxiv_org'),
+    'chemrxiv': Source(
+        'chemrxiv', 'Scraper_chemrxiv_org_fs', 'chemrxiv_20200421',
+        {'char_margin': 3.0, 'line_margin': 2.5}, documents='Scraper_chemrxiv_org'),
+    'pho': Source(
+        'pho', 'Scraper_publichealthontario_fs', 'pho_20200423',
+        {'char_margin': 1.0, 'line_margin': 3.0}),
+}
+
+
+def get_db():
+    client = MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
+                         password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
+    return client[os.getenv("COVID_DB")]
+
+
+def load_registry(db, sources=None):
+    """
+    The sources (default: SOURCES) with the laparams, backends and versions stored in
+    REGISTRY_COLLECTION, {'_id': source name, 'version': ..., 'laparams': {...}, 'backend': ...},
+    for the sources that have one.
+    """
+    sources = dict(sources or SOURCES)
+    for doc in db[REGISTRY_COLLECTION].find({'_id': {'$in': list(sources)}}):
+        sources[doc['_id']] = sources[doc['_id']].override(doc['version'], doc['laparams'], doc.get('backend'))
+    return sources
+
+
+def pending_query(source):
+    """Files requested, never extracted, uploaded again since, extracted with other settings, or due for a retry"""
+    return {
+        '$or': [
+            {'pdf_extraction_requested': True},
+            {'$expr': {'$lt': ['$parsed_date', '$uploadDate']}},
+            {'pdf_extraction_version': {'$ne': source.version}},
+            {'pdf_extraction_retry_date': {'$lte': datetime.datetime.now()}},
+        ]
+    }
+
+
+def is_extracted(doc, source):
+    retry_date = doc.get('pdf_extraction_retry_date')
+    return not doc.get('pdf_extraction_requested') and \
+        doc.get('pdf_extraction_version') == source.version and \
+        'parsed_date' in doc and \
+        doc['parsed_date'] > doc['uploadDate'] and \
+        (retry_date is None or retry_date > datetime.datetime.now())
+
+
+def extraction_mode(doc, source):
+    """the mode to extract a file in: full, unless it was stopped in the current version"""
+    if doc.get('pdf_extraction_version') == source.version and doc.get('pdf_extraction_next_mode'):
+        return doc['pdf_extraction_next_mode']
+    return 'full'
+
+
+def extract_file(db, source, file_id):
+    """
+    Extract one PDF of source, or take its paragraphs from the extraction cache, and store them on
+    its file document.
+
+    :return: (paragraphs, exception message), (None, None) if it was already extracted
+    """
+    collection = db[source.files_collection]
+
+    # check again, another run may have done it
+    doc = collection.find_one({'_id': file_id})
+    if doc is None or is_extracted(doc, source):
+        return None, None
+
+    mode = extraction_mode(doc, source)
+    try:
+        paragraphs = ExtractionCache(db).extract_gridfs(source.bucket, file_id, return_dicts=True,
+                                                        **source.settings(mode))
+        exc = None
+    except Exception as e:
+        paragraphs = None
+        exc = f'Failed to extract PDF {doc.get("filename")} {e}' + traceback.format_exc()
+
+    collection.update_one(
+        {'_id': file_id},
+        {'$set': {
+            'pdf_extraction_success': exc is None,
+            'pdf_extraction_plist': paragraphs,
+            'pdf_extraction_exec': exc,
+            'pdf_extraction_version': source.version,
+            'pdf_extraction_mode': mode,
+            'pdf_extraction_failure': None if exc is None else 'error',
+            'pdf_extraction_next_mode': None,
+            'pdf_extraction_retry_date': None,
+            'pdf_extraction_requested': False,
+            'parsed_date': datetime.datetime.now(),
+        }})
+    if exc is None and doc.get('pdf_extraction_requested') and source.documents:
+        # parse again the documents that were waiting for the paragraphs
+        db[source.documents].update_many({source.file_field: file_id},
+                                         {'$set': {'last_updated': datetime.datetime.now()}})
+    return paragraphs, exc
+
+
+def record_stopped(db, source, file_id, reason, retry_delay):
+    """
+    Record that the extraction of a file was stopped (reason: timeout, memory or crash), and schedule
+    its retry in the next cheaper mode, if any.
+    """
+    collection = db[source.files_collection]
+    doc = collection.find_one({'_id': file_id})
+    if doc is None:
+        return None
+    mode = extraction_mode(doc, source)
+    cheaper = MODES[MODES.index(mode) + 1:]
+    now = datetime.datetime.now()
+    collection.update_one(
+        {'_id': file_id},
+        {'$set': {
+            'pdf_extraction_success': False,
+            'pdf_extraction_plist': None,
+            'pdf_extraction_exec': 'Extraction of PDF %s stopped (%s) in %s mode' % (
+                doc.get('filename'), reason, mode),
+            'pdf_extraction_version': source.version,
+            'pdf_extraction_mode': mode,
+            'pdf_extraction_failure': reason,
+            'pdf_extraction_next_mode': cheaper[0] if cheaper else None,
+            'pdf_extraction_retry_date': now + datetime.timedelta(seconds=retry_delay) if cheaper else None,
+            'pdf_extraction_requested': False,
+            'parsed_date': now,
+        }})
+    return cheaper[0] if cheaper else None
+
+
+_worker_db = None
+_worker_sources = None
+
+
+def _init_worker(sources):
+    """Connect in the worker, after forking"""
+    global _worker_db, _worker_sources
+    _worker_db = get_db()
+    _worker_sources = sources
+
+
+def _handle(task):
+    source_name, file_id = task
+    paragraphs, exc = extract_file(_worker_db, _worker_sources[source_name], file_id)
+    if exc is not None:
+        print(exc)
+    return source_name, paragraphs is not None, exc is not None
+
+
+def _round_robin(iterables):
+    """Interleave the iterables, one item of each in turn"""
+    iterators = [iter(it) for it in iterables]
+    while iterators:
+        alive = []
+        for it in iterators:
+            try:
+                yield next(it)
+            except StopIteration:
+                continue
+            alive.append(it)
+        iterators = alive
+
+
+class ExtractionService(object):
+    def __init__(self, db=None, sources=None, processes=None, timeout=600, max_memory=4096,
+                 retry_delay=6 * 3600):
+        """
+        :param timeout: seconds a PDF can take, None for no limit
+        :param max_memory: MB of resident memory a worker can use, None for no limit
+        :param retry_delay: seconds before a stopped PDF is extracted again in a cheaper mode
+        """
+        self.db = db if db is not None else get_db()
+        self.sources = dict(sources or load_registry(self.db))
+        self.processes = processes or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.retry_delay = retry_delay
+
+    def pending(self, source_name, limit=None):
+        """_id of the files of a source waiting for extraction, the requested ones first"""
+        source = self.sources[source_name]
+        collection = self.db[source.files_collection]
+        requested = [doc['_id'] for doc in collection.find({'pdf_extraction_requested': True}, {'_id': 1})]
+        cursor = collection.find(pending_query(source), {'_id': 1})
+        seen = set(requested)
+        file_ids = itertools.chain(requested, (doc['_id'] for doc in cursor if doc['_id'] not in seen))
+        return itertools.islice(file_ids, limit) if limit else file_ids
+
+    def count_pending(self, source_name):
+        source = self.sources[source_name]
+        return self.db[source.files_collection].count_documents(pending_query(source))
+
+    def tasks(self, source_names, limit=None):
+        """(source name, file _id) of the pending files, alternating between the sources"""
+        def source_tasks(name):
+            for file_id in self.pending(name, limit):
+                yield name, file_id
+
+        return _round_robin([source_tasks(name) for name in source_names])
+
+    def extract(self, source_name, file_id):
+        """Extract a single PDF in this process, without time or memory limit"""
+        return extract_file(self.db, self.sources[source_name], file_id)
+
+    def run(self, source_names=None, limit=None):
+        """
+        Extract the pending PDFs of the sources (default: all of them) with one worker pool.
+
+        :param limit: maximum number of PDFs per source
+        :return: dict of source name -> {'extracted': n, 'failed': n, and the number of PDFs stopped
+            per reason}
+        """
+        source_names = list(source_names or self.sources)
+        for name in source_names:
+            collection = self.db[self.sources[name].files_collection]
+            collection.create_index('parsed_date')
+            collection.create_index('uploadDate')
+            collection.create_index('pdf_extraction_requested')
+
+        total = sum(self.count_pending(name) for name in source_names)
+        if limit:
+            total = min(total, limit * len(source_names))
+        stats = {name: {'extracted': 0, 'failed': 0} for name in source_names}
+
+        pool = GuardedPool(_handle, processes=self.processes, initializer=_init_worker,
+                           initargs=(self.sources,), timeout=self.timeout,
+                           max_rss=self.max_memory * 2 ** 20 if self.max_memory else None)
+        for task, result, reason in tqdm(pool.imap_unordered(self.tasks(source_names, limit)), total=total):
+            source_name, file_id = task
+            if reason is None:
+                _, extracted, failed = result
+                stats[source_name]['extracted'] += extracted and not failed
+                stats[source_name]['failed'] += failed
+            elif reason == 'error':
+                print(result)
+                stats[source_name]['failed'] += 1
+            else:
+                next_mode = record_stopped(self.db, self.sources[source_name], file_id, reason, self.retry_delay)
+                print('Stopped extraction of %s %r (%s), retry in mode %s' % (source_name, file_id, reason, next_mode))
+                stats[source_name][reason] = stats[source_name].get(reason, 0) + 1
+
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--source', help='source to extract, can be repeated, default: all',
+                        action='append', choices=sorted(SOURCES))
+    parser.add_argument('-p', '--processes', help='number of worker processes, default: cpu count',
+                        type=int, default=None)
+    parser.add_argument('--limit', help='maximum number of PDFs per source', type=int, default=None)
+    parser.add_argument('--timeout', help='seconds a PDF can take, default: 600', type=int, default=600)
+    parser.add_argument('--max-memory', help='MB of memory a worker can use, default: 4096', type=int,
+                        default=4096)
+    parser.add_argument('--retry-delay', help='hours before a stopped PDF is retried in a cheaper mode, '
+                                              'default: 6', type=float, default=6)
+    parser.add_argument('--list', help='list the sources and their pending PDFs', action='store_true')
+    args = parser.parse_args()
+
+    service = ExtractionService(processes=args.processes, timeout=args.timeout, max_memory=args.max_memory,
+                                retry_delay=args.retry_delay * 3600)
+    if args.list:
+        for name in args.source or sorted(service.sources):
+            print(service.sources[name], service.count_pending(name), 'pending')
+    else:
+        for name, counts in service.run(args.source, limit=args.limit).items():
+            print(name, counts)
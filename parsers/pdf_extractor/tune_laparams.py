@@ -0,0 +1,184 @@
+"""
+Tune the laparams of the PDF sources: extract a random sample of the PDFs of a source with every
+combination of GRID, and rank the combinations by the quality of the paragraphs and their cost.
+
+Quality heuristics of the paragraphs of a PDF (quality(), 1 is best):
+    sentences   fraction of the paragraphs that end like a sentence; too small a line_margin
+                cuts paragraphs in the middle of sentences, too large a char_margin joins them
+                with the figure labels and footers
+    fragments   fraction of paragraphs of less than 5 words (broken lines, labels)
+    merged      fraction of paragraphs of more than 400 words (columns or sections run together)
+    sections    known section headings found by sections.segment, up to 5
+score = sentences - fragments - merged + 0.2 * sections / 5, averaged over the sample. The best
+setting is the fastest of the ones scoring within tolerance of the highest score.
+
+    # print the grid of a sample of 20 biorxiv PDFs
+    python -m pdf_extractor.tune_laparams -s biorxiv -n 20
+    # and store the best laparams in the registry of the extraction service
+    python -m pdf_extractor.tune_laparams -s biorxiv -n 20 --store
+    # tune the text backend (paragraphs.BACKENDS) of pho, and make it the backend of the source
+    python -m pdf_extractor.tune_laparams -s pho --backend text --store
+
+Storing settings (laparams or backend) that differ from the current ones gives the source a new
+version, so that the extraction service extracts its PDFs again.
+"""
+import datetime
+import itertools
+import re
+import time
+from io import BytesIO
+
+from pdf_extractor.gridfs_reader import open_gridfs
+from pdf_extractor.paragraphs import BACKENDS, extract_paragraphs_pdf
+from pdf_extractor.sections import canonical_section, segment
+from pdf_extractor.service import REGISTRY_COLLECTION, SOURCES, get_db, load_registry
+
+__all__ = ['GRID', 'grid', 'quality', 'sample', 'tune', 'best', 'store']
+
+GRID = {
+    'char_margin': [1.0, 2.0, 3.0],
+    'line_margin': [0.5, 1.5, 2.5, 3.0],
+}
+
+_SENTENCE_END = re.compile(r'[.?!:]["\')\]]*$')
+
+
+def grid(params=None):
+    """the laparams of every combination of params (default: GRID)"""
+    params = params or GRID
+    names = sorted(params)
+    return [dict(zip(names, values)) for values in itertools.product(*(params[name] for name in names))]
+
+
+def quality(paragraphs):
+    """quality heuristics of extracted paragraphs (dicts or strings), see the module docstring"""
+    texts = [p['text'] if isinstance(p, dict) else p for p in paragraphs]
+    texts = [text.strip() for text in texts if text.strip()]
+    if not texts:
+        return {'paragraphs': 0, 'sentences': 0.0, 'fragments': 0.0, 'merged': 0.0, 'sections': 0, 'score': -1.0}
+    words = [len(text.split()) for text in texts]
+    sentences = sum(1 for text in texts if _SENTENCE_END.search(text)) / len(texts)
+    fragments = sum(1 for n in words if n < 5) / len(texts)
+    merged = sum(1 for n in words if n > 400) / len(texts)
+    headings = set(canonical_section(p['section_heading']) for p in segment(paragraphs))
+    sections = len(headings - {None})
+    return {
+        'paragraphs': len(texts),
+        'sentences': sentences,
+        'fragments': fragments,
+        'merged': merged,
+        'sections': sections,
+        'score': sentences - fragments - merged + 0.2 * min(sections, 5) / 5,
+    }
+
+
+def sample(db, source, size=20):
+    """(file _id, content) of a random sample of the PDFs of a source"""
+    collection = db[source.files_collection]
+    for doc in collection.aggregate([{'$sample': {'size': size}}]):
+        with open_gridfs(db, source.bucket, file_doc=doc) as (fp, _):
+            yield doc['_id'], fp.read()
+
+
+def tune(pdfs, params=None, maxpages=0, backend='layout'):
+    """
+    extract every PDF with every setting of the grid
+
+    :param pdfs: (name, content) of the PDFs
+    :return: list of {'laparams', 'backend', 'time' (mean seconds per PDF), the mean quality heuristics,
+        'failed' (PDFs that could not be extracted)}, in the order of the grid
+    """
+    settings = grid(params)
+    totals = [{'time': 0.0, 'failed': 0, 'paragraphs': 0, 'sentences': 0.0, 'fragments': 0.0, 'merged': 0.0,
+               'sections': 0, 'score': 0.0} for _ in settings]
+    n = 0
+    for name, data in pdfs:
+        n += 1
+        for laparams, total in zip(settings, totals):
+            start = time.perf_counter()
+            try:
+                paragraphs = extract_paragraphs_pdf(BytesIO(data), return_dicts=True, laparams=laparams,
+                                                    maxpages=maxpages, backend=backend)
+            except Exception as e:
+                print('Failed to extract PDF %r with %r (%r)' % (name, laparams, e))
+                total['failed'] += 1
+                paragraphs = []
+            total['time'] += time.perf_counter() - start
+            for key, value in quality(paragraphs).items():
+                total[key] += value
+
+    results = []
+    for laparams, total in zip(settings, totals):
+        result = {key: value / n if n else value for key, value in total.items() if key != 'failed'}
+        result.update(laparams=laparams, backend=backend, failed=total['failed'])
+        results.append(result)
+    return results
+
+
+def best(results, tolerance=0.02):
+    """the fastest result scoring within tolerance of the highest score"""
+    top = max(result['score'] for result in results)
+    return min((result for result in results if result['score'] >= top - tolerance), key=lambda r: r['time'])
+
+
+def store(db, source, result, results=None, sample_size=None):
+    """
+    store the laparams and backend of result in the registry of the extraction service, with a new
+    version if they differ from the current ones of the source
+    :return: the version of the source
+    """
+    laparams = result['laparams']
+    backend = result.get('backend', 'layout')
+    current = load_registry(db, {source.name: source})[source.name]
+    version = current.version
+    if current.laparams != laparams or current.backend != backend:
+        version = '%s_%s' % (source.name, datetime.datetime.now().strftime('%Y%m%d%H%M'))
+    db[REGISTRY_COLLECTION].replace_one({'_id': source.name}, {
+        '_id': source.name,
+        'version': version,
+        'laparams': laparams,
+        'backend': backend,
+        'tuned_date': datetime.datetime.now(),
+        'sample_size': sample_size,
+        'results': results,
+    }, upsert=True)
+    return version
+
+
+def print_results(results, chosen=None):
+    print('%-40s %8s %10s %9s %9s %9s %8s %7s %6s' % (
+        'laparams', 'time s', 'paragraphs', 'sentences', 'fragments', 'merged', 'sections', 'score', 'failed'))
+    for result in sorted(results, key=lambda r: -r['score']):
+        laparams = ', '.join('%s=%s' % item for item in sorted(result['laparams'].items()))
+        print('%-40s %8.2f %10.1f %9.3f %9.3f %9.3f %8.1f %7.3f %6d%s' % (
+            laparams, result['time'], result['paragraphs'], result['sentences'], result['fragments'],
+            result['merged'], result['sections'], result['score'], result['failed'],
+            ' *' if result is chosen else ''))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--source', help='source to tune, can be repeated, default: all',
+                        action='append', choices=sorted(SOURCES))
+    parser.add_argument('-n', '--sample', help='PDFs sampled per source, default: 20', type=int, default=20)
+    parser.add_argument('--backend', help='backend to tune, default: layout', choices=sorted(BACKENDS),
+                        default='layout')
+    parser.add_argument('--maxpages', help='pages extracted per PDF, default: all', type=int, default=0)
+    parser.add_argument('--tolerance', help='score below the best one a faster setting can have, default: 0.02',
+                        type=float, default=0.02)
+    parser.add_argument('--store', help='store the best laparams in the registry', action='store_true')
+    args = parser.parse_args()
+
+    db = get_db()
+    sources = load_registry(db)
+    for name in args.source or sorted(sources):
+        source = sources[name]
+        print(source)
+        results = tune(sample(db, source, args.sample), maxpages=args.maxpages, backend=args.backend)
+        chosen = best(results, args.tolerance)
+        print_results(results, chosen)
+        if args.store:
+            print('%s: stored %r, version %s' % (
+                name, chosen['laparams'], store(db, source, chosen, results, args.sample)))
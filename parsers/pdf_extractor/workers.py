@@ -0,0 +1,178 @@
+"""
+Worker pool that guards every task with a wall-clock and a memory limit.
+
+multiprocessing.Pool cannot stop a task: a PDF that spins in PDFPageInterpreter.process_page
+holds its worker for as long as it spins, and a worker killed by the OOM killer loses its task
+and hangs imap_unordered. GuardedPool hands one task at a time to each worker through a pipe,
+and the parent watches them: a worker over the time limit (timeout, seconds) or over the memory
+limit (max_rss, bytes of resident memory) is killed and replaced by a new one, and its task is
+reported with the reason instead of a result. A task is only blamed for memory when the worker grew
+past the limit while running it: a worker left over the limit by a finished task is replaced before
+it takes the next one.
+
+    pool = GuardedPool(func, processes=8, timeout=300, max_rss=4 * 2 ** 30)
+    for task, result, reason in pool.imap_unordered(tasks):
+        ...
+
+reason is None when func returned result, 'error' when it raised (result is then the traceback),
+'timeout', 'memory' or 'crash' (the worker died) when the task was stopped.
+"""
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+
+__all__ = ['GuardedPool', 'rss']
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss(pid):
+    """resident memory of the process in bytes, None if it cannot be read (no /proc)"""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _worker_main(conn, func, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            message = (True, func(task))
+        except Exception:
+            message = (False, traceback.format_exc())
+        conn.send(message)
+    conn.close()
+
+
+class _Worker(object):
+    def __init__(self, func, initializer, initargs):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(child_conn, func, initializer, initargs))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+        self.baseline = None
+
+    def submit(self, task):
+        self.task = task
+        self.started = time.time()
+        self.baseline = rss(self.process.pid)
+        self.conn.send(task)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            os.kill(self.process.pid, 9)
+            self.process.join()
+        self.conn.close()
+
+
+class GuardedPool(object):
+    def __init__(self, func, processes=None, initializer=None, initargs=(), timeout=None, max_rss=None,
+                 poll_interval=1.0):
+        self.func = func
+        self.processes = processes or multiprocessing.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.poll_interval = poll_interval
+        self.recycled = 0
+
+    def _new_worker(self):
+        return _Worker(self.func, self.initializer, self.initargs)
+
+    def _over_limit(self, worker, now):
+        if self.timeout and now - worker.started > self.timeout:
+            return 'timeout'
+        if self.max_rss:
+            memory = rss(worker.process.pid)
+            if memory is not None and memory > self.max_rss and memory > (worker.baseline or 0):
+                return 'memory'
+        return None
+
+    def _bloated(self, worker):
+        """whether the idle worker is over the memory limit and has to be replaced"""
+        if not self.max_rss:
+            return False
+        memory = rss(worker.process.pid)
+        return memory is not None and memory > self.max_rss
+
+    def imap_unordered(self, tasks):
+        """
+        run func on every task, yielding (task, result, reason) as the tasks finish
+        """
+        tasks = iter(tasks)
+        idle = [self._new_worker() for _ in range(self.processes)]
+        busy = {}  # conn -> worker
+        exhausted = False
+        try:
+            while True:
+                while idle and not exhausted:
+                    try:
+                        task = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    worker = idle.pop()
+                    worker.submit(task)
+                    busy[worker.conn] = worker
+                if not busy:
+                    break
+
+                for conn in wait(list(busy), timeout=self.poll_interval):
+                    worker = busy.pop(conn)
+                    try:
+                        ok, value = conn.recv()
+                    except (EOFError, OSError):
+                        worker.kill()
+                        self.recycled += 1
+                        idle.append(self._new_worker())
+                        yield worker.task, None, 'crash'
+                        continue
+                    task = worker.task
+                    if self._bloated(worker):
+                        worker.kill()
+                        self.recycled += 1
+                        worker = self._new_worker()
+                    idle.append(worker)
+                    yield (task, value, None) if ok else (task, value, 'error')
+
+                now = time.time()
+                for conn, worker in list(busy.items()):
+                    reason = self._over_limit(worker, now)
+                    if reason is not None:
+                        del busy[conn]
+                        worker.kill()
+                        self.recycled += 1
+                        idle.append(self._new_worker())
+                        yield worker.task, None, reason
+        finally:
+            for worker in idle:
+                worker.stop()
+            for worker in busy.values():
+                worker.kill()
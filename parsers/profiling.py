@@ -0,0 +1,182 @@
+"""
+Opt-in profiling of the parsers, the entries builder and the Vespa export.
+
+Profiling is enabled by setting PIPELINE_PROFILE to the directory the reports are written to
+(run_all_parsers_vespa.py --profile DIR and mongo_to_feed_mongo.py --profile DIR set it).
+install() then wraps, in the current process:
+    Parser.parse, _preprocess, _postprocess and every _parse_<field> method of every parser
+    entries.merge_documents and entries.find_matching_doc
+    mongo_to_feed_mongo.doc_to_json
+with a deterministic timer that records calls, cumulative and self time per function, and the
+self time of every call stack. Worker processes return collect() with their results and the
+parent merges them (merge), then dump() writes:
+    profile_report.txt   functions sorted by cumulative time
+    profile_stacks.txt   collapsed stacks ("a;b;c <microseconds>"), for flamegraph.pl or speedscope
+    profile.json         the raw merged stats
+"""
+import os
+import sys
+import json
+import time
+import threading
+import functools
+
+ENV = "PIPELINE_PROFILE"
+
+_lock = threading.Lock()
+_local = threading.local()
+_functions = {}  # name -> [calls, cumulative seconds, self seconds]
+_stacks = {}  # "a;b;c" -> self seconds
+_installed = False
+
+
+def enabled():
+    return bool(os.getenv(ENV))
+
+
+def enable(directory):
+    """enable profiling in this process and in the processes it starts"""
+    os.makedirs(directory, exist_ok=True)
+    os.environ[ENV] = directory
+
+
+def profiled(name, func):
+    """wrap func so that its calls are recorded under name"""
+    if getattr(func, "__profiled__", False):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        # each frame is [name, seconds spent in profiled children]
+        stack.append([name, 0.0])
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _, children = stack.pop()
+            path = ";".join(frame[0] for frame in stack + [[name]])
+            recursive = any(frame[0] == name for frame in stack)
+            with _lock:
+                stats = _functions.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                if not recursive:  # the outermost call already counts the time of the inner ones
+                    stats[1] += elapsed
+                stats[2] += elapsed - children
+                _stacks[path] = _stacks.get(path, 0.0) + elapsed - children
+            if stack:
+                stack[-1][1] += elapsed
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+def _subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for s in _subclasses(subclass):
+            yield s
+
+
+def _wrap_parsers():
+    from base import Parser
+
+    for cls in [Parser] + list(_subclasses(Parser)):
+        for attr, value in list(vars(cls).items()):
+            if callable(value) and (attr.startswith("_parse_") or attr in ("parse", "_preprocess", "_postprocess")):
+                setattr(cls, attr, profiled("%s.%s" % (cls.__name__, attr), value))
+
+
+def _wrap_module(module_name, function_names):
+    module = sys.modules.get(module_name)
+    if module is None:
+        return
+    if module_name == "__main__" and getattr(module, "__file__", None):
+        # a script run directly is reported under its module name
+        module_name = os.path.splitext(os.path.basename(module.__file__))[0]
+    for function_name in function_names:
+        if hasattr(module, function_name):
+            setattr(module, function_name, profiled("%s.%s" % (module_name, function_name),
+                                                    getattr(module, function_name)))
+
+
+def install():
+    """
+    wrap the profiled functions of the modules already imported; call it after importing the parsers
+    """
+    global _installed
+    _wrap_parsers()
+    _wrap_module("entries", ["merge_documents", "find_matching_doc"])
+    _wrap_module("mongo_to_feed_mongo", ["doc_to_json"])
+    _wrap_module("__main__", ["doc_to_json"])
+    _installed = True
+
+
+def install_from_env():
+    """install() if profiling is enabled, e.g. at the start of a worker"""
+    if enabled():
+        install()
+    return _installed
+
+
+def collect(reset=True):
+    """
+    the stats recorded in this process, to be returned by a worker; None if profiling is not installed
+    """
+    if not _installed:
+        return None
+    with _lock:
+        stats = {"functions": {k: list(v) for k, v in _functions.items()}, "stacks": dict(_stacks)}
+        if reset:
+            _functions.clear()
+            _stacks.clear()
+    return stats
+
+
+def merge(total, stats):
+    """add stats from collect() into total (a dict from collect() or {})"""
+    if not stats:
+        return total
+    functions = total.setdefault("functions", {})
+    for name, (calls, cumulative, self_time) in stats["functions"].items():
+        current = functions.setdefault(name, [0, 0.0, 0.0])
+        current[0] += calls
+        current[1] += cumulative
+        current[2] += self_time
+    stacks = total.setdefault("stacks", {})
+    for path, seconds in stats["stacks"].items():
+        stacks[path] = stacks.get(path, 0.0) + seconds
+    return total
+
+
+def report(stats, limit=None):
+    lines = ["%-60s %10s %12s %12s %12s" % ("function", "calls", "cumulative s", "self s", "per call ms")]
+    functions = sorted(stats.get("functions", {}).items(), key=lambda x: x[1][1], reverse=True)
+    for name, (calls, cumulative, self_time) in functions[:limit]:
+        lines.append("%-60s %10d %12.3f %12.3f %12.3f" % (
+            name, calls, cumulative, self_time, 1000 * cumulative / calls if calls else 0))
+    return "\n".join(lines) + "\n"
+
+
+def dump(stats=None, directory=None, prefix="profile"):
+    """
+    write the report, the collapsed stacks and the raw stats of stats (default: this process)
+    :return: path of the report
+    """
+    if stats is None:
+        stats = collect(reset=False) or {}
+    directory = directory or os.getenv(ENV) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, prefix + ".json"), "w") as f:
+        json.dump(stats, f)
+    with open(os.path.join(directory, prefix + "_stacks.txt"), "w") as f:
+        for path, seconds in sorted(stats.get("stacks", {}).items()):
+            f.write("%s %d\n" % (path, round(seconds * 1e6)))
+    report_path = os.path.join(directory, prefix + "_report.txt")
+    with open(report_path, "w") as f:
+        f.write(report(stats))
+    return report_path
@@ -21,6 +21,9 @@ import os
 import json
 import itertools
 from entries import build_entries, EntriesDocument
+from instrumentation import Metrics, save_run, start_server_from_env
+import profiling
+import argparse
 from twitter_mentions import TwitterMentions
 import pymongo
 import os
@@ -70,6 +73,7 @@ unparsed_collection_list = [
 
 
 def parse_document(document):
+    """Parse a document if it is new or changed. Returns "parsed", "skipped" or "failed"."""
     try:
         parsed_document = document.parsed_document
     except DoesNotExist:
@@ -90,8 +94,10 @@ def parse_document(document):
             # try:
             parsed_document.save()
             document.save()
+            return "parsed"
         except:
-            pass
+            return "failed"
+    return "skipped"
 
 
 def grouper(n, iterable):
@@ -105,11 +111,17 @@ def grouper(n, iterable):
 
 def parse_documents(documents):
     init_mongoengine()
+    profiling.install_from_env()
+    metrics = Metrics("parse", register=False)
     # print("parsing")
     for document in documents:
-        parse_document(document)
+        source = document._get_collection_name()
+        with metrics.timer("parse", source=source):
+            status = parse_document(document)
+        metrics.count(status, source=source)
         # print(document)
     # print('parsed')
+    return metrics.to_dict(), profiling.collect()
 
 
 # for collection in unparsed_collection_list:
@@ -122,11 +134,31 @@ def parse_documents(documents):
 #            
 #        pprint(document.id)
 #        parse_documents([document])
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--profile", help="profile the parsers and the entries builder, "
+                        "write the reports into this directory", default=None)
+args = arg_parser.parse_args()
+if args.profile:
+    profiling.enable(args.profile)
+
+start_server_from_env()
+profile = {}
+metrics = Metrics("parse")
 with Parallel(n_jobs=32) as parallel:
-    parallel(delayed(parse_documents)(document) for collection in unparsed_collection_list for document in
-             grouper(500, collection.objects))
-
-build_entries()
+    for worker_metrics, worker_profile in parallel(
+            delayed(parse_documents)(document) for collection in unparsed_collection_list
+            for document in grouper(500, collection.objects)):
+        metrics.merge(worker_metrics)
+        profiling.merge(profile, worker_profile)
+save_run(metrics, db)
+
+profiling.install_from_env()
+metrics = Metrics("build_entries")
+build_entries(metrics)
+save_run(metrics, db)
+
+if profiling.enabled():
+    print("Profile written to", profiling.dump(profiling.merge(profile, profiling.collect())))
 
 # twitter_mentions = TwitterMentions()
 # for doc in EntriesDocument.objects(Q(last_twitter_search__not__exists=True)):
@@ -0,0 +1,187 @@
+"""
+Feed client for Vespa's document/v1 API.
+
+Operations are the dicts produced by mongo_to_feed_mongo (a 'put' with all the fields, or an
+'update' assigning the changed fields). They are sent over a pool of keep-alive connections by
+a bounded number of threads, retried with backoff when Vespa is overloaded (429, 503) or the
+connection fails, and every operation is acknowledged to a callback with its outcome.
+
+    client = VespaFeedClient("http://localhost:8080", connections=16, max_in_flight=64)
+    results = client.feed(operations)
+"""
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = {429, 503}
+
+
+class FeedResult:
+    """
+    Outcome of one feed operation
+    """
+    __slots__ = ("key", "docid", "ok", "status", "message", "attempts")
+
+    def __init__(self, key, docid, ok, status, message, attempts):
+        self.key = key
+        self.docid = docid
+        self.ok = ok
+        self.status = status
+        self.message = message
+        self.attempts = attempts
+
+    def __repr__(self):
+        return "FeedResult(docid=%r, ok=%r, status=%r, attempts=%r)" % (
+            self.docid, self.ok, self.status, self.attempts)
+
+
+def operation_request(operation):
+    """
+    Split a feed operation into (docid, HTTP method, document/v1 path, JSON body)
+    """
+    if "put" in operation:
+        docid, method = operation["put"], "POST"
+    elif "update" in operation:
+        docid, method = operation["update"], "PUT"
+    elif "remove" in operation:
+        docid, method = operation["remove"], "DELETE"
+    else:
+        raise ValueError("unknown feed operation: %s" % sorted(operation))
+
+    # id:<namespace>:<document type>::<user specified id>
+    scheme, namespace, doctype, rest = docid.split(":", 3)
+    if scheme != "id" or not rest.startswith(":"):
+        raise ValueError("unsupported document id: %s" % docid)
+    path = "/document/v1/%s/%s/docid/%s" % (quote(namespace), quote(doctype), quote(rest[1:], safe=""))
+
+    body = None
+    if method != "DELETE":
+        body = {"fields": operation["fields"]}
+    return docid, method, path, body
+
+
+class VespaFeedClient:
+    """
+    Concurrent feeder of the document/v1 API.
+
+    connections: size of the HTTP connection pool
+    max_in_flight: upper bound of the operations sent or waiting for a retry at any time
+    max_retries: retries of an operation after 429/503 or a connection error, before it is given up
+    """
+
+    def __init__(self, endpoint, connections=8, max_in_flight=64, max_retries=10, timeout=60,
+                 backoff=0.1, max_backoff=10.0):
+        self.endpoint = endpoint.rstrip("/")
+        self.connections = connections
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, operation, key=None):
+        """
+        Send a single operation, retrying while Vespa asks to slow down.
+        Never raises for HTTP or connection errors, they are returned in the FeedResult.
+        """
+        docid, method, path, body = operation_request(operation)
+        data = json.dumps(body, default=str) if body is not None else None
+
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                response = self.session.request(method, self.endpoint + path, data=data, timeout=self.timeout,
+                                                headers={"Content-Type": "application/json"})
+                status, message = response.status_code, response.text
+            except requests.RequestException as e:
+                status, message = None, repr(e)
+
+            if status is not None and 200 <= status < 300:
+                return FeedResult(key, docid, True, status, None, attempts)
+            if (status is not None and status not in RETRY_STATUS) or attempts > self.max_retries:
+                return FeedResult(key, docid, False, status, message, attempts)
+
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            time.sleep(delay * (0.5 + random.random() / 2))
+
+    def feed(self, operations, callback=None):
+        """
+        Send (key, operation) pairs concurrently, with at most max_in_flight operations pending.
+        Operations may also be given alone, the key is then the index of the operation.
+
+        callback(result) is called from the sending threads as soon as an operation is acknowledged
+        or given up. Returns the list of FeedResult, in completion order.
+        """
+        results = []
+        lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        def done(future):
+            in_flight.release()
+            result = future.result()
+            with lock:
+                results.append(result)
+            if callback is not None:
+                callback(result)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, self.connections)) as executor:
+            for i, item in enumerate(operations):
+                key, operation = item if isinstance(item, tuple) else (i, item)
+                in_flight.acquire()
+                try:
+                    future = executor.submit(self.send, operation, key)
+                except Exception:
+                    in_flight.release()
+                    raise
+                future.add_done_callback(done)
+
+        failed = [r for r in results if not r.ok]
+        if failed:
+            logger.warning("%d of %d operations failed, first: %s %s", len(failed), len(results),
+                           failed[0].docid, failed[0].message)
+        return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Feed a JSON lines file of Vespa operations")
+    parser.add_argument("endpoint", help="Vespa container, e.g. http://localhost:8080")
+    parser.add_argument("file", help="file with one operation per line, - for stdin")
+    parser.add_argument("-c", "--connections", help="HTTP connections, default=8", type=int, default=8)
+    parser.add_argument("--max-in-flight", help="pending operations, default=64", type=int, default=64)
+    args = parser.parse_args()
+
+    f = sys.stdin if args.file == "-" else open(args.file)
+    start = time.time()
+    with VespaFeedClient(args.endpoint, connections=args.connections, max_in_flight=args.max_in_flight) as client:
+        results = client.feed(json.loads(line) for line in f if line.strip())
+    elapsed = time.time() - start
+    n_ok = sum(1 for r in results if r.ok)
+    print("Fed %d of %d operations in %.1f s (%.1f ops/s)" % (
+        n_ok, len(results), elapsed, len(results) / elapsed if elapsed else 0))
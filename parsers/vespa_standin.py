@@ -0,0 +1,188 @@
+"""
+Local stand-in for Vespa's document/v1 API, to test and benchmark the feed without a Vespa cluster.
+
+Documents are kept in memory. Failures can be injected: a fraction of the requests is answered
+429 or 503 (retried by the client), or 500 (not retried), and each response can be delayed.
+
+    python vespa_standin.py serve --port 8080 --throttle-rate 0.05
+    python vespa_standin.py bench -n 20000 --unavailable-rate 0.1 --error-rate 0.01
+"""
+import re
+import sys
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote
+
+DOCUMENT_PATH = re.compile(r"^/document/v1/([^/]+)/([^/]+)/docid/([^/?]+)")
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, throttle_rate=0.0, unavailable_rate=0.0, error_rate=0.0, latency=0.0, seed=None):
+        self.throttle_rate = throttle_rate
+        self.unavailable_rate = unavailable_rate
+        self.error_rate = error_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.documents = {}
+        self.counts = {}
+        super(StandInServer, self).__init__(address, StandInHandler)
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def draw(self):
+        """Pick the injected failure of a request, if any"""
+        with self.lock:
+            x = self.random.random()
+        for status, rate in [(429, self.throttle_rate), (503, self.unavailable_rate), (500, self.error_rate)]:
+            if x < rate:
+                return status
+            x -= rate
+        return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like Vespa
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(status)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+
+        match = DOCUMENT_PATH.match(self.path)
+        if match is None:
+            return self._reply(404, {"message": "no such path: %s" % self.path})
+        docid = "id:%s:%s::%s" % (unquote(match.group(1)), unquote(match.group(2)), unquote(match.group(3)))
+        path_id = self.path.split("?")[0]
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        failure = self.server.draw()
+        if failure is not None:
+            return self._reply(failure, {"pathId": path_id, "message": "injected failure"})
+
+        server = self.server
+        with server.lock:
+            if self.command == "POST":
+                server.documents[docid] = dict(body["fields"])
+            elif self.command == "PUT":
+                if docid not in server.documents:
+                    return self._reply(404, {"pathId": path_id, "id": docid, "message": "document not found"})
+                for field, update in body["fields"].items():
+                    server.documents[docid][field] = update["assign"]
+            elif self.command == "DELETE":
+                server.documents.pop(docid, None)
+            elif self.command == "GET":
+                if docid not in server.documents:
+                    return self._reply(404, {"pathId": path_id, "id": docid})
+                return self._reply(200, {"pathId": path_id, "id": docid, "fields": server.documents[docid]})
+        self._reply(200, {"pathId": path_id, "id": docid})
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+def start_server(port=0, **kwargs):
+    """
+    Start a stand-in server in a background thread.
+    Returns the server, its endpoint is "http://127.0.0.1:%d" % server.server_address[1]
+    """
+    server = StandInServer(("127.0.0.1", port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def synthetic_operations(n, dim=128, seed=0):
+    rng = random.Random(seed)
+    for i in range(n):
+        yield {
+            "put": "id:covid-19:doc::%024x" % i,
+            "fields": {
+                "id": "%024x" % i,
+                "title": "Document %d" % i,
+                "abstract": " ".join("word%d" % rng.randint(0, 5000) for _ in range(200)),
+                "abstract_embedding": {"values": [rng.random() for _ in range(dim)]},
+            },
+        }
+
+
+def bench(n, connections=8, max_in_flight=64, max_retries=10, **kwargs):
+    """
+    Feed n synthetic documents to a stand-in server and check that every operation is acknowledged
+    once, and that the documents acknowledged as successful, and only them, are stored.
+    """
+    from vespa_feed import VespaFeedClient
+
+    server = start_server(**kwargs)
+    endpoint = "http://127.0.0.1:%d" % server.server_address[1]
+    acked = []
+    start = time.time()
+    with VespaFeedClient(endpoint, connections=connections, max_in_flight=max_in_flight,
+                         max_retries=max_retries, backoff=0.01, max_backoff=0.5) as client:
+        results = client.feed(synthetic_operations(n), callback=acked.append)
+    elapsed = time.time() - start
+    server.shutdown()
+
+    succeeded = set(r.docid for r in results if r.ok)
+    report = {
+        "operations": n,
+        "seconds": elapsed,
+        "per_second": n / elapsed if elapsed else None,
+        "succeeded": len(succeeded),
+        "failed": sum(1 for r in results if not r.ok),
+        "retries": sum(r.attempts - 1 for r in results),
+        "responses": {str(k): v for k, v in sorted(server.counts.items())},
+        "acked_once": len(acked) == n and len(set(r.key for r in acked)) == n,
+        "stored_match_acked": succeeded == set(server.documents),
+    }
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", help="serve: run the stand-in server, bench: feed synthetic documents to it",
+                        choices=["serve", "bench"])
+    parser.add_argument("--port", help="port of the server, default=8080", type=int, default=8080)
+    parser.add_argument("--throttle-rate", help="fraction of requests answered 429", type=float, default=0.0)
+    parser.add_argument("--unavailable-rate", help="fraction of requests answered 503", type=float, default=0.0)
+    parser.add_argument("--error-rate", help="fraction of requests answered 500", type=float, default=0.0)
+    parser.add_argument("--latency", help="seconds added to every response", type=float, default=0.0)
+    parser.add_argument("-n", help="bench: number of documents, default=10000", type=int, default=10000)
+    parser.add_argument("-c", "--connections", help="bench: HTTP connections, default=8", type=int, default=8)
+    parser.add_argument("--max-in-flight", help="bench: pending operations, default=64", type=int, default=64)
+    args = parser.parse_args()
+
+    failures = dict(throttle_rate=args.throttle_rate, unavailable_rate=args.unavailable_rate,
+                    error_rate=args.error_rate, latency=args.latency)
+    if args.mode == "serve":
+        server = StandInServer(("", args.port), **failures)
+        print("Serving document/v1 on port %d" % args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        json.dump(bench(args.n, connections=args.connections, max_in_flight=args.max_in_flight, seed=0,
+                        **failures), sys.stdout, indent=2)
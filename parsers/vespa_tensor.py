@@ -0,0 +1,134 @@
+"""
+Compact encodings of the embedding tensors fed to Vespa.
+
+By default the embeddings are fed as JSON float lists, {"values": [0.0123456789, ...]}, about 20 bytes
+per cell. Vespa also accepts the cells of a dense tensor as a single hex string of their binary value,
+{"values": "3C4A..."}, in the cell type of the tensor field:
+    float     hex of the float32 cells, lossless (8 characters per cell)
+    bfloat16  hex of the bfloat16 cells, for tensor<bfloat16> fields (4 characters per cell)
+    int8      hex of int8 cells, for tensor<int8> fields (2 characters per cell). Each vector is scaled
+              so that its largest absolute value is 127; the scale is not stored, so this encoding is
+              only meant for angular/cosine distance, which does not depend on the norm.
+
+    python vespa_tensor.py -n 2000 --dim 100
+compares the sizes, encoding throughput and round-trip accuracy of the encodings.
+"""
+import json
+import time
+
+import numpy as np
+
+ENCODINGS = ["list", "float", "bfloat16", "int8"]
+
+
+def _to_bfloat16_bits(values):
+    """round float32 to the nearest bfloat16 (ties to even), as uint16 bits"""
+    bits = np.asarray(values, dtype=np.float32).view(np.uint32).astype(np.uint64)
+    bits = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+    return bits.astype(np.uint16)
+
+
+def encode_tensor(values, encoding="list"):
+    """
+    Encode a dense embedding as the value of a Vespa tensor field
+    :param values: list of floats
+    :param encoding: one of ENCODINGS
+    :return: {"values": list or hex string}
+    """
+    if encoding == "list":
+        return {"values": values}
+
+    values = np.asarray(values, dtype=np.float32)
+    if encoding == "float":
+        cells = values.astype(">f4")
+    elif encoding == "bfloat16":
+        cells = _to_bfloat16_bits(values).astype(">u2")
+    elif encoding == "int8":
+        scale = np.abs(values).max()
+        scale = 127.0 / scale if scale > 0 else 0.0
+        cells = np.clip(np.rint(values * scale), -127, 127).astype(np.int8)
+    else:
+        raise ValueError("unknown tensor encoding: %s" % encoding)
+    return {"values": cells.tobytes().hex().upper()}
+
+
+def decode_tensor(tensor, encoding="list"):
+    """
+    Inverse of encode_tensor. int8 tensors are returned as the integer cells, without the scale
+    :rtype: np.ndarray
+    """
+    values = tensor["values"]
+    if encoding == "list":
+        return np.asarray(values, dtype=np.float32)
+
+    data = bytes.fromhex(values)
+    if encoding == "float":
+        return np.frombuffer(data, dtype=">f4").astype(np.float32)
+    elif encoding == "bfloat16":
+        bits = np.frombuffer(data, dtype=">u2").astype(np.uint32) << 16
+        return bits.view(np.float32)
+    elif encoding == "int8":
+        return np.frombuffer(data, dtype=np.int8).astype(np.float32)
+    raise ValueError("unknown tensor encoding: %s" % encoding)
+
+
+def compare(embeddings, encodings=ENCODINGS):
+    """
+    Encode every embedding with each encoding and report the JSON size, the encode + json.dumps
+    throughput and the round-trip error (max absolute error for the lossless/float encodings,
+    cosine similarity to the original for all)
+    """
+    embeddings = [list(map(float, e)) for e in embeddings]
+    originals = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(originals, axis=1)
+    norms[norms == 0] = 1
+
+    report = {}
+    for encoding in encodings:
+        start = time.perf_counter()
+        encoded = [json.dumps(encode_tensor(e, encoding)) for e in embeddings]
+        seconds = time.perf_counter() - start
+
+        decoded = np.vstack([decode_tensor(json.loads(e), encoding) for e in encoded])
+        decoded_norms = np.linalg.norm(decoded, axis=1)
+        decoded_norms[decoded_norms == 0] = 1
+        cosine = (decoded * originals).sum(axis=1) / (decoded_norms * norms)
+        record = {
+            "bytes_per_embedding": sum(len(e) for e in encoded) / len(encoded),
+            "embeddings_per_second": len(encoded) / seconds if seconds else None,
+            "min_cosine": float(cosine.min()),
+            "mean_cosine": float(cosine.mean()),
+        }
+        if encoding != "int8":
+            record["max_abs_error"] = float(np.abs(decoded - originals).max())
+        report[encoding] = record
+    return report
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", help="number of embeddings, default=2000", type=int, default=2000)
+    parser.add_argument("--dim", help="dimension of the synthetic embeddings, default=100", type=int, default=100)
+    parser.add_argument("--sample", help="sample the abstract embeddings of entries_vespa2 instead of random ones",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.sample:
+        import pymongo
+
+        client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
+                                     password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
+        db = client[os.getenv("COVID_DB")]
+        embeddings = [doc["embeddings"]["abstract_embedding"] for doc in db.entries_vespa2.aggregate([
+            {"$match": {"embeddings.abstract_embedding": {"$type": "array"}}},
+            {"$sample": {"size": args.n}},
+            {"$project": {"embeddings.abstract_embedding": 1}},
+        ])]
+    else:
+        embeddings = np.random.RandomState(0).randn(args.n, args.dim).astype(np.float32) * 0.1
+
+    json.dump(compare(embeddings), sys.stdout, indent=2)
@@ -0,0 +1,228 @@
+"""
+Orchestrator of the entries pipeline, replacing the sequential loop of entries_script.bash.
+
+The stages form a DAG:
+
+    parse (run_all_parsers_vespa.py) --> classify (is_covid19_class.py) --+--> export (mongo_to_feed_mongo.py)
+                                     \\-> keywords (Keywords.py) ---------/
+
+Every stage runs in its own thread, so independent stages overlap: classify and keywords run side
+by side, and a stage with a long interval does not hold back the others. A stage consumes the
+output of its upstream stages through a pending query on entries_vespa2 (unclassified entries,
+entries without keywords, unsynced entries), and only runs when that queue holds more entries than it left behind last time (entries a stage
+fails on stay pending; they are retried every retry_interval). Stages without a pending query
+run every `interval` seconds. A stage is woken up as soon as one of its upstream stages finishes,
+and does not start while one of them is running: the export would otherwise mark synced entries
+that classify or keywords are rewriting (mongo_to_feed_mongo.mark_synced also only marks the
+entries unchanged since they were read).
+
+    python pipeline.py            # run forever
+    python pipeline.py --once     # run each stage with work once, in DAG order
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import subprocess
+
+import pymongo
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, "parsers"))
+from instrumentation import Metrics, start_server_from_env
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    A pipeline step run as a subprocess
+
+    :param pending: function(db) -> number of entries waiting for this stage, or None to run on interval
+    :param upstream: names of the stages whose output this stage consumes
+    """
+
+    def __init__(self, name, command, cwd, pending=None, upstream=(), interval=1800, retry_interval=21600):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.pending = pending
+        self.upstream = list(upstream)
+        self.interval = interval
+        self.retry_interval = retry_interval
+
+        self.wakeup = threading.Event()
+        self.running = threading.Event()
+        self.last_start = None
+        self.left_over = 0
+        self.runs = 0
+
+    def has_work(self, db):
+        """
+        :return: (whether the stage should run, number of pending entries or None)
+        """
+        since_last = time.time() - self.last_start if self.last_start is not None else None
+        if self.pending is None:
+            return since_last is None or since_last >= self.interval, None
+
+        n_pending = self.pending(db)
+        if n_pending == 0:
+            return False, n_pending
+        retry = since_last is None or since_last >= self.retry_interval
+        return n_pending > self.left_over or retry, n_pending
+
+    def run(self, db):
+        self.last_start = time.time()
+        logger.info("Stage {} started: {}".format(self.name, " ".join(self.command)))
+        # the metrics endpoint belongs to the orchestrator, the stages write run records
+        env = {k: v for k, v in os.environ.items() if k != "PIPELINE_METRICS_PORT"}
+        returncode = subprocess.call(self.command, cwd=self.cwd, env=env)
+        seconds = time.time() - self.last_start
+        self.runs += 1
+        if self.pending is not None:
+            self.left_over = self.pending(db)
+        logger.info("Stage {} finished in {:.0f} s with code {}, {} entries left".format(
+            self.name, seconds, returncode, self.left_over if self.pending is not None else "-"))
+        return returncode
+
+
+def default_stages(python=sys.executable):
+    """
+    The stages of entries_script.bash
+    """
+    parsers_dir = os.path.join(ROOT, "parsers")
+    ml_dir = os.path.join(ROOT, "ML_builders")
+    return [
+        Stage("parse", [python, "run_all_parsers_vespa.py"], parsers_dir, interval=1800),
+        Stage("classify", [python, "is_covid19_class.py"], ml_dir, upstream=["parse"],
+              pending=lambda db: db.entries_vespa2.count_documents({"is_covid19_ML": None})),
+        Stage("keywords", [python, "Keywords.py"], ml_dir, upstream=["parse"],
+              pending=lambda db: db.entries_vespa2.count_documents({
+                  "$or": [{"keywords_ML": []}, {"keywords_ML": {"$exists": False}}],
+                  "abstract": {"$nin": [None, "", []]},
+              })),
+        Stage("export", [python, "mongo_to_feed_mongo.py"], parsers_dir, upstream=["parse", "classify", "keywords"],
+              pending=lambda db: db.entries_vespa2.count_documents({"synced": False})),
+    ]
+
+
+class Pipeline:
+    def __init__(self, stages, db, poll_interval=60):
+        self.stages = {stage.name: stage for stage in stages}
+        self.db = db
+        self.poll_interval = poll_interval
+        self.downstream = {name: [] for name in self.stages}
+        for stage in stages:
+            for name in stage.upstream:
+                self.downstream[name].append(stage)
+        self._stop = threading.Event()
+        self.metrics = Metrics("pipeline")
+
+    def order(self):
+        """
+        stages in topological order
+        """
+        ordered, seen = [], set()
+
+        def visit(stage, path=()):
+            if stage.name in path:
+                raise ValueError("cycle in the pipeline: {}".format(" -> ".join(path + (stage.name,))))
+            if stage.name in seen:
+                return
+            for name in stage.upstream:
+                visit(self.stages[name], path + (stage.name,))
+            seen.add(stage.name)
+            ordered.append(stage)
+
+        for stage in self.stages.values():
+            visit(stage)
+        return ordered
+
+    def step(self, stage):
+        """
+        run the stage if it has work, and wake up its downstream stages after it ran
+        """
+        busy = [name for name in stage.upstream if self.stages[name].running.is_set()]
+        if busy:
+            logger.debug("Stage {} waiting for {}".format(stage.name, ", ".join(busy)))
+            return False
+        should_run, n_pending = stage.has_work(self.db)
+        if not should_run:
+            logger.debug("Stage {} idle, {} pending".format(stage.name, n_pending))
+            return False
+        stage.running.set()
+        try:
+            with self.metrics.timer("stage_run", source=stage.name):
+                returncode = stage.run(self.db)
+        finally:
+            stage.running.clear()
+        self.metrics.count("runs" if returncode == 0 else "failed_runs", source=stage.name)
+        if n_pending is not None:
+            self.metrics.count("consumed", max(0, n_pending - stage.left_over), source=stage.name)
+        for downstream in self.downstream[stage.name]:
+            downstream.wakeup.set()
+        return True
+
+    def run_once(self):
+        for stage in self.order():
+            self.step(stage)
+
+    def _loop(self, stage):
+        while not self._stop.is_set():
+            try:
+                self.step(stage)
+            except Exception:
+                logger.exception("Stage {} failed".format(stage.name))
+            stage.wakeup.wait(self.poll_interval)
+            stage.wakeup.clear()
+
+    def run_forever(self):
+        threads = [threading.Thread(target=self._loop, args=(stage,), name=stage.name, daemon=True)
+                   for stage in self.order()]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self._stop.set()
+            for stage in self.stages.values():
+                stage.wakeup.set()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--once", help="run each stage with work once, in order, and exit", action="store_true")
+    parser.add_argument("--poll", help="seconds between checks for work, default=60", type=int, default=60)
+    parser.add_argument("--parse-interval", help="seconds between parser runs, default=1800", type=int, default=1800)
+    parser.add_argument("--skip", help="stages not to run", nargs="*", default=[])
+    parser.add_argument("-v", "--verbose", help="set logger level, default=INFO", default="INFO",
+                        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
+    args = parser.parse_args()
+
+    out_hdlr = logging.StreamHandler(sys.stdout)
+    out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(out_hdlr)
+    logger.setLevel(args.verbose)
+
+    client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
+                                 password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
+    db = client[os.getenv("COVID_DB")]
+
+    stages = []
+    for stage in default_stages():
+        if stage.name == "parse":
+            stage.interval = args.parse_interval
+        if stage.name not in args.skip:
+            stage.upstream = [name for name in stage.upstream if name not in args.skip]
+            stages.append(stage)
+
+    start_server_from_env()
+    pipeline = Pipeline(stages, db, poll_interval=args.poll)
+    if args.once:
+        pipeline.run_once()
+    else:
+        pipeline.run_forever()
@@ -0,0 +1,317 @@
+"""
+Benchmark of the similar_abstracts pipeline: train, build and update.
+
+The entries are synthetic abstracts (or a sample of the real entries) loaded into mongomock,
+or into a local mongod given by --mongo-uri. Every stage reports its wall time, throughput
+and the peak RSS of the process and its workers, and the whole run is written as JSON
+so that runs can be compared.
+
+    python benchmark.py --scale 10k -o result/bench_10k.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import threading
+import datetime
+
+import psutil
+import numpy as np
+
+from corpus_builder import CorpusBuilder
+from neighbors import top_k
+from similar_abstract_mongodb import AbstractSimilarity
+
+logger = logging.getLogger(__name__)
+
+SCALES = {
+    "10k": 10000,
+    "100k": 100000,
+    "1m": 1000000,
+}
+
+
+class PeakRSS:
+    """
+    sample the RSS of this process and its children in a thread, keep the peak
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self):
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+class Stage:
+    """
+    time a stage and record its throughput and peak RSS into the report
+    """
+
+    def __init__(self, report, name, items=None, unit="docs"):
+        self.report = report
+        self.name = name
+        self.record = {"items": items, "unit": unit}
+        self._rss = PeakRSS()
+
+    def __enter__(self):
+        logger.info("Stage {} started".format(self.name))
+        self._rss.__enter__()
+        self._start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        self._rss.__exit__(*exc)
+        self.record["seconds"] = seconds
+        self.record["peak_rss_mb"] = self._rss.peak / 2 ** 20
+        if self.record.get("items"):
+            self.record["per_second"] = self.record["items"] / seconds if seconds else None
+        self.report["stages"][self.name] = self.record
+        logger.info("Stage {} finished: {}".format(self.name, self.record))
+
+
+def synthetic_abstracts(n, seed=0, vocabulary_size=20000, min_words=80, max_words=250):
+    """
+    generate n abstracts of Zipf distributed words, so that token frequencies look like real text
+    """
+    rng = np.random.RandomState(seed)
+    syllables = ["ab", "co", "vi", "ra", "pro", "te", "in", "ce", "lu", "dis", "ea", "se", "mo", "gen", "tion"]
+    vocabulary = []
+    words = set()
+    while len(vocabulary) < vocabulary_size:
+        word = "".join(rng.choice(syllables, rng.randint(2, 5)))
+        if word not in words:
+            words.add(word)
+            vocabulary.append(word)
+    vocabulary = np.array(vocabulary)
+    cdf = np.cumsum(1.0 / np.arange(1, vocabulary_size + 1))
+    cdf /= cdf[-1]
+    for _ in range(n):
+        length = rng.randint(min_words, max_words)
+        sentence = vocabulary[np.searchsorted(cdf, rng.random_sample(length))]
+        yield " ".join(sentence) + "."
+
+
+def sampled_abstracts(n):
+    """
+    sample n abstracts from the real entries collection
+    """
+    import pymongo
+
+    client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
+                                 password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
+    db = client[os.getenv("COVID_DB")]
+    for doc in db[AbstractSimilarity.collection].aggregate([
+        {"$match": {AbstractSimilarity.abstract_entry: {"$exists": True, "$ne": None}}},
+        {"$sample": {"size": n}},
+        {"$project": {AbstractSimilarity.abstract_entry: 1}},
+    ], allowDiskUse=True):
+        yield doc[AbstractSimilarity.abstract_entry]
+
+
+def get_db(mongo_uri):
+    if mongo_uri:
+        import pymongo
+
+        db = pymongo.MongoClient(mongo_uri)["similar_abstracts_benchmark"]
+        db.client.drop_database(db.name)
+        return db
+
+    import mongomock
+
+    return mongomock.MongoClient()["similar_abstracts_benchmark"]
+
+
+def load(db, abstracts, batch_size=10000):
+    collection = db[AbstractSimilarity.collection]
+    batch = []
+    count = 0
+    for abstract in abstracts:
+        batch.append({AbstractSimilarity.abstract_entry: abstract})
+        if len(batch) >= batch_size:
+            collection.insert_many(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+        count += len(batch)
+    return count
+
+
+def similarity_state(db, similarity):
+    """
+    the similar abstracts lists (as lists of _id) and the reverse index in the database
+    """
+    lists = {
+        doc["_id"]: [x[1] for x in doc[similarity.similar_abstracts_entry]]
+        for doc in db[similarity.collection].find({similarity.similar_abstracts_entry: {"$exists": True}},
+                                                  {similarity.similar_abstracts_entry: 1})
+        if doc[similarity.similar_abstracts_entry]
+    }
+    reverse = {doc["_id"]: sorted(doc.get("listed_by", [])) for doc in db[similarity.reverse_collection].find()}
+    return {"lists": lists, "reverse": reverse}
+
+
+def run(n, mongo_uri=None, sample=False, update_fraction=0.01, processes=None, epoch=5, seed=0, work_dir=None):
+    """
+    run the benchmark on n abstracts
+    :return: report dict
+    """
+    report = {
+        "started": datetime.datetime.now().isoformat(),
+        "n": n,
+        "source": "sampled" if sample else "synthetic",
+        "backend": "mongod" if mongo_uri else "mongomock",
+        "processes": processes or os.cpu_count(),
+        "epoch": epoch,
+        "update_fraction": update_fraction,
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": {},
+    }
+    n_update = int(n * update_fraction)
+    abstracts = sampled_abstracts(n + n_update) if sample else synthetic_abstracts(n + n_update, seed)
+
+    db = get_db(mongo_uri)
+    work_dir = work_dir or tempfile.mkdtemp(prefix="similar_abstracts_benchmark_")
+    model_path = os.path.join(work_dir, "model.bin")
+
+    with Stage(report, "load", n):
+        load(db, (next(abstracts) for _ in range(n)))
+
+    # tokenization
+    builder = CorpusBuilder(db, AbstractSimilarity.collection, AbstractSimilarity.abstract_entry,
+                            processes=processes)
+    corpus_dir = os.path.join(work_dir, "corpus")
+    with Stage(report, "tokenize", n) as record:
+        builder.build(corpus_dir)
+    record["tokens"] = sum(len(line.split()) for path in builder.corpus_files(corpus_dir) for line in open(path))
+    record["tokens_per_second"] = record["tokens"] / record["seconds"]
+
+    with Stage(report, "tokenize_cached", n):
+        builder.build(corpus_dir)
+
+    # train
+    similarity = AbstractSimilarity(model_path, db=db)
+    similarity.training_args = dict(similarity.training_args, epoch=epoch, verbose=0)
+    with Stage(report, "train", record["tokens"], unit="tokens"):
+        similarity.train(corpus_dir=corpus_dir, use_existing_corpus=True, processes=processes)
+
+    # build, stage by stage
+    with Stage(report, "vectors", n):
+        ids, vectors, current, _ = similarity._load_vectors()
+    with Stage(report, "vectors_cached", n):
+        similarity._load_vectors()
+    with Stage(report, "deduplicate", len(ids)) as record:
+        labels, representatives = similarity._representatives(vectors)
+    record["groups"] = len(representatives)
+    with Stage(report, "neighbor_search", len(representatives), unit="queries"):
+        indices, similarities = top_k(vectors[representatives], vectors[representatives], similarity.n,
+                                      query_index=np.arange(len(representatives)))
+    representative_ids = [ids[i] for i in representatives]
+    representative_row = {i: row for row, i in enumerate(representatives)}
+    new_lists = {
+        _id: similarity._to_similar_abstracts(representative_ids, indices[representative_row[labels[i]]],
+                                              similarities[representative_row[labels[i]]])
+        for i, _id in enumerate(ids)
+    }
+    with Stage(report, "write", len(new_lists), unit="lists"):
+        similarity._save(new_lists, current)
+
+    # the whole build, for reference
+    with Stage(report, "build", n):
+        similarity.build()
+
+    # update after adding new abstracts, removing an entry and the abstract of another
+    load(db, abstracts)
+    removed = [doc["_id"] for doc in db[similarity.collection].find({}, {"_id": 1}).limit(2)]
+    db[similarity.collection].delete_one({"_id": removed[0]})
+    db[similarity.collection].update_one({"_id": removed[1]}, {"$unset": {similarity.abstract_entry: ""}})
+    with Stage(report, "update", n_update):
+        similarity.update()
+
+    # the update must give the same lists and reverse index as a build
+    updated = similarity_state(db, similarity)
+    with Stage(report, "rebuild", n + n_update):
+        similarity.build()
+    rebuilt = similarity_state(db, similarity)
+    report["update_mismatches"] = {
+        name: sum(1 for _id in set(updated[name]) | set(rebuilt[name])
+                  if updated[name].get(_id) != rebuilt[name].get(_id))
+        for name in rebuilt
+    }
+
+    report["finished"] = datetime.datetime.now().isoformat()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="number of abstracts, default=10k", default="10k",
+                        choices=sorted(SCALES))
+    parser.add_argument("-n", help="number of abstracts, overrides --scale", type=int, default=None)
+    parser.add_argument("--sample", help="sample the abstracts from the database instead of generating them",
+                        action="store_true")
+    parser.add_argument("--mongo-uri", help="use a local mongod instead of mongomock", default=None)
+    parser.add_argument("--update-fraction", help="fraction of abstracts added before update, default=0.01",
+                        type=float, default=0.01)
+    parser.add_argument("-p", "--processes", help="number of tokenization processes.", type=int, default=None)
+    parser.add_argument("--epoch", help="fasttext training epochs, default=5", type=int, default=5)
+    parser.add_argument("--seed", help="random seed of the synthetic abstracts", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the JSON report to this file instead of stdout", default=None)
+    parser.add_argument("-v", "--verbose", help="set logger level, default=INFO", default="INFO",
+                        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
+
+    args = parser.parse_args()
+
+    out_hdlr = logging.StreamHandler(sys.stderr)
+    out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    for _logger in [logger, logging.getLogger("similar_abstract_mongodb"), logging.getLogger("corpus_builder")]:
+        _logger.addHandler(out_hdlr)
+        _logger.setLevel(args.verbose)
+
+    result = run(args.n or SCALES[args.scale], mongo_uri=args.mongo_uri, sample=args.sample,
+                 update_fraction=args.update_fraction, processes=args.processes, epoch=args.epoch,
+                 seed=args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
@@ -0,0 +1,239 @@
+import os
+import sys
+import glob
+import json
+import shutil
+import hashlib
+import logging
+import itertools
+import multiprocessing
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from pretokenize import PreTokenize
+
+logger = logging.getLogger(__name__)
+
+
+def _text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _tokenize_chunk(chunk):
+    """
+    worker function: tokenize the documents of one chunk
+    :param chunk: list of (_id, text_hash, text, cached_tokens), cached_tokens is None when not cached
+    :return: list of (_id, text_hash, tokens, newly_tokenized)
+    """
+    results = []
+    for _id, text_hash, text, tokens in chunk:
+        if tokens is not None:
+            results.append((_id, text_hash, tokens, False))
+        else:
+            results.append((_id, text_hash, PreTokenize.tokenize(text, True), True))
+    return results
+
+
+class CorpusBuilder:
+    """
+    Build the fastText training corpus with a process pool.
+
+    The corpus is written as ordered shards (shard_00000.txt, shard_00001.txt, ...) into a directory,
+    together with a manifest.json that records the shards and the last `_id` included.
+    Tokens are cached in `cache_collection` keyed by entry `_id` and the sha1 of the abstract,
+    so only new or changed abstracts go through spaCy.
+    """
+    shard_size = 20000  # documents per shard
+    chunk_size = 200  # documents per worker task
+    manifest_name = "manifest.json"
+    delta_name = "delta.txt"
+
+    def __init__(self, db, collection="entries", abstract_entry="abstract",
+                 cache_collection="abstract_tokens", processes=None):
+        self.db = db
+        self.collection = collection
+        self.abstract_entry = abstract_entry
+        self.cache_collection = cache_collection
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def _query(self, after_id=None):
+        query = {self.abstract_entry: {"$exists": True, "$ne": None}}
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        return query
+
+    def _chunks(self, query):
+        """
+        read the documents in _id order and attach cached tokens, chunk by chunk
+        """
+        cursor = self.db[self.collection].find(query, {self.abstract_entry: 1}).sort("_id", 1)
+        while True:
+            docs = list(itertools.islice(cursor, self.chunk_size))
+            if not docs:
+                return
+            cached = {
+                c["_id"]: c for c in self.db[self.cache_collection].find(
+                    {"_id": {"$in": [d["_id"] for d in docs]}}
+                )
+            }
+            chunk = []
+            for doc in docs:
+                text = doc.get(self.abstract_entry, "") or ""
+                if isinstance(text, list):
+                    text = " ".join(text)
+                text_hash = _text_hash(text)
+                cache = cached.get(doc["_id"])
+                tokens = cache["tokens"] if cache is not None and cache.get("hash") == text_hash else None
+                chunk.append((doc["_id"], text_hash, text, tokens))
+            yield chunk
+
+    def _tokenized(self, query):
+        """
+        tokenize the documents matching query in a process pool, results are yielded in _id order
+        the pool is fed a bounded window of chunks so that the cursor is not read ahead unboundedly
+        """
+        window = self.processes * 4
+        chunks = self._chunks(query)
+        with multiprocessing.Pool(processes=self.processes) as pool:
+            while True:
+                batch = list(itertools.islice(chunks, window))
+                if not batch:
+                    return
+                for results in pool.imap(_tokenize_chunk, batch):
+                    self._update_cache(results)
+                    yield results
+
+    def _update_cache(self, results):
+        requests = [
+            UpdateOne({"_id": _id}, {"$set": {"hash": text_hash, "tokens": tokens}}, upsert=True)
+            for _id, text_hash, tokens, newly_tokenized in results if newly_tokenized
+        ]
+        if requests:
+            self.db[self.cache_collection].bulk_write(requests, ordered=False)
+
+    def _write(self, query, path_for_shard, shard_size=None):
+        """
+        write tokenized documents into shards, a shard is closed as soon as it is full
+        when shard_size is None, everything goes into a single file
+        :return: list of shard paths, last _id written, number of documents written
+        """
+        shards = []
+        last_id = None
+        count = 0
+        f = None
+        try:
+            for results in self._tokenized(query):
+                for _id, _, tokens, _ in results:
+                    last_id = _id
+                    if not tokens:
+                        continue
+                    if f is None or (shard_size and count % shard_size == 0 and count > 0):
+                        if f is not None:
+                            f.close()
+                            logger.info("Finished shard {}".format(shards[-1]))
+                        shards.append(path_for_shard(len(shards)))
+                        f = open(shards[-1], "w", encoding="utf-8")
+                    f.write(" ".join(tokens) + "\n")
+                    count += 1
+        finally:
+            if f is not None:
+                f.close()
+        return shards, last_id, count
+
+    def build(self, corpus_dir):
+        """
+        build the full corpus from scratch into corpus_dir
+        :return: list of shard paths
+        """
+        os.makedirs(corpus_dir, exist_ok=True)
+        for old_file in glob.glob(os.path.join(corpus_dir, "shard_*.txt")) + [
+                os.path.join(corpus_dir, self.delta_name)]:
+            if os.path.isfile(old_file):
+                os.remove(old_file)
+
+        logger.info("Building corpus in {} with {} processes".format(corpus_dir, self.processes))
+        shards, last_id, count = self._write(
+            self._query(), lambda i: os.path.join(corpus_dir, "shard_{:05d}.txt".format(i)), self.shard_size
+        )
+        self._save_manifest(corpus_dir, [os.path.basename(s) for s in shards], last_id)
+        logger.info("Corpus built: {} documents in {} shards".format(count, len(shards)))
+        return shards
+
+    def build_delta(self, corpus_dir):
+        """
+        write the documents added after the corpus was built into corpus_dir/delta.txt
+        only documents with an _id after the last one of the corpus are selected: abstracts edited since
+        the corpus was built keep their old tokens in the shards until the corpus is built again
+        :return: path of the delta file, or None if there is nothing new
+        """
+        manifest = self.load_manifest(corpus_dir)
+        delta_path = os.path.join(corpus_dir, self.delta_name)
+        shards, last_id, count = self._write(self._query(manifest["last_id"]), lambda i: delta_path + ".part")
+        if not shards:
+            return None
+
+        os.replace(delta_path + ".part", delta_path)
+        logger.info("Delta built: {} documents after {}".format(count, manifest["last_id"]))
+        return delta_path
+
+    def _save_manifest(self, corpus_dir, shards, last_id):
+        with open(os.path.join(corpus_dir, self.manifest_name), "w") as f:
+            json.dump({"shards": shards, "last_id": str(last_id) if last_id is not None else None}, f)
+
+    def load_manifest(self, corpus_dir):
+        with open(os.path.join(corpus_dir, self.manifest_name)) as f:
+            manifest = json.load(f)
+        if manifest["last_id"] is not None and ObjectId.is_valid(manifest["last_id"]):
+            manifest["last_id"] = ObjectId(manifest["last_id"])
+        return manifest
+
+    def corpus_files(self, corpus_dir, with_delta=True):
+        """
+        list the files of a previously built corpus, in order
+        """
+        manifest = self.load_manifest(corpus_dir)
+        files = [os.path.join(corpus_dir, s) for s in manifest["shards"]]
+        delta_path = os.path.join(corpus_dir, self.delta_name)
+        if with_delta and os.path.isfile(delta_path):
+            files.append(delta_path)
+        return files
+
+    @staticmethod
+    def concatenate(files, out_path):
+        """
+        fastText only takes a single input file
+        """
+        with open(out_path, "wb") as out:
+            for path in files:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        return out_path
+
+
+if __name__ == "__main__":
+    import argparse
+    import pymongo
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", help="build: build the whole corpus, delta: add the new documents to a corpus",
+                        choices=["build", "delta"])
+    parser.add_argument("corpus_dir", help="directory of the corpus shards")
+    parser.add_argument("-p", "--processes", help="number of tokenization processes", type=int, default=None)
+    parser.add_argument("-v", "--verbose", help="set logger level, default=WARNING", default="WARNING",
+                        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
+
+    args = parser.parse_args()
+
+    out_hdlr = logging.StreamHandler(sys.stdout)
+    out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(out_hdlr)
+    logger.setLevel(args.verbose)
+
+    client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
+                                 password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
+    builder = CorpusBuilder(client[os.getenv("COVID_DB")], processes=args.processes)
+    if args.mode == "build":
+        builder.build(args.corpus_dir)
+    else:
+        builder.build_delta(args.corpus_dir)
@@ -0,0 +1,62 @@
+import numpy as np
+
+__all__ = ['duplicate_groups']
+
+
+def _find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:  # path compression
+        parent[i], i = root, parent[i]
+    return root
+
+
+def duplicate_groups(vectors, threshold=0.99, n_bits=16, n_tables=4, seed=0, block_size=1024):
+    """
+    group exact and near-exact duplicates by random hyperplane hashing of the vectors
+
+    Vectors are hashed into buckets by the signs of their projections on n_bits random hyperplanes,
+    n_tables times. Inside a bucket, pairs with cosine similarity >= threshold are joined into one group.
+    Identical abstracts have identical vectors, so they always share their buckets.
+
+    :param vectors: normalized vectors, shape (n, dim)
+    :type vectors: np.ndarray
+    :param threshold: cosine similarity from which two vectors are duplicates
+    :type threshold: float
+    :param n_bits: hyperplanes per table, more bits give smaller buckets
+    :type n_bits: int
+    :param n_tables: number of hash tables, more tables miss fewer duplicates
+    :type n_tables: int
+    :param seed: seed of the random hyperplanes
+    :type seed: int
+    :return: labels, labels[i] is the index of the representative of vector i, the smallest index of its group
+    :rtype: np.ndarray
+    """
+    n = len(vectors)
+    parent = list(range(n))
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    rng = np.random.RandomState(seed)
+    weights = np.left_shift(1, np.arange(n_bits, dtype=np.int64))
+    for _ in range(n_tables):
+        planes = rng.randn(vectors.shape[1], n_bits).astype(np.float32)
+        signatures = ((vectors @ planes) > 0).astype(np.int64) @ weights
+        order = np.argsort(signatures, kind="stable")
+        boundaries = np.nonzero(np.diff(signatures[order]))[0] + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) < 2:
+                continue
+            bucket_vectors = vectors[bucket]
+            for start in range(0, len(bucket), block_size):
+                sims = bucket_vectors[start:start + block_size] @ bucket_vectors.T
+                rows, cols = np.nonzero(sims >= threshold)
+                for row, col in zip(rows + start, cols):
+                    if row < col:
+                        root_a, root_b = _find(parent, bucket[row]), _find(parent, bucket[col])
+                        if root_a != root_b:
+                            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # the smaller root always becomes the parent, so the root of a group is its smallest index
+    return np.array([_find(parent, i) for i in range(n)], dtype=np.int64)
@@ -0,0 +1,226 @@
+import sys
+import hashlib
+import logging
+import itertools
+import multiprocessing
+import numpy as np
+from pymongo import UpdateOne
+
+from neighbors import normalize
+from similar_abstract_mongodb import AbstractSimilarity
+
+logger = logging.getLogger(__name__)
+
+
+def _tokenize_texts(texts):
+    return [AbstractSimilarity._tokenize(text, False) for text in texts]
+
+
+class MultiFieldSimilarity(AbstractSimilarity):
+    """
+    Similar entries from a weighted combination of title, abstract and body_text vectors.
+
+    The per-field vectors are computed as AbstractSimilarity computes the abstract vectors (same tokenization
+    and model), so the similarities of the two are comparable. They are cached in
+    `similarity_embeddings.<field>_embedding`, together with the sha1 of the text and the identity of the model
+    they were computed from;
+    the `embeddings` exported to Vespa (see mongo_to_feed_mongo.doc_to_json) come from another model and are
+    never touched.
+    Neighbors are found with the same top-k backend and stored in the same [similarity, _id] format
+    as AbstractSimilarity, with their own reverse index.
+    """
+    stage = "similar_entries"
+    collection = "entries_vespa2"  # entries exported to Vespa
+    reverse_collection = "similar_entries_reverse"
+
+    # entry names
+    similar_abstracts_entry = "similar_entries"  # relevant entries' similarity and _id
+    embeddings_entry = "similarity_embeddings"  # dict of <field>_embedding, not exported
+    embeddings_hash_entry = "similarity_embeddings_hash"  # dict of field -> sha1 of the text
+    embeddings_model_entry = "similarity_embeddings_model"  # identity of the model of the embeddings
+
+    # weights of the normalized field vectors in the combined vector
+    # fields with weight 0 do not count in the similarity
+    field_weights = {
+        "title": 0.25,
+        "abstract": 0.5,
+        "body_text": 0.25,
+    }
+    embedding_names = {
+        "title": "title_embedding",
+        "abstract": "abstract_embedding",
+        "body_text": "body_text_embedding",
+    }
+    max_body_paragraphs = 50  # paragraphs of body_text pooled into its vector
+    batch_size = 500  # entries embedded per batch
+
+    def __init__(self, model_path, field_weights=None, processes=None, db=None):
+        super(MultiFieldSimilarity, self).__init__(model_path, db=db)
+        if field_weights is not None:
+            self.field_weights = field_weights
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def build(self):
+        """
+        build similar entries from scratch, re-embedding every field
+        """
+        self.db[self.collection].update_many({}, {"$unset": {self.embeddings_hash_entry: ""}})
+        super(MultiFieldSimilarity, self).build()
+
+    def _field_texts(self, doc):
+        """
+        :return: dict of field -> list of texts to embed (the body_text paragraphs are pooled)
+        """
+        texts = {}
+        for field in ["title", "abstract"]:
+            text = doc.get(field, None)
+            if isinstance(text, list):
+                text = " ".join(text)
+            if text:
+                texts[field] = [text]
+
+        body_text = doc.get("body_text", None)
+        if isinstance(body_text, str):
+            body_text = [{"text": body_text}]
+        paragraphs = [p["text"] for p in (body_text or [])[:self.max_body_paragraphs] if p.get("text")]
+        if paragraphs:
+            texts["body_text"] = paragraphs
+        return texts
+
+    def _embed(self, tokens_list):
+        """
+        pool the sentence vectors of the texts of one field into a single vector
+        """
+        vectors = [self._tokens_vec(tokens)[0] for tokens in tokens_list if tokens]
+        if not vectors:
+            return None
+        if len(vectors) == 1:
+            return vectors[0]
+        return normalize(np.vstack(vectors)).mean(axis=0)
+
+    def _combine(self, embeddings):
+        """
+        weighted sum of the normalized field vectors
+        """
+        combined = None
+        for field, weight in self.field_weights.items():
+            embedding = embeddings.get(self.embedding_names[field], None)
+            if not weight or embedding is None:
+                continue
+            vec = normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0] * weight
+            combined = vec if combined is None else combined + vec
+        return combined
+
+    def _embed_batch(self, docs, pool):
+        """
+        compute the missing or outdated field embeddings of a batch of entries
+        all the texts of the batch are tokenized together in the pool
+
+        :return: list of embeddings dict, one for each doc, the list of update requests,
+            list of _id whose embeddings changed
+        """
+        jobs = []  # (doc position, field, text hash, number of texts)
+        texts = []
+        all_embeddings = []
+        for i, doc in enumerate(docs):
+            embeddings = dict(doc.get(self.embeddings_entry, None) or {})
+            hashes = doc.get(self.embeddings_hash_entry, None) or {}
+            if doc.get(self.embeddings_model_entry, None) != self.model_id:
+                hashes = {}
+            for field, field_texts in self._field_texts(doc).items():
+                text_hash = hashlib.sha1("\n".join(field_texts).encode("utf-8")).hexdigest()
+                if hashes.get(field) == text_hash and embeddings.get(self.embedding_names[field]) is not None:
+                    continue
+                jobs.append((i, field, text_hash, len(field_texts)))
+                texts.extend(field_texts)
+            all_embeddings.append(embeddings)
+
+        chunk_size = max(1, len(texts) // (self.processes * 4) + 1)
+        tokens = list(itertools.chain.from_iterable(
+            pool.imap(_tokenize_texts, [texts[j:j + chunk_size] for j in range(0, len(texts), chunk_size)])
+        ))
+
+        updates = {}
+        position = 0
+        for i, field, text_hash, n_texts in jobs:
+            vec = self._embed(tokens[position:position + n_texts])
+            position += n_texts
+            name = self.embedding_names[field]
+            all_embeddings[i][name] = vec.tolist() if vec is not None else None
+            update = updates.setdefault(i, {})
+            update["{}.{}".format(self.embeddings_entry, name)] = all_embeddings[i][name]
+            update["{}.{}".format(self.embeddings_hash_entry, field)] = text_hash
+            update[self.embeddings_model_entry] = self.model_id
+
+        requests = [UpdateOne({"_id": docs[i]["_id"]}, {"$set": update}) for i, update in updates.items()]
+        return all_embeddings, requests, [docs[i]["_id"] for i in updates]
+
+    def _load_vectors(self):
+        """
+        read (and compute when needed) the field embeddings of all the entries and combine them
+
+        :return: same as AbstractSimilarity._load_vectors
+        """
+        ids, vectors, current, recomputed = [], [], {}, []
+        projection = {field: 1 for field in self.embedding_names}
+        projection.update({self.embeddings_entry: 1, self.embeddings_hash_entry: 1, self.embeddings_model_entry: 1,
+                           self.similar_abstracts_entry: 1})
+        cursor = self.db[self.collection].find(
+            {"$or": [{field: {"$exists": True}} for field in self.embedding_names]}, projection
+        )
+        with multiprocessing.Pool(processes=self.processes) as pool:
+            while True:
+                docs = list(itertools.islice(cursor, self.batch_size))
+                if not docs:
+                    break
+                all_embeddings, requests, updated = self._embed_batch(docs, pool)
+                self._bulk_write(self.collection, requests)
+                recomputed.extend(updated)
+
+                for doc, embeddings in zip(docs, all_embeddings):
+                    combined = self._combine(embeddings)
+                    if combined is None:
+                        continue
+                    ids.append(doc["_id"])
+                    vectors.append(combined)
+                    current[doc["_id"]] = doc.get(self.similar_abstracts_entry, None)
+                logger.info("Embedded {} entries".format(len(ids)))
+
+        if vectors:
+            vectors = normalize(np.vstack(vectors))
+        else:
+            vectors = np.zeros((0, self.training_args["dim"]), dtype=np.float32)
+        return ids, vectors, current, recomputed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", help="Possible modes: build, update.", choices=["build", "update"])
+    parser.add_argument("-m", "--model", help="path to the fasttext model.", required=True)
+    parser.add_argument("-w", "--weights", help="field weights, e.g. title=0.25,abstract=0.5,body_text=0.25",
+                        default=None)
+    parser.add_argument("-p", "--processes", help="number of tokenization processes.", type=int, default=None)
+    parser.add_argument("-v", "--verbose", help="set logger level, default=WARNING", default="WARNING",
+                        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
+
+    args = parser.parse_args()
+
+    weights = None
+    if args.weights:
+        weights = {k: float(v) for k, v in (w.split("=") for w in args.weights.split(","))}
+        for field in weights:
+            if field not in MultiFieldSimilarity.embedding_names:
+                parser.error("unknown field {}".format(field))
+
+    out_hdlr = logging.StreamHandler(sys.stdout)
+    out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(out_hdlr)
+    logger.setLevel(args.verbose)
+
+    similarity = MultiFieldSimilarity(args.model, field_weights=weights, processes=args.processes)
+    if args.mode == "build":
+        similarity.build()
+    elif args.mode == "update":
+        similarity.update()
@@ -0,0 +1,69 @@
+import numpy as np
+
+__all__ = ['normalize', 'top_k']
+
+
+def normalize(vectors):
+    """
+    scale each row to unit length, so that dot products are cosine similarities
+    rows with zero norm are left as zeros
+    :type vectors: np.ndarray
+    :rtype: np.ndarray
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(queries, corpus, k, query_index=None, threshold=0.99, max_cells=2 ** 25):
+    """
+    find the k most similar corpus rows for each query row, by blocked matrix products
+
+    :param queries: normalized query vectors, shape (m, dim)
+    :type queries: np.ndarray
+    :param corpus: normalized corpus vectors, shape (n, dim)
+    :type corpus: np.ndarray
+    :param k: number of neighbors for each query
+    :type k: int
+    :param query_index: position of each query in the corpus, so that a query never finds itself,
+        -1 for queries which are not in the corpus
+    :type query_index: np.ndarray
+    :param threshold: similarities >= threshold are treated as the same abstract and skipped
+    :type threshold: float
+    :param max_cells: upper bound of the size of the similarity block held in memory
+    :type max_cells: int
+    :return: indices (m, k) into corpus and similarities (m, k), sorted by similarity descending.
+        missing neighbors have index -1 and similarity -inf.
+    """
+    m, n = len(queries), len(corpus)
+    indices = np.full((m, k), -1, dtype=np.int64)
+    similarities = np.full((m, k), -np.inf, dtype=np.float32)
+    if m == 0 or n == 0 or k == 0:
+        return indices, similarities
+
+    block_size = max(1, max_cells // n)
+    kk = min(k, n)
+    for start in range(0, m, block_size):
+        end = min(start + block_size, m)
+        sims = queries[start:end] @ corpus.T
+        if query_index is not None:
+            rows = np.nonzero(query_index[start:end] >= 0)[0]
+            sims[rows, query_index[start:end][rows]] = -np.inf
+        if threshold is not None:
+            sims[sims >= threshold] = -np.inf
+
+        if kk < n:
+            part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+        else:
+            part = np.tile(np.arange(n), (end - start, 1))
+        part_sims = np.take_along_axis(sims, part, axis=1)
+        order = np.argsort(-part_sims, axis=1, kind="stable")
+        block_indices = np.take_along_axis(part, order, axis=1)
+        block_sims = np.take_along_axis(part_sims, order, axis=1)
+        block_indices[np.isneginf(block_sims)] = -1
+
+        indices[start:end, :kk] = block_indices
+        similarities[start:end, :kk] = block_sims
+
+    return indices, similarities
@@ -1,13 +1,21 @@
 import os
 import sys
-import heapq
+import shutil
+import hashlib
 import pymongo
 import logging
 import fasttext
 import datetime
 import numpy as np
+from pymongo import UpdateOne
 
 from pretokenize import PreTokenize
+from corpus_builder import CorpusBuilder
+from neighbors import normalize, top_k
+from dedup import duplicate_groups
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'parsers'))
+from instrumentation import Metrics, save_run
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +24,19 @@ class AbstractSimilarity:
     # general configurations
     n = 3  # the number of relevant abstracts to store
 
+    stage = "similar_abstracts"  # name of the runs in the run records
     collection = "entries"  # collection to be updated
+    reverse_collection = "similar_abstracts_reverse"  # which entries list an entry as similar abstract
+    write_batch_size = 1000  # number of updates per bulk write
+    deduplicate = True  # search neighbors among one representative of each group of duplicated abstracts
+    duplicate_threshold = 0.99  # cosine similarity from which two abstracts are the same
 
     # entry names
     abstract_entry = "abstract"  # abstract_text
-    similar_abstracts_entry = "similar_abstracts"  # relevant abstracts' doi and similarity
-    doi_entry = "doi"  # doi
+    similar_abstracts_entry = "similar_abstracts"  # relevant abstracts' similarity and _id
     abstract_vec_entry = "abstract_vec"  # abstract_vec
+    abstract_hash_entry = "abstract_hash"  # sha1 of the abstract abstract_vec was computed from
+    abstract_model_entry = "abstract_model"  # identity of the model abstract_vec was computed with
 
     # tmp_dir
     tmp_dir = r"/var/tmp"  # used for storing tmp file when training
@@ -42,21 +56,36 @@ class AbstractSimilarity:
         "verbose": 2
     }
 
-    def __init__(self, model_path):
-        client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
-                                     password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
-        self.db = client[os.getenv("COVID_DB")]
-        logger.info("Log in to the database successfully.")
+    def __init__(self, model_path, db=None):
+        if db is None:
+            client = pymongo.MongoClient(os.getenv("COVID_HOST"), username=os.getenv("COVID_USER"),
+                                         password=os.getenv("COVID_PASS"), authSource=os.getenv("COVID_DB"))
+            db = client[os.getenv("COVID_DB")]
+            logger.info("Log in to the database successfully.")
+        self.db = db
         self.model_path = model_path
+        self.metrics = Metrics(self.stage, register=False)
         try:
             self.model = fasttext.load_model(self.model_path)
         except ValueError:
             pass
+        self.model_id = self._model_id()
 
-    def train(self):
+    def train(self, corpus_dir=None, use_existing_corpus=False, processes=None):
         """
         update the language model
+
+        :param corpus_dir: directory to keep the corpus shards in, a tmp directory is used (and removed) if None
+        :type corpus_dir: str
+        :param use_existing_corpus: when True, train on the corpus already in corpus_dir plus a delta of
+            the documents added since it was built, instead of rebuilding it. Abstracts edited after the
+            corpus was built are not picked up by the delta, rebuild the corpus to include them
+        :type use_existing_corpus: bool
+        :param processes: number of tokenization processes, default to the number of cpus
+        :type processes: int
         """
+        if use_existing_corpus and corpus_dir is None:
+            raise ValueError("use_existing_corpus needs the corpus_dir of a previously built corpus")
         self.model = None  # remove the old model (for saving memory)
 
         current_time = datetime.datetime.now()
@@ -65,22 +94,30 @@ class AbstractSimilarity:
                                                                        month=current_time.month,
                                                                        day=current_time.day)
         tmp_path = os.path.join(self.tmp_dir, file_name)
+        keep_corpus = corpus_dir is not None
+        if not keep_corpus:
+            corpus_dir = tmp_path + "_corpus"
 
         # make corpus
-        logger.info("Starting to build corpus for training, tmp file: {}".format(tmp_path))
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            for doc in self.db[self.collection].find({self.abstract_entry: {"$exists": True, "$ne": None}}):
-                tokens = PreTokenize.tokenize(doc.get(self.abstract_entry, ""), True)
-                if tokens:
-                    f.write(" ".join(tokens)+"\n")
+        builder = CorpusBuilder(self.db, self.collection, self.abstract_entry, processes=processes)
+        if use_existing_corpus:
+            logger.info("Updating corpus in {}".format(corpus_dir))
+            builder.build_delta(corpus_dir)
+        else:
+            logger.info("Starting to build corpus for training, corpus dir: {}".format(corpus_dir))
+            builder.build(corpus_dir)
+        builder.concatenate(builder.corpus_files(corpus_dir), tmp_path)
 
         logger.info("Training the model -- Arguments: {}".format(self.training_args))
         model = fasttext.train_unsupervised(input=tmp_path, **self.training_args)
         model.save_model(self.model_path)
         self.model = model  # load new model
+        self.model_id = self._model_id()
 
         # delete the tmp file
         os.remove(tmp_path)
+        if not keep_corpus:
+            shutil.rmtree(corpus_dir)
         logger.info("Successfully save the new model and remove tmp file")
         self.db.metadata.update_one(
             {"data": "last_word_embedding_trained"}, {"$set": {"datetime": datetime.datetime.now()}}
@@ -91,136 +128,202 @@ class AbstractSimilarity:
         build similar abstracts entries from scratch
         for initialize the database or after changing the model
         """
-        # clear all the similar_abstract_entry
-        self.db[self.collection].update({}, {"$unset": {self.similar_abstracts_entry: []}})
-        self.db[self.collection].update({}, {"$unset": {self.abstract_vec_entry: None}})
-
         current_time = datetime.datetime.now()
 
-        cursor1 = {self.abstract_entry: {"$exists": True}}
-        cursor2 = cursor1
-        # do update routine
-        self._update(cursor1, cursor2)
+        # clear all the similar_abstract_entry, the cached vectors and the reverse index
+        self.db[self.collection].update_many({}, {"$unset": {self.similar_abstracts_entry: "",
+                                                              self.abstract_vec_entry: "",
+                                                              self.abstract_hash_entry: "",
+                                                              self.abstract_model_entry: ""}})
+        self.db[self.reverse_collection].delete_many({})
+        self.metrics = Metrics(self.stage)
+
+        with self.metrics.timer("load_vectors", source=self.collection):
+            ids, vectors, _, _ = self._load_vectors()
+        self.metrics.count("entries", len(ids), source=self.collection)
+
+        # search over the representatives of the duplicate groups, then fan the lists out to the members
+        with self.metrics.timer("neighbor_search", source=self.collection):
+            labels, representatives = self._representatives(vectors)
+            representative_ids = [ids[i] for i in representatives]
+            indices, similarities = top_k(vectors[representatives], vectors[representatives], self.n,
+                                          query_index=np.arange(len(representatives)),
+                                          threshold=self.duplicate_threshold)
+        representative_lists = {
+            i: self._to_similar_abstracts(representative_ids, indices[row], similarities[row])
+            for row, i in enumerate(representatives)
+        }
+        new_lists = {_id: list(representative_lists[labels[i]]) for i, _id in enumerate(ids)}
+        self._save(new_lists, {})
 
         # log the update
         self.db.metadata.update_one(
             {"data": "last_abstract_similarity_sweep"}, {"$set": {"datetime": current_time}}, upsert=True
         )
+        save_run(self.metrics, self.db, mode="build")
 
     def update(self):
         """
-        update the database with the newly added doc
-        For faster speed, we employ some tricks:
-
-                           old papers          new papers
-                   _______________________________________
-                   |                        |            |
-                   |                        |            |
-                   |                        |            |
-                   |                        |            |
-              old  |                        |      a     |
-             paper |                        |            |
-                   |                        |            |
-                   |                        |            |
-                   |                        |            |
-                   |________________________|____________|
-                   |                        |            |
-              new  |                        |            |
-             paper |            a'          |      b     |
-                   |                        |            |
-                   |________________________|____________|
-
-        Considering the similarity matrix M above.
-        M[i][j] is the cosine similarity between ith and jth abstract vector.
-        Obviously, M is a symmetric matrix.
-        And we have to compare one abstract with all other abstracts at least onece.
-        Notice that when some new papers are added to the database, the matrix will have three new parts,
-        namely, a, a' and b.
-        a and a' are symmetric, so we only need to calculate a & b.
-
-        As for b, if we only compute the lower triangle of b, half of the time will be saved.
-        Here we use {"_id": {"$lt": doc["_id"]}} filter to do that.
+        update the database with the newly added doc and the docs whose abstract changed
+
+        Similar abstracts are stored as [similarity, _id] and every entry listed as a neighbor has a document
+        {"_id": <neighbor _id>, "listed_by": [<_id>, ...]} in the reverse collection.
+        When an entry is added or its abstract changes, only these lists are affected:
+            1. the entry's own list, computed against all the entries
+            2. the lists that contain the entry (found by the reverse index), recomputed against all the entries,
+               since the entry may have become less similar
+            3. any other list, which only has to consider the entry as a new candidate
+        so the cost is O(n * changed) instead of the O(n ^ 2) of a rebuild.
+        Duplicated abstracts are grouped first and only one representative of each group is a candidate,
+        every member of a group gets the list of its representative.
         """
-
-        last_abstract_similarity_sweep = self.db.metadata.find_one(
-            {'data': 'last_abstract_similarity_sweep'}
-        )['datetime']
-
         current_time = datetime.datetime.now()  # the routine may take very long time
-
-        # compute part b
-        # cursor1 = {self.abstract_entry: {"$exists": True}, "last_updated": {"$gte": last_abstract_similarity_sweep}}
-        cursor1 = {self.abstract_entry: {"$exists": True}, "similar_abstracts": {"$exists": False}}
-        print(last_abstract_similarity_sweep)
-        print(cursor1)
-        cursor2 = cursor1
-        self._update(cursor1, cursor2)
-
-        # compute part a
-        cursor2 = {self.abstract_entry: {"$exists": True}, "last_updated": {"$lt": last_abstract_similarity_sweep}}
-        cursor2 = {self.abstract_entry: {"$exists": True}, "similar_abstracts": {"$exists": True}}
-        self._update(cursor1, cursor2)
+        self.metrics = Metrics(self.stage)
+
+        with self.metrics.timer("load_vectors", source=self.collection):
+            ids, vectors, current, recomputed = self._load_vectors()
+        id_set = set(ids)
+
+        changed = set(recomputed)
+        changed.update(_id for _id in ids if current[_id] is None)
+        # entries which lost their abstract (or were removed) but are still listed by an entry, or still
+        # list entries in the reverse index (read from the listed_by index only, not the whole collection)
+        self.db[self.reverse_collection].create_index("listed_by")
+        removed = set(x[1] for similar_abstracts in current.values() for x in (similar_abstracts or []))
+        removed.update(self.db[self.reverse_collection].distinct("listed_by"))
+        removed -= id_set
+        logger.info("{} of {} entries changed, {} removed".format(len(changed), len(ids), len(removed)))
+
+        self.metrics.count("entries", len(ids), source=self.collection)
+        self.metrics.count("changed", len(changed), source=self.collection)
+        self.metrics.count("removed", len(removed), source=self.collection)
+
+        with self.metrics.timer("refresh", source=self.collection):
+            self.refresh(changed | removed, ids, vectors, current)
+
+        # removed entries do not list anything any more: neither in the reverse index nor, for the entries
+        # which only lost their abstract, in their own similar abstracts list
+        self.db[self.collection].update_many({"_id": {"$in": list(removed)}},
+                                             {"$unset": {self.similar_abstracts_entry: ""}})
+        self.db[self.reverse_collection].update_many({"listed_by": {"$in": list(removed)}},
+                                                     {"$pull": {"listed_by": {"$in": list(removed)}}})
+        self.db[self.reverse_collection].delete_many({"listed_by": {"$size": 0}})
 
         # log the update
-        # self.db.metadata.update_one(
-        #     {"data": "last_abstract_similarity_sweep"}, {"$set": {"datetime": current_time}}
-        # )
+        self.db.metadata.update_one(
+            {"data": "last_abstract_similarity_sweep"}, {"$set": {"datetime": current_time}}, upsert=True
+        )
+        save_run(self.metrics, self.db, mode="update")
 
-    def _update(self, cursor1, cursor2):
+    def refresh(self, changed, ids=None, vectors=None, current=None):
         """
-        general method for generating similar abstracts entry
-        if cursor1 and cursor2 are the same, we can reduce the computation from n ^ 2 to \frac{1}{2} n ^ 2
+        recompute the similar abstracts lists affected by the changed entries
 
-        :type cursor1: dict
-        :type cursor2: dict
+        :param changed: _id of the entries that are new, changed or removed
+        :type changed: set
+        :param ids, vectors, current: the output of self._load_vectors(), loaded if not given
         """
-        if cursor1 == cursor2:
-            cursor2 = None
-
-        print(self.db[self.collection].find(cursor1).count())
-        # for each abstracts to be updated
-        for doc in self.db[self.collection].find(cursor1):
-            try:
-                abstract, similar_abstracts, doi, abstract_vec, vec_norm = self._get_para_info(doc)
-            except TypeError:
-                continue
+        if ids is None:
+            ids, vectors, current, _ = self._load_vectors()
+        position = {_id: i for i, _id in enumerate(ids)}
+
+        # neighbors are only searched among the representatives of the duplicate groups
+        labels, representatives = self._representatives(vectors)
+        representative_row = {i: row for row, i in enumerate(representatives)}
+        representative_ids = [ids[i] for i in representatives]
+        representative_vectors = vectors[representatives]
+
+        # lists which must be recomputed from scratch
+        affected = set(_id for _id in changed if _id in position)
+        for r in self.db[self.reverse_collection].find({"_id": {"$in": list(changed)}}):
+            affected.update(_id for _id in r.get("listed_by", []) if _id in position)
+        affected_idx = np.array(sorted(position[_id] for _id in affected), dtype=np.int64)
+
+        new_lists = {}
+        query_rows = np.array([representative_row[labels[i]] for i in affected_idx], dtype=np.int64)
+        indices, similarities = top_k(representative_vectors[query_rows], representative_vectors, self.n,
+                                      query_index=query_rows, threshold=self.duplicate_threshold)
+        for row, i in enumerate(affected_idx):
+            new_lists[ids[i]] = self._to_similar_abstracts(representative_ids, indices[row], similarities[row])
+
+        # other lists only take the changed representatives as new candidates
+        changed_rows = np.array(sorted(
+            representative_row[position[_id]] for _id in changed
+            if _id in position and labels[position[_id]] == position[_id]
+        ), dtype=np.int64)
+        if len(changed_rows):
+            changed_ids = [representative_ids[row] for row in changed_rows]
+            changed_column = {row: column for column, row in enumerate(changed_rows)}
+            other_mask = np.ones(len(ids), dtype=bool)
+            other_mask[affected_idx] = False
+            other_idx = np.nonzero(other_mask)[0]
+            query_rows = np.array([representative_row[labels[i]] for i in other_idx], dtype=np.int64)
+            # an entry never gets its own group as candidate
+            exclude = np.array([changed_column.get(row, -1) for row in query_rows], dtype=np.int64)
+            indices, similarities = top_k(representative_vectors[query_rows], representative_vectors[changed_rows],
+                                          self.n, query_index=exclude, threshold=self.duplicate_threshold)
+            for row, i in enumerate(other_idx):
+                if indices[row, 0] == -1:
+                    continue
+                old = current[ids[i]] or []
+                candidates = old + self._to_similar_abstracts(changed_ids, indices[row], similarities[row])
+                merged = sorted(candidates, key=lambda x: x[0], reverse=True)[:self.n]
+                if merged != old:
+                    new_lists[ids[i]] = merged
+
+        logger.info("Updating {} similar abstracts lists".format(len(new_lists)))
+        self._save(new_lists, current)
+
+    def _save(self, new_lists, current):
+        """
+        write the new similar abstracts lists and keep the reverse index in sync
 
-            # for each abstract in the database
-            if cursor2 is None:
-                _cursor2 = self.db[self.collection].find(
-                    dict(cursor1, _id={"$lt": doc["_id"]})
+        :param new_lists: _id -> new similar abstracts list
+        :type new_lists: dict
+        :param current: _id -> similar abstracts list currently in the database
+        :type current: dict
+        """
+        self.metrics.count("lists_written", len(new_lists), source=self.collection)
+        requests = []
+        reverse_requests = []
+        for _id, similar_abstracts in new_lists.items():
+            requests.append(UpdateOne({"_id": _id}, {"$set": {self.similar_abstracts_entry: similar_abstracts}}))
+
+            old_neighbors = set(x[1] for x in (current.get(_id) or []))
+            new_neighbors = set(x[1] for x in similar_abstracts)
+            for neighbor in new_neighbors - old_neighbors:
+                reverse_requests.append(
+                    UpdateOne({"_id": neighbor}, {"$addToSet": {"listed_by": _id}}, upsert=True)
                 )
-            else:
-                _cursor2 = self.db[self.collection].find(cursor2)
-            for doc_ in _cursor2:
-                try:
-                    abstract_, similar_abstracts_, doi_, abstract_vec_, vec_norm_ = self._get_para_info(doc_)
-                except TypeError:
-                    continue
+            for neighbor in old_neighbors - new_neighbors:
+                reverse_requests.append(UpdateOne({"_id": neighbor}, {"$pull": {"listed_by": _id}}))
 
-                # calculate cosine similarity
-                similarity = (abstract_vec @ abstract_vec_) / (vec_norm * vec_norm_)
-                if similarity >= 0.99:  # when doc and doc_ are exactly the same
-                    continue
-                similarity = float(similarity)
-                # update the best match list
-                if len(similar_abstracts) < self.n:
-                    similar_abstracts.append([similarity, doi_])
-                    heapq.heapify(similar_abstracts)
-                else:
-                    heapq.heappushpop(similar_abstracts, [similarity, doi_])
-                if len(similar_abstracts_) < self.n:
-                    similar_abstracts_.append([similarity, doi])
-                    heapq.heapify(similar_abstracts_)
-                else:
-                    heapq.heappushpop(similar_abstracts_, [similarity, doi])
-                self.db[self.collection].update_one({self.doi_entry: doi_},
-                                                    {"$set": {self.similar_abstracts_entry: similar_abstracts_}},
-                                                    upsert=True)
-
-            self.db[self.collection].update_one({self.doi_entry: doi},
-                                                {"$set": {self.similar_abstracts_entry: similar_abstracts}},
-                                                upsert=True)
+        self._bulk_write(self.collection, requests)
+        self._bulk_write(self.reverse_collection, reverse_requests)
+        self.db[self.reverse_collection].delete_many({"listed_by": {"$size": 0}})
+
+    def _bulk_write(self, collection, requests):
+        for i in range(0, len(requests), self.write_batch_size):
+            self.db[collection].bulk_write(requests[i:i + self.write_batch_size], ordered=False)
+
+    def _representatives(self, vectors):
+        """
+        group the duplicated abstracts (the same abstract from several sources or preprint versions)
+        :return: labels: index of the representative of each vector,
+                 representatives: sorted indices of the representatives
+        """
+        if self.deduplicate:
+            labels = duplicate_groups(vectors, threshold=self.duplicate_threshold)
+        else:
+            labels = np.arange(len(vectors))
+        return labels, np.unique(labels)
+
+    @staticmethod
+    def _to_similar_abstracts(ids, indices, similarities):
+        """
+        convert one row of top_k results into a similar abstracts list: [[similarity, _id], ...]
+        """
+        return [[float(similarity), ids[j]] for j, similarity in zip(indices, similarities) if j != -1]
 
     def _get_para_vec(self, abstract_text, restrict_min_token_num=True):
         """
@@ -232,44 +335,98 @@ class AbstractSimilarity:
         :return: abstract_vec, vec_norm
         """
         # tokenize
-        abstract_tokens = PreTokenize.tokenize(abstract_text, restrict_min_token_num)
+        abstract_tokens = self._tokenize(abstract_text, restrict_min_token_num)
         if not abstract_tokens:
             return None, None  # must carefully handle this situation
 
-        # get vec
-        abstract_vec = self.model.get_sentence_vector(" ".join(abstract_tokens))
+        return self._tokens_vec(abstract_tokens)
+
+    @staticmethod
+    def _tokenize(text, restrict_min_token_num=True):
+        """
+        tokenize a text as _get_para_vec does, it can be done apart (e.g. in a process pool)
+        """
+        return PreTokenize.tokenize(text, restrict_min_token_num)
+
+    def _tokens_vec(self, tokens):
+        """
+        the vector of tokenized text
+        :return: abstract_vec, vec_norm
+        """
+        abstract_vec = self.model.get_sentence_vector(" ".join(tokens))
         vec_norm = np.sqrt(abstract_vec @ abstract_vec)
 
         return abstract_vec, vec_norm
 
-    def _get_para_info(self, doc):
+    def _model_id(self):
         """
-        get necessary information from the doc object
-        :param doc: dict-like object
-        :return: abstract, similar_abstracts, doi, abstract_vec, vec_norm
+        identity of the model file (size and modification time), None if there is no model file
         """
-        abstract = doc.get(self.abstract_entry, "") or ""
-        similar_abstracts = doc.get(self.similar_abstracts_entry, []) or []
-        doi = doc.get(self.doi_entry, "") or ""
-
-        if not doi or not abstract:
+        if not self.model_path or not os.path.isfile(self.model_path):
             return None
+        stat = os.stat(self.model_path)
+        return "{}:{}".format(stat.st_size, int(stat.st_mtime))
 
-        tmp = doc.get(self.abstract_vec_entry, None)
-        no_vec = tmp is None
-        if no_vec:
-            tmp = self._get_para_vec(abstract, False)
-        if tmp[0] is None:
-            #logger.info("{} cannot be tokenized.".format(doi))
-            return None
-        if no_vec:
-            byte_array = (tmp[0].tobytes(), tmp[1].tobytes())
-            self.db[self.collection].update_one({"doi": doi}, {"$set": {self.abstract_vec_entry: byte_array}},
-                                                upsert=True)
-        abstract_vec, vec_norm = tmp
-        abstract_vec = np.frombuffer(abstract_vec, dtype=np.float32)
-        vec_norm = np.frombuffer(vec_norm, dtype=np.float32)
-        return abstract, similar_abstracts, doi, abstract_vec, vec_norm
+    def _load_vectors(self):
+        """
+        read the abstract vectors of all the entries
+        vectors are cached in the entries together with the hash of the abstract and the identity of the model
+        they were computed from, missing or outdated ones are computed and written back
+
+        :return: ids: list of _id,
+                 vectors: normalized vectors as np.ndarray, in the order of ids,
+                 current: dict of _id -> similar abstracts list in the database (None if missing),
+                 recomputed: list of _id whose vector has been (re)computed
+        """
+        ids, vectors, current, recomputed = [], [], {}, []
+        requests = []
+        cursor = self.db[self.collection].find(
+            {self.abstract_entry: {"$exists": True}},
+            {self.abstract_entry: 1, self.abstract_vec_entry: 1, self.abstract_hash_entry: 1,
+             self.abstract_model_entry: 1, self.similar_abstracts_entry: 1}
+        )
+        for doc in cursor:
+            abstract = doc.get(self.abstract_entry, "") or ""
+            if isinstance(abstract, list):
+                abstract = " ".join(abstract)
+            if not abstract:
+                continue
+
+            abstract_hash = hashlib.sha1(abstract.encode("utf-8")).hexdigest()
+            cached_hash = doc.get(self.abstract_hash_entry, None)
+            abstract_vec = doc.get(self.abstract_vec_entry, None)
+            if abstract_vec is not None and cached_hash in (None, abstract_hash) \
+                    and doc.get(self.abstract_model_entry, None) == self.model_id:
+                abstract_vec = np.frombuffer(abstract_vec[0], dtype=np.float32)
+                if cached_hash is None:  # vectors cached before the hash was stored
+                    requests.append(UpdateOne({"_id": doc["_id"]},
+                                              {"$set": {self.abstract_hash_entry: abstract_hash}}))
+            else:
+                abstract_vec, vec_norm = self._get_para_vec(abstract, False)
+                if abstract_vec is None:
+                    # logger.info("{} cannot be tokenized.".format(doc["_id"]))
+                    continue
+                byte_array = (abstract_vec.tobytes(), vec_norm.tobytes())
+                requests.append(UpdateOne({"_id": doc["_id"]},
+                                          {"$set": {self.abstract_vec_entry: byte_array,
+                                                    self.abstract_hash_entry: abstract_hash,
+                                                    self.abstract_model_entry: self.model_id}}))
+                recomputed.append(doc["_id"])
+
+            if len(requests) >= self.write_batch_size:
+                self._bulk_write(self.collection, requests)
+                requests = []
+
+            ids.append(doc["_id"])
+            vectors.append(abstract_vec)
+            current[doc["_id"]] = doc.get(self.similar_abstracts_entry, None)
+
+        self._bulk_write(self.collection, requests)
+        if vectors:
+            vectors = normalize(np.vstack(vectors))
+        else:
+            vectors = np.zeros((0, self.training_args["dim"]), dtype=np.float32)
+        return ids, vectors, current, recomputed
 
 
 if __name__ == "__main__":
@@ -278,6 +435,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("mode", help="Possible modes: train, build, update.", choices=["train", "build", "update"])
     parser.add_argument("-m", "--model", help="path to the fasttext model.", required=True)
+    parser.add_argument("-c", "--corpus", help="directory to keep the training corpus in.", default=None)
+    parser.add_argument("--resume-corpus", help="train on the existing corpus plus the newly added abstracts.",
+                        action="store_true")
+    parser.add_argument("-p", "--processes", help="number of tokenization processes.", type=int, default=None)
     parser.add_argument("-v", "--verbose", help="set logger level, default=WARNING", default="WARNING",
                         choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
 
@@ -296,7 +457,7 @@ if __name__ == "__main__":
     
     aa = AbstractSimilarity(model_path)
     if mode == "train":
-        aa.train()
+        aa.train(corpus_dir=args.corpus, use_existing_corpus=args.resume_corpus, processes=args.processes)
     elif mode == "build":
         aa.build()
     elif mode == "update":